@@ -1,34 +1,72 @@
 # coding=utf-8
 from __future__ import absolute_import, unicode_literals
-from threading import Timer
-from json import dumps
+import os
+from collections import deque
+from threading import Lock
+from logging import DEBUG
+from time import perf_counter_ns, time
 from flask import abort, jsonify
-from re import search
 
 import octoprint.plugin
 from octoprint.server import user_permission
 from octoprint.events import Events
-
-from octoprint_prusammu.common.Mmu import MmuStates, MmuKeys, MMU3Codes, \
-  MMU3RequestCodes, MMU3ResponseCodes, MMU3MK4Commands, DEFAULT_MMU_STATE
+from octoprint.filemanager import FileDestinations, valid_file_type
+from octoprint.filemanager.util import StreamWrapper
+
+from octoprint_prusammu.common.Mmu import MmuStates, MmuKeys, MMU3ResponseCodes, MmuState, \
+  DEFAULT_MMU_STATE
+from octoprint_prusammu.common.Coalescer import Coalescer
+from octoprint_prusammu.common.DebugLog import DebugLog, format_message
+from octoprint_prusammu.common.ErrorHistory import ErrorHistory
+from octoprint_prusammu.common.EventDispatcher import EventDispatcher
+from octoprint_prusammu.common.FilamentCatalogue import FilamentCatalogue, parse_slots
+from octoprint_prusammu.common.FilamentMapStream import FilamentMapStream
+from octoprint_prusammu.common.Gcode import ToolRemap, ToolRemapState, PASSTHROUGH_REMAP, \
+  parse_tool, has_filament_map_header
+from octoprint_prusammu.common.GcodeIndex import GcodeIndexCache
+from octoprint_prusammu.common.HookStats import HookStats, timed
+from octoprint_prusammu.common.MmuProtocolParser import MmuProtocolParser, is_mmu_line
+from octoprint_prusammu.common.PhaseTimes import PhaseTimes
 from octoprint_prusammu.common.PluginEventKeys import PluginEventKeys
+from octoprint_prusammu.common.ProfileCache import ProfileCache
 from octoprint_prusammu.common.SettingsKeys import SettingsKeys
+from octoprint_prusammu.common.StateJournal import StateJournal
 from octoprint_prusammu.common.StateKeys import StateKeys, DEFAULT_STATE
+from octoprint_prusammu.common.ToolChangeEstimate import ToolChangeEstimate, index_tools
 from octoprint_prusammu.common.PrusaProfile import PrusaProfile, detect_connection_profile
+from octoprint_prusammu.common.Scheduler import Scheduler
 
 
 # === Constants ===
 DEFAULT_TIMEOUT = 30
+DEFAULT_NAV_UPDATE_INTERVAL = 250 # ms
+JOURNAL_FLUSH_INTERVAL = 1 # s
+# What's put back from the state journal, prusaVersion is left to be detected again
+RESTORED_MMU_KEYS = [
+  MmuKeys.STATE, MmuKeys.TOOL, MmuKeys.PREV_TOOL, MmuKeys.RESPONSE, MmuKeys.RESPONSE_DATA,
+]
+# MMU lines kept while the printer profile isn't known yet, the oldest are dropped past this
+HELD_LINES = 256
+# Reported by getstats
+TIMED_HOOKS = [
+  "gcode_queuing_hook", "gcode_sent_hook", "gcode_received_hook", "_fire_event", "_update_navbar",
+]
 PLUGIN_NAME = "prusammu"
 TAG_PREFIX = "prusaMMUPlugin:"
 TIMEOUT_TAG = "{}timeout".format(TAG_PREFIX)
-FILAMENT_SOURCE_DEFAULT = [
+FILAMENT_SOURCE_DEFAULT = (
   dict(name="Prusa MMU", id=PLUGIN_NAME),
-]
-TOOL_REGEX = r"^T(\d+)"
+)
+# Plugin identifier and the source it adds when it's enabled
+FILAMENT_SOURCE_PLUGINS = (
+  ("filamentmanager", dict(name="Filament Manager", id="filamentManager")),
+  ("SpoolManager", dict(name="Spool Manager", id="spoolManager")),
+  ("Spoolman", dict(name="Spool Man", id="spoolMan")),
+)
 
 
 class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
+                     octoprint.plugin.ShutdownPlugin,
                      octoprint.plugin.TemplatePlugin,
                      octoprint.plugin.AssetPlugin,
                      octoprint.plugin.EventHandlerPlugin,
@@ -38,14 +76,75 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
   def __init__(self):
     # Used for MK4 to retain the override.
     self.filamentOverride = None
+    # How gcode_queuing_hook rewrites T# commands and the filament map setting, see
+    # _rebuild_tool_remap. Read it into a local once, it can be swapped at any time.
+    self.toolRemap = PASSTHROUGH_REMAP
+    # The file being printed had the filament map written into it at upload
+    self.fileToolMapped = False
 
     # Dialog Status Variables
-    self.timer = None
+    # Pending prompt timeout, the lock makes sure a prompt is resolved once (see _take_prompt)
+    self.promptTimeout = None
+    self._promptLock = Lock()
     self.states = DEFAULT_STATE.copy()
 
     # MMU Status - Used to display MMU data in the navbar
-    self.mmu = DEFAULT_MMU_STATE.copy()
-    self.lastMmuAction = ""
+    self.mmu = DEFAULT_MMU_STATE
+    # Turns received lines into MMU changes, see MmuProtocolParser
+    self.parser = MmuProtocolParser()
+    # Dict form of self.mmu, see _mmu_payload
+    self._mmuPayload = (None, None)
+    # Every nav message is numbered so browsers can ask getmmu if they missed any. Nav updates come
+    # from several threads, the lock keeps the numbers unique and in the order they're pushed.
+    self.navSeq = 0
+    self._navLock = Lock()
+    # Runs the prompt timeout, nav flushes and other delayed work on one thread
+    self.scheduler = Scheduler()
+    # Limits how often nav messages go out to the browsers
+    self.navCoalescer = Coalescer(self._send_navbar, self.scheduler, DEFAULT_NAV_UPDATE_INTERVAL)
+    # Event firing and logging happen here instead of on the serial comm thread
+    self.dispatcher = EventDispatcher()
+    # Debug records, read with getdebug
+    self.debugLog = DebugLog()
+    # Call counts and latencies of the hooks, read with getstats
+    self.hookStats = HookStats(TIMED_HOOKS)
+    # How long each slot spends in each load/unload phase, read with getphases
+    self.phaseTimes = PhaseTimes()
+    # Tool change index of uploaded files, set up on startup (needs the data folder). Files are
+    # scanned (and dropped from it) one at a time on the indexer's thread.
+    self.gcodeIndex = None
+    self.indexer = EventDispatcher(name="prusammu-index")
+    self._indexing = set()
+    self._indexLock = Lock()
+    # Local gcode being printed, its tool changes are followed for the estimate below
+    self.jobPath = None
+    # perf_counter_ns of the T# last sent until the MMU has loaded it
+    self.toolChangeStart = None
+    # Time the tool changes left in the job will take, sent with the nav
+    self.toolChangeEstimate = ToolChangeEstimate()
+    self.toolChangeTimeLeft = None
+    # MMU states that survive a restart, set up on startup (needs the data folder). restoreRecord is
+    # the state to put back, read off the comm thread and applied on it (see _restore_mmu).
+    self.stateJournal = None
+    self.restoreRecord = None
+    # MMU errors seen, read with geterrors. The last error code recorded so one error isn't
+    # recorded again as its state changes (kept with the MMU state, see _fire_event).
+    self.errorHistory = ErrorHistory()
+    self._lastErrorCode = None
+    # Profile last detected per connection (see _assume_profile). assumedProfile is set while the
+    # profile in use came from the cache and the firmware hasn't confirmed it. heldLines are the MMU
+    # lines received before any profile was known, parsed once one is (comm thread only).
+    self.profileCache = ProfileCache()
+    self.connectionKey = None
+    self.connectionKeyFailed = False
+    self.assumedProfile = None
+    self.heldLines = deque(maxlen=HELD_LINES)
+    # Filament sources offered in the settings, found on startup (see _find_filament_sources)
+    self.filamentSources = list(FILAMENT_SOURCE_DEFAULT)
+    # What's in each slot for the browsers, read with getfilament
+    self.filamentCatalogue = FilamentCatalogue(PLUGIN_NAME)
+    # How long on_after_startup took and the part of startup left to the dispatcher, see getstats
+    self.startupMs = dict(sync=None, deferred=None)
 
     # Local Settings Config
     self.config = dict(
@@ -59,41 +158,69 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
       filamentMap=[],
       filamentCount=5,
       useFilamentMap=False,
+      rewriteFilamentMap=False,
       enablePrompt=True,
       prusaVersion="",
+      navUpdateInterval=DEFAULT_NAV_UPDATE_INTERVAL,
     )
 
   # ======== Startup ========
 
+  # Only what has to be ready before the printer talks to us runs here (that includes reading the
+  # profile cache), anything else that reads files or looks around is left to _deferred_startup on
+  # the dispatcher thread. Nothing is written.
   def on_after_startup(self):
+    start = perf_counter_ns()
     self._log("on_after_startup")
-    
+    self.dispatcher.logger = self._logger
+    self.dispatcher.start()
+    self.indexer.logger = self._logger
+    self.indexer.start()
+    self.scheduler.logger = self._logger
+    self.scheduler.start()
+    dataFolder = self.get_plugin_data_folder()
+    self.gcodeIndex = GcodeIndexCache(os.path.join(dataFolder, "index"))
+    self.stateJournal = StateJournal(dataFolder)
+    self.scheduler.call_every(JOURNAL_FLUSH_INTERVAL, self.stateJournal.flush)
+    self.errorHistory.path = os.path.join(dataFolder, "errors.json")
+    # One small file, the comm thread reads it as soon as a printer connects
+    self.profileCache.path = os.path.join(dataFolder, "profiles.json")
+    self.profileCache.load()
+
+    self._refresh_config()
+    self.mmu = DEFAULT_MMU_STATE
+    self.parser.reset()
+    self.dispatcher.submit(self._deferred_startup)
+    self.startupMs["sync"] = round((perf_counter_ns() - start) / 1000000, 2)
+
+  def _deferred_startup(self):
+    start = perf_counter_ns()
+    # Errors are recorded on this thread as well, so none can be recorded before this load
+    self.errorHistory.load()
+    self.filamentSources = self._find_filament_sources()
+    self.config[SettingsKeys.FILAMENT_SOURCES] = self.filamentSources
+    self._queue_restore()
+    self.startupMs["deferred"] = round((perf_counter_ns() - start) / 1000000, 2)
+    self._log("_deferred_startup", obj=self.startupMs, debug=True)
+
+  # The sources filament names can come from, ours and any filament plugin that's enabled
+  def _find_filament_sources(self):
+    sources = list(FILAMENT_SOURCE_DEFAULT)
     try:
-      # After startup set the sources we have available
-      # TODO: Move this out of settings
-      sources = FILAMENT_SOURCE_DEFAULT
-      filamentManager = self._plugin_manager.get_plugin_info("filamentmanager")
-      if filamentManager is not None and filamentManager.enabled:
-        self._log("Found Filament Manager")
-        sources.append(dict(name="Filament Manager", id="filamentManager"))
-
-      spoolManager = self._plugin_manager.get_plugin_info("SpoolManager")
-      if spoolManager is not None and spoolManager.enabled:
-        self._log("Found Spool Manager")
-        sources.append(dict(name="Spool Manager", id="spoolManager"))
-
-      spoolMan = self._plugin_manager.get_plugin_info("Spoolman")
-      if spoolMan is not None and spoolMan.enabled:
-        self._log("Found Spool Man")
-        sources.append(dict(name="Spool Man", id="spoolMan"))
-
-      self._settings.set([SettingsKeys.FILAMENT_SOURCES], sources)
-      self._settings.save()
+      for name, source in FILAMENT_SOURCE_PLUGINS:
+        info = self._plugin_manager.get_plugin_info(name)
+        if info is not None and info.enabled:
+          self._log("Found {}".format(source["name"]))
+          sources.append(source)
     except Exception as e:
       self._log("Failed to load sources {}".format(str(e)))
+    return sources
 
-    self._refresh_config()
-    self.mmu = DEFAULT_MMU_STATE.copy()
+  # ======== ShutdownPlugin ========
+
+  def on_shutdown(self):
+    if self.stateJournal is not None:
+      self.stateJournal.flush()
 
   # ======== TemplatePlugin ========
 
@@ -116,6 +243,15 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
     return dict(
       select=["choice"],
       getmmu=[],
+      getqueue=[],
+      getdebug=[],
+      getstats=[],
+      getphases=[],
+      geterrors=[],
+      resetstats=[],
+      getindex=["path"],
+      getfilament=[],
+      setfilament=["source", "filament"],
     )
 
   def on_api_command(self, command, data):
@@ -123,34 +259,140 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
       if not user_permission.can():
         return abort(403, "Insufficient permissions")
 
-      if self.states[StateKeys.ACTIVE] is False:
-        return abort(409, "No active prompt")
-
       choice = data["choice"]
       if choice != "skip" and not (int(choice) < self.config[SettingsKeys.FILAMENT_COUNT] or int(choice) >= 0):
         return abort(400, "{} is not a valid value for filament choice".format(choice+1))
 
-      self._log("on_api_command T{}".format(choice), debug=True)
+      # Also stops the timeout (or another browser) from handling the same prompt
+      if not self._take_prompt():
+        return abort(409, "No active prompt")
+
+      self._log("on_api_command T{}", choice, debug=True)
       if choice != "skip":
         self._fire_event(PluginEventKeys.MMU_CHANGE, dict(tool=choice))
       self._done_prompt(choice)
       return
 
     if command == "getmmu":
-      return jsonify(self._fire_event(PluginEventKeys.REFRESH_NAV))
+      # Answers only the browser asking. If it has already seen the latest nav message there's
+      # nothing to send.
+      seq = self.navSeq
+      if data.get("seq") == seq:
+        return jsonify(dict(unchanged=True, seq=seq))
+      return jsonify(dict(self._mmu_payload(), seq=seq, **self._estimate_payload()))
+
+    if command == "getqueue":
+      return jsonify(self.dispatcher.stats())
+
+    if command == "getstats":
+      return jsonify(dict(
+        self.hookStats.to_dict(),
+        dispatcher=self.dispatcher.stats(),
+        scheduled=self.scheduler.pending(),
+        suppressedLines=self.parser.recentLines.suppressed,
+        journal=self.stateJournal.stats() if self.stateJournal is not None else None,
+        startupMs=dict(self.startupMs),
+      ))
+
+    if command == "resetstats":
+      if not user_permission.can():
+        return abort(403, "Insufficient permissions")
+      self.hookStats.reset()
+      return
+
+    if command == "getphases":
+      return jsonify(self.phaseTimes.to_dict())
+
+    if command == "geterrors":
+      try:
+        since = int(data.get("since", 0))
+        limit = int(data.get("limit", 50))
+      except (TypeError, ValueError):
+        return abort(400, "since and limit must be numbers")
+      records, nextSeq = self.errorHistory.read(since, limit)
+      return jsonify(dict(
+        first=self.errorHistory.first(),
+        next=nextSeq,
+        counts=dict(self.errorHistory.counts),
+        records=records,
+      ))
+
+    if command == "getindex":
+      return self._get_index(data["path"], bool(data.get("entries")))
+
+    if command == "getfilament":
+      payload = self._filament_payload()
+      if data.get("version") == payload["version"]:
+        return jsonify(dict(unchanged=True, version=payload["version"]))
+      return jsonify(payload)
+
+    if command == "setfilament":
+      if not user_permission.can():
+        return abort(403, "Insufficient permissions")
+      slots = parse_slots(data["filament"])
+      if slots is None:
+        return abort(400, "filament must be a list of slots")
+      if self.filamentCatalogue.set_spools(str(data["source"]), slots):
+        self._log("on_api_command setfilament {}", data["source"], obj=slots, debug=True)
+        self._filament_changed()
+      return jsonify(dict(version=self._filament_payload()["version"]))
+
+    if command == "getdebug":
+      try:
+        since = int(data.get("since", 0))
+        limit = int(data.get("limit", 100))
+      except (TypeError, ValueError):
+        return abort(400, "since and limit must be numbers")
+      records, nextSeq = self.debugLog.read(since, limit)
+      return jsonify(dict(
+        enabled=bool(self.config.get(SettingsKeys.DEBUG)),
+        first=self.debugLog.first(),
+        next=nextSeq,
+        records=records,
+      ))
+
+  # ======== Filament ========
+
+  def _filament_payload(self):
+    return self.filamentCatalogue.to_dict(self.config[SettingsKeys.FILAMENT_SOURCE],
+                                          self._settings.get([SettingsKeys.FILAMENT]),
+                                          self.config[SettingsKeys.FILAMENT_COUNT])
+
+  # Browsers only get the new version, they ask for the filament with getfilament
+  def _filament_changed(self):
+    self.filamentCatalogue.invalidate()
+    self._plugin_manager.send_plugin_message(
+      self._identifier, dict(action="filament", version=self._filament_payload()["version"]))
 
   # ======== Prompt ========
 
   def _show_prompt(self):
-    self.states[StateKeys.ACTIVE] = True
-    self.timer = Timer(float(self.config[SettingsKeys.TIMEOUT]), self._timeout_prompt)
-    self.timer.start()
+    with self._promptLock:
+      if self.promptTimeout is not None:
+        self.promptTimeout.cancel()
+      self.states[StateKeys.ACTIVE] = True
+      self.promptTimeout = self.scheduler.call_later(
+        float(self.config[SettingsKeys.TIMEOUT]), self._timeout_prompt)
     self._plugin_manager.send_plugin_message(self._identifier, dict(action="show"))
 
+  # A prompt ends with a select, a skip or the timeout and they can happen at the same time on
+  # different threads. Only the first one to get here gets True and handles the prompt.
+  def _take_prompt(self):
+    with self._promptLock:
+      if not self.states[StateKeys.ACTIVE]:
+        return False
+      self.states[StateKeys.ACTIVE] = False
+      if self.promptTimeout is not None:
+        self.promptTimeout.cancel()
+        self.promptTimeout = None
+      return True
+
   def _timeout_prompt(self):
+    if not self._take_prompt():
+      return
     self._log("_timeout_prompt", debug=True)
     # non-MK3 can't use default filament, instead it just defaults to whatever it was sliced with.
-    if self.mmu[MmuKeys.PRUSA_VERSION] == PrusaProfile.MK3:
+    if self.mmu.prusaVersion == PrusaProfile.MK3:
       # Handle if the user had a default filament
       if (
         self.config[SettingsKeys.USE_DEFAULT_FILAMENT] and
@@ -163,7 +405,7 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
     self._clean_up_prompt()
 
   def _done_prompt(self, command, tags=set()):
-    self._log("_done_prompt {}".format(command), debug=True)
+    self._log("_done_prompt {}", command, debug=True)
     # If we get a skip then the user chose to skip
     if str(command) == "skip":
       self._log("_done_prompt SKIP", debug=True)
@@ -175,68 +417,218 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
 
     # MK4: Enable filament rewrite
     if (
-      self.mmu[MmuKeys.PRUSA_VERSION] != PrusaProfile.MK3 and
-      self.mmu[MmuKeys.PRUSA_VERSION] is not None
+      self.mmu.prusaVersion != PrusaProfile.MK3 and
+      self.mmu.prusaVersion is not None
     ):
       self._enable_mk4_remap(command)
 
     self._clean_up_prompt()
 
+  # The prompt has been taken (see _take_prompt)
   def _clean_up_prompt(self):
     self._log("_clean_up_prompt", debug=True)
-    self.timer.cancel()
-    self.states[StateKeys.ACTIVE] = False
     self._plugin_manager.send_plugin_message(self._identifier, dict(action="close"))
     self._printer.set_job_on_hold(False)
 
   # ======== MK4 Remap ========
 
   def _enable_mk4_remap(self, command):
-    self._log("_enable_mk4_remap T{}".format(command), debug=True)
+    self._log("_enable_mk4_remap T{}", command, debug=True)
     self.filamentOverride = command
+    self._rebuild_tool_remap()
 
   def _disable_mk4_remap(self):
     self._log("_disable_mk4_remap", debug=True)
     self.filamentOverride = None
+    self._rebuild_tool_remap()
     return
 
+  # ======== Gcode Index ========
+
+  def _get_index(self, path, entries=False):
+    if self.gcodeIndex is None:
+      return abort(503, "Not started")
+    try:
+      diskPath = self._file_manager.path_on_disk(FileDestinations.LOCAL, path)
+    except Exception:
+      return abort(404, "Unknown file {}".format(path))
+    if not os.path.isfile(diskPath):
+      return abort(404, "Unknown file {}".format(path))
+
+    index = self.gcodeIndex.get(diskPath)
+    if index is None:
+      # Big files take a while, come back later
+      self._queue_index(path)
+      return jsonify(dict(path=path, indexing=True)), 202
+
+    index = dict(index, path=path)
+    if not entries:
+      index.pop("entries")
+    return jsonify(index)
+
+  # Scans the file in the background unless it's cached or already being scanned. path is relative
+  # to local storage.
+  def _queue_index(self, path):
+    if self.gcodeIndex is None:
+      return
+    with self._indexLock:
+      if path in self._indexing:
+        return
+      self._indexing.add(path)
+    self.indexer.submit(self._build_index, path)
+
+  # Drops the cached index of a file that was removed or moved away, after any scan queued before
+  def _queue_index_removal(self, path):
+    if self.gcodeIndex is None:
+      return
+    self.indexer.submit(self._remove_index, path)
+
+  def _build_index(self, path):
+    try:
+      diskPath = self._file_manager.path_on_disk(FileDestinations.LOCAL, path)
+      index = self.gcodeIndex.get(diskPath)
+      if index is None:
+        index = self.gcodeIndex.build(diskPath)
+        self._log("_build_index {}: {} tool changes, tools {}", path, index["toolChanges"],
+                  index["tools"], debug=True)
+      if path == self.jobPath:
+        self._follow_job_index(path, index)
+    except Exception as e:
+      self._log("Failed to index {}: {}".format(path, e))
+    finally:
+      with self._indexLock:
+        self._indexing.discard(path)
+
+  def _remove_index(self, path):
+    self.gcodeIndex.remove(self._file_manager.path_on_disk(FileDestinations.LOCAL, path))
+
+  # ======== Tool Change Estimate ========
+  # toolChangeEstimate and toolChangeTimeLeft are only changed on the dispatcher thread, the other
+  # threads submit their part.
+
+  # Runs on the indexer thread
+  def _follow_job_index(self, path, index):
+    # The index has the tools as written in the file, map them to slots like the queuing hook does
+    remap = self.toolRemap
+    toolMap = remap.toolMap if remap.mode == ToolRemap.FILAMENT_MAP else None
+    tools = index_tools(index, toolMap)
+    self._log("_follow_job_index {} tool commands", len(tools), debug=True)
+    self.dispatcher.submit(self._set_job_tools, path, tools)
+
+  def _set_job_tools(self, path, tools):
+    # The job may have ended while the file was indexed
+    if path != self.jobPath:
+      return
+    self.toolChangeEstimate.set_tools(tools, self.toolChangeEstimate.cursor, self._loaded_slot())
+    self._update_tool_change_estimate()
+
+  def _estimate_tool_sent(self):
+    self.toolChangeEstimate.tool_sent()
+    if self.toolChangeEstimate.tools is not None:
+      self._update_tool_change_estimate()
+
+  def _reset_tool_change_estimate(self):
+    self.toolChangeEstimate.reset()
+    self.toolChangeTimeLeft = None
+
+  # Called from _apply_line_changes when the MMU has loaded a tool and is idle. Only LOADED counts,
+  # OK also shows up between the unload and the load of a tool change.
+  def _on_mmu_loaded(self, mmu):
+    if self.toolChangeStart is None:
+      return
+    self.hookStats.record("tool_change", perf_counter_ns() - self.toolChangeStart)
+    self.toolChangeStart = None
+    # The change that just finished has been timed (see PhaseTimes)
+    if self.toolChangeEstimate.tools is not None:
+      self.dispatcher.submit_latest(self._update_tool_change_estimate)
+
+  # The loaded slot as a number, None if there isn't one
+  def _loaded_slot(self):
+    tool = self.mmu.tool
+    if isinstance(tool, int):
+      return tool
+    try:
+      return int(tool, 16)
+    except (TypeError, ValueError):
+      return None
+
+  # Runs on the dispatcher thread, sums up the phase times of the changes left
+  def _update_tool_change_estimate(self):
+    seconds = self.toolChangeEstimate.seconds_left(self.phaseTimes)
+    if seconds == self.toolChangeTimeLeft:
+      return
+    self.toolChangeTimeLeft = seconds
+    self._update_navbar()
+
+  def _estimate_payload(self):
+    return dict(
+      toolChangeTimeLeft=self.toolChangeTimeLeft,
+      toolChangesLeft=(
+        self.toolChangeEstimate.changesLeft if self.toolChangeEstimate.tools is not None else None
+      ),
+    )
+
   # ======== Nav Updater ========
 
+  @timed("_update_navbar")
   def _update_navbar(self):
-    self._log("update_navbar:", obj=self.mmu, debug=True)
-    self._plugin_manager.send_plugin_message(
-      self._identifier,
-      dict(
-        action="nav",
-        tool=self.mmu[MmuKeys.TOOL],
-        previousTool=self.mmu[MmuKeys.PREV_TOOL],
-        state=self.mmu[MmuKeys.STATE],
-        response=self.mmu[MmuKeys.RESPONSE],
-        responseData=self.mmu[MmuKeys.RESPONSE_DATA],
-        prusaVersion=self.mmu[MmuKeys.PRUSA_VERSION],
+    with self._navLock:
+      mmu = self.mmu
+      self.navSeq += 1
+      seq = self.navSeq
+      # Progress codes can change many times a second, those get coalesced. Errors go out right
+      # away.
+      self.navCoalescer.push(
+        dict(
+          action="nav",
+          seq=seq,
+          tool=mmu.tool,
+          previousTool=mmu.previousTool,
+          state=mmu.state,
+          response=mmu.response,
+          responseData=mmu.responseData,
+          prusaVersion=mmu.prusaVersion,
+          **self._estimate_payload()
+        ),
+        immediate=mmu.response == MMU3ResponseCodes.ERROR,
       )
-    )
+    self._log("update_navbar {}:", seq, obj=mmu, debug=True)
+
+  def _send_navbar(self, message):
+    self._plugin_manager.send_plugin_message(self._identifier, message)
 
   # ======== Printer Firmware Hooks ========
   # https://docs.octoprint.org/en/master/plugins/hooks.html#firmware_info_hook
 
   def firmware_info_hook(self, comm_instance, firmware_name, firmware_data, *args, **kwargs):
-   self._process_firmware(firmware_data["MACHINE_TYPE"])
-
-  def _process_firmware(self, machine_type, force=False):
-    # Prevent detection and overwrite if it was already set (like from settings)
-    version = self.mmu[MmuKeys.PRUSA_VERSION]
-    if version == "" or version is None or force:
+   self._process_firmware(firmware_data["MACHINE_TYPE"], comm=comm_instance)
+
+  def _process_firmware(self, machine_type, force=False, comm=None):
+    # Prevent detection and overwrite if it was already set (like from settings), a profile that
+    # was only assumed from the cache is detected again
+    version = self.mmu.prusaVersion
+    assumed = self.assumedProfile
+    self.assumedProfile = None
+    if version == "" or version is None or force or assumed is not None:
       # If we tried to set it back to auto detect then we need to ask the printer again.
       if machine_type == "" and force:
         self._printer.commands("M115")
-        self.mmu[MmuKeys.PRUSA_VERSION] = None
+        # Lines are held until it answers, or the cached profile is used (see _gcode_received)
+        self.mmu = self.mmu._replace(prusaVersion=None)
         return
 
       # Figure out what Prusa version we are dealing with (defaults to MK3)
       version = detect_connection_profile(machine_type)
-      self._log("_process_firmware: {}".format(version), obj=machine_type, debug=True)
+      self._log("_process_firmware: {}", version, obj=machine_type, debug=True)
+      if not force:
+        self._remember_profile(comm, version)
+      # Confirmed, the MMU may well have moved on since the profile was set so leave it be
+      if version == assumed:
+        return
 
+    self._set_profile(version)
+
+  def _set_profile(self, version):
     # MK4: The MMU doesn't tell us it's ok so if the printer has one assume it is.
     if version != PrusaProfile.MK3:
       self._fire_event(PluginEventKeys.MMU_CHANGE, dict(state=MmuStates.OK, prusaVersion=version))
@@ -245,395 +637,354 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
     # MK3: Just send the version so it's there. This probably already happened but let's go.
     self._fire_event(PluginEventKeys.MMU_CHANGE, dict(prusaVersion=version))
 
+  # The ProfileCache key of the printer on the other end of comm, worked out once per connection.
+  # If that fails the connection goes without the cache rather than trying again on every line.
+  def _connection_key(self, comm):
+    if self.connectionKey is None and comm is not None and not self.connectionKeyFailed:
+      try:
+        printerProfile = self._printer_profile_manager.get_current_or_default()["id"]
+        self.connectionKey = ProfileCache.key(comm.getConnection()[0], printerProfile)
+      except Exception as e:
+        self.connectionKeyFailed = True
+        self._log("_connection_key failed: {}", e, debug=True)
+    return self.connectionKey
+
+  def _remember_profile(self, comm, version):
+    if self.profileCache.set(self._connection_key(comm), version):
+      self.dispatcher.submit_latest(self._save_profiles)
+
+  def _save_profiles(self):
+    try:
+      self.profileCache.save()
+    except Exception as e:
+      self._log("Failed to save profiles {}".format(e))
+
+  # Starts parsing with the profile this connection had last time, detection still runs and
+  # corrects it (see _process_firmware). False if there isn't one.
+  def _assume_profile(self, comm):
+    version = self.profileCache.get(self._connection_key(comm))
+    if version is None:
+      return False
+    self._log("_assume_profile: {}", version, debug=True)
+    self.assumedProfile = version
+    self._set_profile(version)
+    return True
+
   # ======== Gcode Hooks ========
   # https://docs.octoprint.org/en/master/plugins/hooks.html#octoprint-comm-protocol-gcode-phase
 
+  # The hooks hand off to timed methods that only take what they use, see HookStats.timed
   def gcode_queuing_hook(self, comm, phase, cmd, cmd_type, gcode,
                          subcode=None, tags=None, *args, **kwarg):
+    return self._gcode_queuing(cmd, tags)
+
+  @timed("gcode_queuing_hook")
+  def _gcode_queuing(self, cmd, tags):
+    # Only T and M1xx commands matter here, everything else (mostly G1) leaves on the first char.
+    first = cmd[:1]
+    if first != "T" and (first != "M" or not cmd.startswith("M1")):
+      return # passthrough
+
     # This line right here is how we handle not prompting the user again if they timeout
-    if TIMEOUT_TAG in tags:
+    if tags and TIMEOUT_TAG in tags:
       return # passthrough
-    
-    # handle mk4 remap if it was re-mapped (This is for single filament prints)
-    if self.filamentOverride is not None and search(TOOL_REGEX, cmd):
-      self._log(
-        "gcode_queuing_hook_T# MK4 command: {} -> T{}".format(cmd, self.filamentOverride),
-        debug=True
-      )
-      return [("T{}".format(self.filamentOverride),),]
 
-    # handle tool remap if enabled
-    if (
-       self.filamentOverride is None and self.config[SettingsKeys.USE_FILAMENT_MAP] and
-       search(TOOL_REGEX, cmd)
-    ):
-      try:
-        tool = int(search(TOOL_REGEX, cmd).group(1))
-        new_tool = int(self.config[SettingsKeys.FILAMENT_MAP][tool]["id"])
-        self._log("gcode_queuing_hook_T# command: {} -> T{}".format(cmd, new_tool), debug=True)
-        return [("T{}".format(new_tool),),]
-      except Exception as e:
-        self._log("gcode_queuing_hook_T# ERROR command: {}, {}".format(cmd, str(e)), debug=True)
-        return # passthrough
+    # handle mk4 remap or tool remap if either is enabled (see _rebuild_tool_remap)
+    remap = self.toolRemap
+    if first == "T" and remap.mode != ToolRemap.PASSTHROUGH:
+      tool = parse_tool(cmd)
+      if tool is not None:
+        return self._remap_tool(cmd, tool, remap)
 
     # ========
     # MK4 Blocker
     # This blocks non-MK3s from proceeding. For MK4 support see above.
     # ========
     if (
-      self.mmu[MmuKeys.PRUSA_VERSION] != PrusaProfile.MK3 and
-      self.mmu[MmuKeys.PRUSA_VERSION] is not None
+      self.mmu.prusaVersion != PrusaProfile.MK3 and
+      self.mmu.prusaVersion is not None
     ):
       return # passthrough
 
-    if cmd.startswith("M1600"):
-      return # passthrough
-
-    # only react to tool change commands and ignore everything if they dont want the dialog
-    if not cmd.startswith("Tx") and not cmd.startswith("M109 S"):
-      return # passthrough
-
     if cmd.startswith("M109 S"):
-      self._log("gcode_queuing_hook_M109 command: {}".format(cmd), debug=True)
+      self._log("gcode_queuing_hook_M109 command: {}", cmd, debug=True)
       if self.states[StateKeys.SELECTED_FILAMENT] is not None:
         tool_cmd = "T{}".format(self.states[StateKeys.SELECTED_FILAMENT])
         self._fire_event(PluginEventKeys.MMU_CHANGE,
                          dict(tool=self.states[StateKeys.SELECTED_FILAMENT]))
         self.states[StateKeys.SELECTED_FILAMENT] = None
-        self._log("gcode_queuing_hook_M109 tool: {}".format(tool_cmd), debug=True)
+        self._log("gcode_queuing_hook_M109 tool: {}", tool_cmd, debug=True)
         # Rewrite and append the tool commands.
         return [(cmd,), (tool_cmd,)]
       return # passthrough
 
     # Prompt for filament change
     if self.config[SettingsKeys.ENABLE_PROMPT] and cmd.startswith("Tx"):
-      self._log("gcode_queuing_hook {}".format(cmd), debug=True)
+      self._log("gcode_queuing_hook {}", cmd, debug=True)
       if self._printer.set_job_on_hold(True):
         self._fire_event(PluginEventKeys.SHOW_PROMPT)
       return None, # suppress
 
     return # passthrough
 
-  def mk4_gcode_received(self, line):
-    # The MK4 is less verbose. To try and fill that gap we're faking the response and responseData
-    # to try and match the information we'd expect to get. Some day I hope prusa gives us back
-    # the data we had before.
-
-    # Dedupe
-    if "MMU2:" in line:
-      if self.mmu[MmuKeys.LAST_LINE] == line:
-        return
-      self.mmu[MmuKeys.LAST_LINE] = line
-
-    # Paused
-    if MMU3MK4Commands.PAUSED_USER in line:
-      self.lastMmuAction = MmuStates.PAUSED_USER
-      # The printer will spam pause messages, so ignore them if we're already paused
-      if self.mmu[MmuKeys.STATE] == MmuStates.PAUSED_USER:
-        return
-      # The printer will send pause messages directly after an attention, and attention is more
-      # important, so ignore them
-      elif self.mmu[MmuKeys.STATE] == MmuStates.ATTENTION:
-        return
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.PAUSED_USER, response=MMU3ResponseCodes.ERROR,
-                            responseData="c"))
-      return
-
-    # Errors
-    if MMU3MK4Commands.ERROR in line:
-      # TODO: This is a more generic error. we might be able to get something out of the bytes sent.
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.ATTENTION, response=MMU3ResponseCodes.ERROR,
-                            responseData="c"))
-      return
-    if MMU3MK4Commands.ERROR_FILAMENT in line:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.ATTENTION, response=MMU3ResponseCodes.ERROR,
-                            responseData="f"))
-      return
-    if MMU3MK4Commands.ERROR_INTERNAL in line:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.ATTENTION, response=MMU3ResponseCodes.ERROR,
-                            responseData="d"))
-      return
-    if MMU3MK4Commands.ERROR_TMC in line:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.ATTENTION, response=MMU3ResponseCodes.ERROR,
-                            responseData="e"))
-      return
-
-    # Loading
-    if MMU3MK4Commands.LOADING_FINDA in line:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.LOADING, tool=self.mmu[MmuKeys.TOOL],
-                            response=MMU3ResponseCodes.PROCESSING, responseData="5"))
-      self.lastMmuAction = MmuStates.LOADING
-      return
-    if MMU3MK4Commands.LOADING_EXTRUDER in line:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.LOADING, tool=self.mmu[MmuKeys.TOOL],
-                            response=MMU3ResponseCodes.PROCESSING, responseData="6"))
-      self.lastMmuAction = MmuStates.LOADING
-      return
-    if MMU3MK4Commands.LOADING_FSENSOR in line:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.LOADING, tool=self.mmu[MmuKeys.TOOL],
-                            response=MMU3ResponseCodes.PROCESSING, responseData="7"))
-      self.lastMmuAction = MmuStates.LOADING
-      return
-
-    # Loaded, clear previous tool
-    if  MMU3MK4Commands.ACTION_DONE in line and self.lastMmuAction == MmuStates.LOADING:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.LOADED, previousTool="", tool=self.mmu[MmuKeys.TOOL],
-                            response=MMU3ResponseCodes.FINISHED, responseData="2"))
-      self.lastMmuAction = MmuStates.LOADED
-      return
-
-    # Unloading (changing tool)
-    if MMU3MK4Commands.UNLOADING in line:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.UNLOADING, response=MMU3ResponseCodes.PROCESSING,
-                            responseData="3"))
-      self.lastMmuAction = MmuStates.UNLOADING
-      return
-
-    # Unloading Final (print done)
-    if MMU3MK4Commands.UNLOADING_FINAL in line:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.UNLOADING, response=MMU3ResponseCodes.PROCESSING,
-                            responseData="3"))
-      self.lastMmuAction = MmuStates.UNLOADING_FINAL
-      return
-
-    # Unloaded Final
-    if MMU3MK4Commands.ACTION_DONE in line and self.lastMmuAction == MmuStates.UNLOADING_FINAL:
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.OK, response=MMU3ResponseCodes.FINISHED,
-                            responseData="2"))
-      self.lastMmuAction = MmuStates.OK
-      return
-
-    # Starting
-    if search(MMU3MK4Commands.START_MATCH, line):
-      # We fire them back to back because we no longer get a ready message from the MMU
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.STARTING, response=MMU3ResponseCodes.FINISHED,
-                            responseData="0"))
-      self._fire_event(PluginEventKeys.MMU_CHANGE,
-                       dict(state=MmuStates.OK, response=MMU3ResponseCodes.FINISHED,
-                            responseData="0"))
-      self.lastMmuAction == MmuStates.OK
-      return
-
-    return
-
-  def mk3_gcode_received(self, line):
-    # MMU2 3.0.0
-    # https://github.com/prusa3d/Prusa-Firmware/blob/d84e3a9cf31963b9378b9cf39cd3dd4c948a05d6/Firmware/mmu2_progress_converter.cpp#L8
-    # https://github.com/prusa3d/Prusa-Firmware/blob/d84e3a9cf31963b9378b9cf39cd3dd4c948a05d6/Firmware/mmu2_protocol_logic.cpp
-    # General REGEX to catch all important MMU commands
-    if search(MMU3Codes.GENERAL_MATCH, line):
-      # If this line is the same as the previously seen one, ignore it and return immediately,
-      # otherwise it's new, so continue
-      if self.mmu[MmuKeys.LAST_LINE] == line:
-        return
-      self.mmu[MmuKeys.LAST_LINE] = line
-      # Search the line. This creates 4 matched groups. 
-      # Group 1 is a single letter request code. Group 2 is the request data in hexidecimal
-      # Group 3 is a single letter response code. Group 4 is the response data in hexidecimal.
-      # Warning, it may not exist!
-      matchedCommand = search(MMU3Codes.GROUP_MATCH, line)
-      # self._log("Matched Line Info: Line: " + line + " Groups: " + matchedCommand.group(1) + "," +
-      #           matchedCommand.group(2) + "," + matchedCommand.group(3) + "," +
-      #           matchedCommand.group(4), debug=True)
-
-      # If we're already at attention, and the new MMU response has an error, stay at attention and
-      # add the error code, then stop checking. Otherwise the new MMU response shows that the
-      # ATTENTION has cleared, so continue and get the new state.
-      if (
-        self.mmu[MmuKeys.STATE] == MmuStates.ATTENTION and
-        matchedCommand.group(3) == MMU3ResponseCodes.ERROR
-      ):
-        self._fire_event(PluginEventKeys.MMU_CHANGE,
-                         dict(state=MmuStates.ATTENTION, response=matchedCommand.group(3),
-                              responseData=matchedCommand.group(4)))
-        return
-
-      # Load filament to nozzle
-      if matchedCommand.group(1) == MMU3RequestCodes.TOOL:
-        # Loading Finished, Printer is now loaded. Clear previous tool
-        if matchedCommand.group(3) == MMU3ResponseCodes.FINISHED:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.LOADED, previousTool="",
-                                response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        # Still Loading
-        else:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.LOADING, tool=matchedCommand.group(2),
-                                response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        return
-      # Preload filament to mmu
-      elif matchedCommand.group(1) == MMU3RequestCodes.LOAD:
-        # Preload Finished, Printer is now idle
-        if matchedCommand.group(3) == MMU3ResponseCodes.FINISHED:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.OK, response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        # Preload in progress
-        else:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.LOADING_MMU, tool=matchedCommand.group(2),
-                                response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        return
-      # Unload Filament from Nozzle NOTE: Doesn't give us any tool info, so rely on T# commands to
-      # give us current and previous tool info
-      elif matchedCommand.group(1) == MMU3RequestCodes.UNLOAD:
-        # Unload Finished, Printer is now idle
-        if matchedCommand.group(3) == MMU3ResponseCodes.FINISHED:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.OK, response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        # Unload in progress
-        else:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.UNLOADING, response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        return
-      # Printer Reset, Shows up after power on
-      elif matchedCommand.group(1) == MMU3RequestCodes.RESET:
-        self._fire_event(PluginEventKeys.MMU_CHANGE,
-                         dict(state=MmuStates.OK, response=matchedCommand.group(3),
-                              responseData=matchedCommand.group(4)))
-        return
-      # Cut Filament
-      elif matchedCommand.group(1) == MMU3RequestCodes.CUT:
-        # Cutting finished, Printer is now idle
-        if matchedCommand.group(3) == MMU3ResponseCodes.FINISHED:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.OK, response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        # Cutting in progress
-        else:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.CUTTING, tool=matchedCommand.group(2),
-                                response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        return
-      # Eject Filament
-      elif matchedCommand.group(1) == MMU3RequestCodes.EJECT:
-        # Ejecting finished, Printer is now idle
-        if matchedCommand.group(3) == MMU3ResponseCodes.FINISHED:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.OK, response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        # Ejecting in progress
-        else:
-          self._fire_event(PluginEventKeys.MMU_CHANGE,
-                           dict(state=MmuStates.EJECTING, tool=matchedCommand.group(2),
-                                response=matchedCommand.group(3),
-                                responseData=matchedCommand.group(4)))
-        return
+  def _remap_tool(self, cmd, tool, remap):
+    # handle mk4 remap if it was re-mapped (This is for single filament prints)
+    if remap.mode == ToolRemap.OVERRIDE:
+      self._log("gcode_queuing_hook_T# MK4 command: {} -> {}", cmd, remap.commands[0][0],
+                debug=True)
+      return remap.commands
 
-    # Catch other MMU3 lines not caught by regex
-    # ATTENTION. Some errors spam one of these lines, so deduplicate them here. It's possible some
-    # error may not print one of these lines, but I haven't found one
-    elif (
-      (MMU3Codes.SAVING_PARKING in line or MMU3Codes.COOLDOWN_PENDING in line) and
-      self.mmu[MmuKeys.STATE] != MmuStates.ATTENTION
+    # handle tool remap
+    commands = remap.commands.get(int(tool))
+    if commands is None:
+      self._log("gcode_queuing_hook_T# ERROR command: {}, not in filament map", cmd,
+                debug=True)
+      return # passthrough
+    self._log("gcode_queuing_hook_T# command: {} -> {}", cmd, commands[0][0], debug=True)
+    return commands
+
+  def _rebuild_tool_remap(self):
+    # Decide once how T# commands are rewritten instead of on every queued line. This needs to be
+    # called whenever the filament override, the filament map settings or fileToolMapped change.
+    # Everything is built in locals, the comm thread only ever sees the finished ToolRemapState.
+    toolMap = {}
+    if self.config[SettingsKeys.USE_FILAMENT_MAP]:
+      for tool, mapped in enumerate(self.config[SettingsKeys.FILAMENT_MAP] or []):
+        try:
+          toolMap[tool] = int(mapped["id"])
+        except Exception as e:
+          self._log("_rebuild_tool_remap ERROR tool: {}, {}", tool, e, debug=True)
+
+    filamentOverride = self.filamentOverride
+    if filamentOverride is not None:
+      mode = ToolRemap.OVERRIDE
+      commands = [("T{}".format(filamentOverride),),]
+    # Files mapped at upload are already mapped, mapping them again would be wrong
+    elif not self.config[SettingsKeys.USE_FILAMENT_MAP] or self.fileToolMapped:
+      mode = ToolRemap.PASSTHROUGH
+      commands = None
+    else:
+      mode = ToolRemap.FILAMENT_MAP
+      commands = {tool: [("T{}".format(mapped),),] for tool, mapped in toolMap.items()}
+
+    self.toolRemap = ToolRemapState.build(mode, commands, toolMap)
+
+  # ======== File Preprocessor Hook ========
+  # https://docs.octoprint.org/en/master/plugins/hooks.html#octoprint-filemanager-preprocessor
+
+  # With rewriteFilamentMap on the filament map is written into gcode as it's uploaded so the
+  # queuing hook has nothing to do during the print (see fileToolMapped).
+  def gcode_preprocessor_hook(self, path, file_object, links=None, printer_profile=None,
+                              allow_overwrite=False, *args, **kwargs):
+    toolMap = self.toolRemap.toolMap
+    if (
+      not self.config[SettingsKeys.REWRITE_FILAMENT_MAP] or
+      not self.config[SettingsKeys.USE_FILAMENT_MAP] or
+      not toolMap or
+      not valid_file_type(path, type="gcode")
     ):
-      self._fire_event(PluginEventKeys.MMU_CHANGE, dict(state=MmuStates.ATTENTION))
-    # PAUSED_USER is caught in the MMU2 section early on in this function, but we need to recover
-    # from it if the MMU's response is the same as LAST_LINE
-    elif self.mmu[MmuKeys.STATE] == MmuStates.PAUSED_USER and MMU3Codes.LCD_CHANGED in line:
-      # If detected, blank out LAST_LINE. The next mmu response in the log will trigger again and
-      # change the state away from PAUSED_USER
-      self.mmu[MmuKeys.LAST_LINE] = ""
+      return # unchanged
 
-    return
+    toolMap = dict(toolMap)
+    self._log("gcode_preprocessor_hook {}", path, obj=toolMap, debug=True)
+    return StreamWrapper(
+      file_object.filename,
+      FilamentMapStream(file_object.stream(), toolMap),
+    )
+
+  # Checks at print start whether the file has the filament map in it already
+  def _detect_file_tool_map(self, payload):
+    fileToolMapped = False
+    if self._is_local_gcode(payload):
+      try:
+        path = self._file_manager.path_on_disk(FileDestinations.LOCAL, payload["path"])
+        with open(path, "rb") as f:
+          fileToolMapped = has_filament_map_header(f.readline())
+      except Exception as e:
+        self._log("_detect_file_tool_map {} failed: {}".format(payload["path"], e))
+    if fileToolMapped != self.fileToolMapped:
+      self._log("_detect_file_tool_map {}", fileToolMapped, debug=True)
+      self.fileToolMapped = fileToolMapped
+      self._rebuild_tool_remap()
 
   # Listen for MMU events and update the nav to reflect it
   def gcode_received_hook(self, comm, line, *args, **kwargs):
-    # Another Firmware check in case the actual one fails.
-    if self.mmu[MmuKeys.PRUSA_VERSION] is None and line.startswith("FIRMWARE_NAME"):
-      self._log("gcode_received_hook FIRMWARE_NAME: {}".format(line), debug=True)
-      self._process_firmware(line)
-      return line
-
-    # Until we have a version there's no point in trying to parse
-    if self.mmu[MmuKeys.PRUSA_VERSION] is None:
-      return line
+    return self._gcode_received(line, comm)
 
-    # MK3.5/3.9/4
+  @timed("gcode_received_hook")
+  def _gcode_received(self, line, comm=None):
+    # Only around connecting, see _receive_before_profile
     if (
-      self.mmu[MmuKeys.PRUSA_VERSION] != PrusaProfile.MK3 and
-      self.mmu[MmuKeys.PRUSA_VERSION] is not None
-    ):
-      self.mk4_gcode_received(line)
+      self.mmu.prusaVersion is None or self.assumedProfile is not None or self.heldLines or
+      self.restoreRecord is not None
+    ) and not self._receive_before_profile(line, comm):
       return line
 
-    # MK3
-    self.mk3_gcode_received(line)
+    changes = self.parser.feed(self.mmu, line)
+    if changes:
+      self._apply_line_changes(changes)
     return line
 
+  # Handles a line while the printer profile isn't known or confirmed. True if the line should
+  # still be parsed.
+  def _receive_before_profile(self, line, comm):
+    if self.restoreRecord is not None:
+      self._restore_mmu()
+
+    if line.startswith("FIRMWARE_NAME"):
+      # Another Firmware check in case the actual one fails.
+      if self.mmu.prusaVersion is None:
+        self._log("gcode_received_hook FIRMWARE_NAME: {}", line, debug=True)
+        self._apply_line_changes(self.parser.feed(self.mmu, line))
+        self._remember_profile(comm, self.mmu.prusaVersion)
+        self._replay_held_lines()
+        return False
+      # A profile from the cache is confirmed (or corrected) by the printer
+      if self.assumedProfile is not None:
+        self._process_firmware(line, comm=comm)
+
+    # Until we have a version there's no point in trying to parse, keep the line for when we do
+    if self.mmu.prusaVersion is None and not self._assume_profile(comm):
+      if is_mmu_line(line):
+        self.heldLines.append(line)
+      return False
+
+    self._replay_held_lines()
+    return True
+
+  # Parses the lines held while the profile wasn't known, in the order they came in
+  def _replay_held_lines(self):
+    if not self.heldLines or self.mmu.prusaVersion is None:
+      return
+    lines = list(self.heldLines)
+    self.heldLines.clear()
+    self._log("_replay_held_lines {}", len(lines), debug=True)
+    changes, _ = self.parser.feed_many(self.mmu, lines)
+    self._apply_line_changes(changes)
+
+  # The parser works out what changed (see MmuProtocolParser), this fires it and follows up
+  def _apply_line_changes(self, changes):
+    for change in changes:
+      mmu = self._fire_event(PluginEventKeys.MMU_CHANGE, change.changes)
+      if change.request is None:
+        continue
+      if mmu.state == MmuStates.LOADED:
+        self._on_mmu_loaded(mmu)
+
   def gcode_sent_hook(self, comm, phase, cmd, cmd_type, gcode,
                       subcode=None, tags=None, *args, **kwarg):
-    # only react to tool change commands
-    if not search(TOOL_REGEX, cmd):
-      return
+    return self._gcode_sent(cmd)
 
+  @timed("gcode_sent_hook")
+  def _gcode_sent(self, cmd):
+    # only react to tool change commands
     # Catch when the gcode sends a tool number, this happens when it's set to print in multi
-    try:
-      x = search(TOOL_REGEX, cmd)
-      tool = x.group(1)
-
-      # If the tool does not match the current tool then we're about to get an unload message from
-      # the printer so set the previous tool's value before we replace tool.
-      if self.mmu[MmuKeys.TOOL] != tool:
-        self.mmu[MmuKeys.PREV_TOOL] = self.mmu[MmuKeys.TOOL]
-
-      # Store the tool value on the tool. We're about to get a loading call.
-      self.mmu[MmuKeys.TOOL] = tool
-      self._log("gcode_sent_hook Tool:{} Prev:{}".format(tool, self.mmu[MmuKeys.PREV_TOOL]),
-                debug=True)
-    except:
-      pass
+    tool = parse_tool(cmd)
+    if tool is None:
+      return
 
+    # Every T# counts, the estimate follows the job's tool commands in order
+    self.dispatcher.submit(self._estimate_tool_sent)
+
+    # If the tool does not match the current tool then we're about to get an unload message from
+    # the printer so set the previous tool's value before we replace tool.
+    # Store the tool value on the tool. We're about to get a loading call.
+    if self.mmu.tool != tool:
+      self.mmu = self.mmu._replace(tool=tool, previousTool=self.mmu.tool)
+      # Tool change latency is measured from here to the MMU reporting LOADED (see _on_mmu_loaded)
+      self.toolChangeStart = perf_counter_ns()
+    self._log("gcode_sent_hook Tool:{} Prev:{}", tool, self.mmu.previousTool,
+              debug=True)
     return
 
   # ======== EventHandlerPlugin ========
 
+  # Updates the MMU state right away (the parsers depend on it) but leaves firing the event to the
+  # dispatcher thread.
+  @timed("_fire_event")
   def _fire_event(self, key, payload=None):
     if key != PluginEventKeys.MMU_CHANGE:
-      self._event_bus.fire(key, payload=payload)
+      self.dispatcher.submit(self._event_bus.fire, key, payload)
+      return self.mmu
 
-    newPayload = self.mmu.copy()
-    if payload is not None:
-      newPayload.update(payload)
+    # payload is either the changes to apply or a whole new MmuState
+    if isinstance(payload, MmuState):
+      newMmu = payload
+    else:
+      newMmu = self.mmu.update(payload or {})
 
     # Dedupe events
-    if (
-      self.mmu[MmuKeys.STATE] == newPayload[MmuKeys.STATE] and
-      self.mmu[MmuKeys.TOOL] == newPayload[MmuKeys.TOOL] and
-      self.mmu[MmuKeys.PREV_TOOL] == newPayload[MmuKeys.PREV_TOOL] and
-      self.mmu[MmuKeys.RESPONSE] == newPayload[MmuKeys.RESPONSE] and
-      self.mmu[MmuKeys.RESPONSE_DATA] == newPayload[MmuKeys.RESPONSE_DATA] and
-      self.mmu[MmuKeys.PRUSA_VERSION] == newPayload[MmuKeys.PRUSA_VERSION]
-    ):
-      return newPayload
-    
-    self.mmu = newPayload
+    if newMmu is self.mmu or newMmu == self.mmu:
+      return newMmu
+
+    self.mmu = newMmu
+    self.phaseTimes.observe(newMmu)
 
     # Steps are taken in gcode_received_hook to reduce the spamminess of events. Proper
     # deduplication happens in on_event
-    # self._log("_fire_event {} with".format(key), obj=payload, debug=True)
-    self._event_bus.fire(key, payload=newPayload)
+    # self._log("_fire_event {} with", key, obj=payload, debug=True)
+    # Every state is fired and journaled, other plugins and the journal see each transition
+    self.dispatcher.submit(self._dispatch_mmu_change, key, newMmu, self.parser.lastLine)
+
+    if newMmu.response != MMU3ResponseCodes.ERROR:
+      self._lastErrorCode = None
+    elif newMmu.responseData != self._lastErrorCode:
+      self._lastErrorCode = newMmu.responseData
+      self.dispatcher.submit(self._record_error, newMmu)
+
+    return newMmu
 
-    return newPayload
+  def _dispatch_mmu_change(self, key, mmu, lastLine):
+    self._event_bus.fire(key, payload=dict(self._mmu_payload(mmu, lastLine)))
+    # Not found says nothing about the MMU (no printer), keep the last state that did
+    if self.stateJournal is not None and mmu.state != MmuStates.NOT_FOUND:
+      self.stateJournal.append(dict(mmu._asdict(), at=time()))
+
+  def _record_error(self, mmu):
+    try:
+      printerState = self._printer.get_state_id()
+    except Exception:
+      printerState = None
+    record = self.errorHistory.append(mmu.responseData, mmu.tool, mmu.state, printerState)
+    self._log("_record_error", obj=record, debug=True)
+    try:
+      self.errorHistory.save()
+    except Exception as e:
+      self._log("Failed to save error history {}".format(e))
+
+  # Reads the last MMU state from the journal for _restore_mmu, the first line the printer sends
+  # puts it back.
+  def _queue_restore(self):
+    if self.stateJournal is not None:
+      self.restoreRecord = self.stateJournal.last() or None
+
+  # Puts back the last MMU state from the journal so the navbar (and the loaded tool) are known
+  # before the MMU says anything. Only while the state is unknown, anything the MMU said wins. Runs
+  # on the comm thread like the parsing so the two can't both change the state at once.
+  def _restore_mmu(self):
+    record = self.restoreRecord
+    self.restoreRecord = None
+    if record is None or self.mmu.state != MmuStates.NOT_FOUND:
+      return
+    self._log("_restore_mmu", obj=record, debug=True)
+    # An error being restored was recorded before the restart
+    if record.get(MmuKeys.RESPONSE) == MMU3ResponseCodes.ERROR:
+      self._lastErrorCode = record.get(MmuKeys.RESPONSE_DATA)
+    self._fire_event(PluginEventKeys.MMU_CHANGE,
+                     {key: record[key] for key in RESTORED_MMU_KEYS if key in record})
+
+  def _mmu_payload(self, mmu=None, lastLine=None):
+    # The dict form of the MMU state for the event bus and websocket. It's built lazily, once per
+    # state, with the line that caused the state.
+    if mmu is None:
+      mmu = self.mmu
+    # Kept as one (state, dict) tuple since the dispatcher and API threads both read it. The dict is
+    # shared, anything that hands it to other plugins passes a copy.
+    cachedFor, payload = self._mmuPayload
+    if cachedFor is not mmu:
+      payload = mmu.to_dict(self.parser.lastLine if lastLine is None else lastLine)
+      self._mmuPayload = (mmu, payload)
+    return payload
 
   def register_custom_events(*args, **kwargs):
     return [
@@ -651,31 +1002,60 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
 
     # Fired any time we detect a command that would update something about the MMU
     if event == PluginEventKeys.MMU_CHANGE:
-      self._log("on_event {} with".format(event), obj=payload, debug=True)
-      self._fire_event(PluginEventKeys.MMU_CHANGED, self.mmu)
+      self._log("on_event {} with", event, obj=payload, debug=True)
+      self._fire_event(PluginEventKeys.MMU_CHANGED, dict(self._mmu_payload()))
       self._update_navbar()
       return
 
     # Fired to cause a refresh event on the UI
     if event == PluginEventKeys.REFRESH_NAV:
-      self._log("on_event {}".format(event), debug=True)
+      self._log("on_event {}", event, debug=True)
       self._update_navbar()
       return
 
     # Fired to prompt the user to select a filament
     if event == PluginEventKeys.SHOW_PROMPT:
-      self._log("on_event {}".format(event), debug=True)
+      self._log("on_event {}", event, debug=True)
       self._show_prompt()
       return
     
+    # Index gcode when it's uploaded (or analysed) so it's ready before it's printed
+    if event == Events.FILE_ADDED or event == Events.METADATA_ANALYSIS_FINISHED:
+      if self._is_local_gcode(payload):
+        self._queue_index(payload["path"])
+      return
+
+    if event == Events.FILE_REMOVED:
+      if self._is_local_gcode(payload):
+        self._queue_index_removal(payload["path"])
+      return
+
+    # OctoPrint also fires FILE_REMOVED and FILE_ADDED for a move, but not every version does
+    if event == Events.FILE_MOVED:
+      storage = payload.get("storage")
+      source = dict(storage=storage, path=payload.get("source_path"))
+      if self._is_local_gcode(source):
+        self._queue_index_removal(source["path"])
+      destination = dict(storage=storage, path=payload.get("destination_path"))
+      if self._is_local_gcode(destination):
+        self._queue_index(destination["path"])
+      return
+
     if event == Events.PRINT_STARTED:
-      self._log("on_event {}".format(event), debug=True)
+      self._log("on_event {}", event, debug=True)
+      self._detect_file_tool_map(payload)
+      self.dispatcher.submit(self._reset_tool_change_estimate)
+      self.toolChangeStart = None
+      self.jobPath = None
+      if self._is_local_gcode(payload):
+        self.jobPath = payload["path"]
+        self._queue_index(payload["path"])
       # If we start a print and version is empty then set it to MK3
-      if self.mmu[MmuKeys.PRUSA_VERSION] is None:
-        self.mmu[MmuKeys.PRUSA_VERSION] = PrusaProfile.MK3
+      if self.mmu.prusaVersion is None:
+        self.mmu = self.mmu._replace(prusaVersion=PrusaProfile.MK3)
 
       if (
-        self.mmu[MmuKeys.PRUSA_VERSION] != PrusaProfile.MK3 and
+        self.mmu.prusaVersion != PrusaProfile.MK3 and
         self.config[SettingsKeys.ENABLE_PROMPT]
       ):
         self._show_prompt()
@@ -683,27 +1063,50 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
           self._log("PAUSE FAILED?", debug=True)
         return
 
+    # The MMU was most likely left as it was, show its last state until it says otherwise
+    if event == Events.CONNECTED:
+      self._log("on_event {}", event, debug=True)
+      self._queue_restore()
+      return
+
     # Handle disconnected event to set the mmu to Not Found (no printer...)
     if event == Events.DISCONNECTED:
-      self._log("on_event {}".format(event), debug=True)
+      self._log("on_event {}", event, debug=True)
+      self.fileToolMapped = False
+      self.jobPath = None
+      self.dispatcher.submit(self._reset_tool_change_estimate)
       self._disable_mk4_remap()
-      self._fire_event(PluginEventKeys.MMU_CHANGE, DEFAULT_MMU_STATE.copy())
+      self.parser.reset()
+      self.connectionKey = None
+      self.connectionKeyFailed = False
+      self.assumedProfile = None
+      self.heldLines.clear()
+      self._fire_event(PluginEventKeys.MMU_CHANGE, DEFAULT_MMU_STATE)
       return
 
     # Handle terminal states when printer is no longer printing to reset the MMU
     if (
       event == Events.PRINT_DONE or
       event == Events.PRINT_CANCELLED or
-      (event == Events.PRINT_FAILED and self.mmu[MmuKeys.STATE] != MmuStates.ATTENTION)
+      (event == Events.PRINT_FAILED and self.mmu.state != MmuStates.ATTENTION)
     ):
-      self._log("on_event {}".format(event), debug=True)
-      newMmu = DEFAULT_MMU_STATE.copy()
-      newMmu[MmuKeys.STATE] = MmuStates.OK
-      newMmu[MmuKeys.PRUSA_VERSION] = self.mmu[MmuKeys.PRUSA_VERSION]
+      self._log("on_event {}", event, debug=True)
+      newMmu = DEFAULT_MMU_STATE._replace(state=MmuStates.OK, prusaVersion=self.mmu.prusaVersion)
+      self.parser.reset()
+      self.fileToolMapped = False
+      self.jobPath = None
+      self.dispatcher.submit(self._reset_tool_change_estimate)
       self._disable_mk4_remap()
       self._fire_event(PluginEventKeys.MMU_CHANGE, newMmu)
       return
 
+  def _is_local_gcode(self, payload):
+    if not payload or not payload.get("path"):
+      return False
+    # Events either have storage (file events) or origin (analysis, print)
+    storage = payload.get("storage", payload.get("origin"))
+    return storage == FileDestinations.LOCAL and valid_file_type(payload["path"], type="gcode")
+
   # ======== SettingsPlugin ========
 
   def get_settings_defaults(self):
@@ -718,7 +1121,7 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
       indexAtZero=False,
       classicColorPicker=False,
       filamentSource=PLUGIN_NAME,
-      filamentSources=FILAMENT_SOURCE_DEFAULT,
+      filamentSources=list(FILAMENT_SOURCE_DEFAULT),
       filament=[
         dict(name="", color="", enabled=True, id=1),
         dict(name="", color="", enabled=True, id=2),
@@ -729,11 +1132,20 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
       filamentCount=5,
       filamentMap=[dict(id=0), dict(id=1), dict(id=2), dict(id=3), dict(id=4)],
       useFilamentMap=False,
+      rewriteFilamentMap=False,
       enablePrompt=True,
       prusaVersion="",
+      navUpdateInterval=DEFAULT_NAV_UPDATE_INTERVAL,
     )
 
+  # filamentSources depends on the plugins installed, it's filled in here and never saved
+  def on_settings_load(self):
+    data = octoprint.plugin.SettingsPlugin.on_settings_load(self)
+    data[SettingsKeys.FILAMENT_SOURCES] = self.filamentSources
+    return data
+
   def on_settings_save(self, data):
+    data.pop(SettingsKeys.FILAMENT_SOURCES, None)
     # ensure timeout is correct
     try:
       if SettingsKeys.TIMEOUT not in data:
@@ -745,6 +1157,13 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
     except:
       data[SettingsKeys.TIMEOUT] = DEFAULT_TIMEOUT
 
+    # ensure the nav update interval is correct, 0 turns coalescing off
+    if SettingsKeys.NAV_UPDATE_INTERVAL in data:
+      try:
+        data[SettingsKeys.NAV_UPDATE_INTERVAL] = max(0, int(data[SettingsKeys.NAV_UPDATE_INTERVAL]))
+      except:
+        data[SettingsKeys.NAV_UPDATE_INTERVAL] = DEFAULT_NAV_UPDATE_INTERVAL
+
     if SettingsKeys.FILAMENT_COUNT not in data:
       data[SettingsKeys.FILAMENT_COUNT] = self._settings.get_int([SettingsKeys.FILAMENT_COUNT])
     data[SettingsKeys.FILAMENT_COUNT] = int(data[SettingsKeys.FILAMENT_COUNT])
@@ -767,11 +1186,12 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
       data[SettingsKeys.FILAMENT] = data[SettingsKeys.FILAMENT][:data[SettingsKeys.FILAMENT_COUNT]]
       data[SettingsKeys.FILAMENT_MAP] = data[SettingsKeys.FILAMENT_MAP][:data[SettingsKeys.FILAMENT_COUNT]]
 
-    self._log("on_settings_save", data, debug=True)
+    self._log("on_settings_save", obj=dict(data), debug=True)
 
     # save settings
     octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
     self._refresh_config()
+    self._filament_changed()
 
   def _refresh_config(self):
     self.config[SettingsKeys.DEBUG] = self._settings.get_boolean([SettingsKeys.DEBUG])
@@ -789,13 +1209,19 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
     self.config[SettingsKeys.DISPLAY_ACTIVE_FILAMENT] = self._settings.get_boolean([
       SettingsKeys.DISPLAY_ACTIVE_FILAMENT])
     self.config[SettingsKeys.FILAMENT_SOURCE] = self._settings.get([SettingsKeys.FILAMENT_SOURCE])
-    self.config[SettingsKeys.FILAMENT_SOURCES] = self._settings.get([SettingsKeys.FILAMENT_SOURCES])
+    self.config[SettingsKeys.FILAMENT_SOURCES] = self.filamentSources
     self.config[SettingsKeys.USE_FILAMENT_MAP] = self._settings.get_boolean([
       SettingsKeys.USE_FILAMENT_MAP])
     self.config[SettingsKeys.FILAMENT_MAP] = self._settings.get([SettingsKeys.FILAMENT_MAP])
+    self.config[SettingsKeys.REWRITE_FILAMENT_MAP] = self._settings.get_boolean([
+      SettingsKeys.REWRITE_FILAMENT_MAP])
     self.config[SettingsKeys.ENABLE_PROMPT] = self._settings.get_boolean([
       SettingsKeys.ENABLE_PROMPT])
     self.config[SettingsKeys.FILAMENT_COUNT] = self._settings.get_int([SettingsKeys.FILAMENT_COUNT])
+    self._rebuild_tool_remap()
+    self.config[SettingsKeys.NAV_UPDATE_INTERVAL] = self._settings.get_int([
+      SettingsKeys.NAV_UPDATE_INTERVAL])
+    self.navCoalescer.interval = self.config[SettingsKeys.NAV_UPDATE_INTERVAL]
 
     # handle overwriting the prusa version but don't rewrite if it's blank.
     self.config[SettingsKeys.PRUSA_VERSION] = self._settings.get([SettingsKeys.PRUSA_VERSION])
@@ -826,27 +1252,26 @@ class PrusaMMUPlugin(octoprint.plugin.StartupPlugin,
 
   # ======== Misc ========
 
-  def _log(self, msg, obj=None, debug=False):
+  # Debug messages are a str.format template plus args, obj is appended as json. Nothing is
+  # formatted until the record is read (getdebug) so with debug off this is a dict lookup.
+  def _log(self, msg, *args, obj=None, debug=False):
     try:
       if not debug:
-        return self._logger.info(msg)
-      
-      if SettingsKeys.DEBUG not in self.config or not self.config[SettingsKeys.DEBUG]:
+        return self._logger.info(format_message(msg, args, obj))
+
+      if not self.config.get(SettingsKeys.DEBUG):
         return
-      
-      if obj is not None:
-        msg = "{} {}".format(msg, dumps(obj))
-      self._logger.debug(msg)
-      self._plugin_manager.send_plugin_message(
-        self._identifier,
-        dict(
-          action="debug",
-          msg=msg,
-        )
-      )
+
+      self.debugLog.append(msg, args, obj)
+      if self._logger.isEnabledFor(DEBUG):
+        # Already in debugLog, the logger copy can be lost if the dispatcher is full
+        self.dispatcher.try_submit(self._log_debug, msg, args, obj)
     except:
       pass
 
+  def _log_debug(self, msg, args, obj):
+    self._logger.debug(format_message(msg, args, obj))
+
 
 __plugin_name__ = "Prusa MMU"
 __plugin_pythoncompat__ = ">=3,<4"
@@ -856,6 +1281,7 @@ __plugin_hooks__ = {
   "octoprint.comm.protocol.gcode.received": __plugin_implementation__.gcode_received_hook,
   "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.gcode_sent_hook,
   "octoprint.comm.protocol.firmware.info": __plugin_implementation__.firmware_info_hook,
+  "octoprint.filemanager.preprocessor": __plugin_implementation__.gcode_preprocessor_hook,
   "octoprint.events.register_custom_events":  __plugin_implementation__.register_custom_events,
   "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
 }
@@ -0,0 +1,248 @@
+# coding=utf-8
+# Offline MMU timeline from an OctoPrint serial.log, no running OctoPrint needed.
+#
+# The log is read in chunks and only searched for a few plain strings (RECEIVED_MARKERS, SENT_TOOL)
+# which is far quicker than matching every line, only the lines found are turned into strings. Those
+# go through the plugin's own parser (SerialLogReplay), so the timeline is what the plugin would have
+# shown at the time. Memory use doesn't depend on the size of the log.
+#
+# Usage:
+#   python -m octoprint_prusammu.analyze serial.log
+#   python -m octoprint_prusammu.analyze serial.log --format csv --output timeline.csv
+#   python -m octoprint_prusammu.analyze serial.log --profile MK4
+from __future__ import absolute_import, print_function
+import argparse
+import csv
+import json
+import sys
+from datetime import datetime
+from re import compile, escape
+from time import perf_counter
+
+from octoprint_prusammu.common.Gcode import parse_tool
+from octoprint_prusammu.common.Mmu import MmuStates, MMU3ResponseCodes, DEFAULT_MMU_STATE
+from octoprint_prusammu.common.MmuProtocolParser import MmuProtocolParser
+from octoprint_prusammu.common.PrusaProfile import PrusaProfile
+
+CHUNK_SIZE = 8 << 20
+# Lines look like "2024-01-31 23:59:59,123 - Recv: MMU2:<T1 P5*aa" or "... - Send: N123 T1*45"
+STAMP_LENGTH = 23
+RECV = b" - Recv: "
+SEND = b" - Send: "
+# Received lines the MMU parsers care about (not the requests to the MMU, MMU2:>), and T# being sent
+RECEIVED_MARKERS = [compile(marker) for marker in (
+  rb"MMU2:[^>]", escape(b"FIRMWARE_NAME"), escape(b"LCD status changed"),
+)]
+SENT_TOOL = compile(rb" T\d")
+COLUMNS = ["time", "event", "state", "tool", "previousTool", "response", "responseData", "line"]
+
+
+# Follows the MMU through the log with the plugin's own parser (MmuProtocolParser), writing each
+# state change to the timeline instead of OctoPrint's event bus.
+class SerialLogReplay():
+  def __init__(self, emit, profile=None):
+    self.emit = emit
+    self._stamp = b""
+    self._logTime = None
+    self._day = (None, 0.0)
+    self.toolChanges = 0
+    # Count per error code, like the plugin's error history an error is counted once however many
+    # states it goes through (see _lastErrorCode)
+    self.errors = {}
+    self._lastErrorCode = None
+    self.mmu = DEFAULT_MMU_STATE
+    self.parser = MmuProtocolParser()
+    # Repeats are judged by the time in the log, not how fast it's read
+    self.parser.recentLines.clock = lambda: self.logSeconds
+    self.profile = profile
+    if profile:
+      self.mmu = self.mmu._replace(prusaVersion=profile)
+
+  # Only kept as bytes, most lines never need the time
+  def set_time(self, stamp):
+    self._stamp = stamp
+    self._logTime = None
+
+  @property
+  def logTime(self):
+    if self._logTime is None:
+      self._logTime = self._stamp.decode("ascii")
+    return self._logTime
+
+  @property
+  def logSeconds(self):
+    stamp = self.logTime
+    day, dayStart = self._day
+    if day != stamp[:10]:
+      day = stamp[:10]
+      dayStart = datetime.strptime(day, "%Y-%m-%d").timestamp()
+      self._day = (day, dayStart)
+    return (
+      dayStart + int(stamp[11:13]) * 3600 + int(stamp[14:16]) * 60 + int(stamp[17:19]) +
+      int(stamp[20:23]) / 1000.0
+    )
+
+  @property
+  def lastLine(self):
+    return self.parser.lastLine
+
+  def received(self, line):
+    if line.startswith("FIRMWARE_NAME"):
+      # A log can have several connections, each one detects the printer again
+      if not self.profile:
+        self.mmu = self.mmu._replace(prusaVersion=None)
+    elif self.mmu.prusaVersion is None:
+      # Log started after the connection, assume MK3 like a print start does
+      self.mmu = self.mmu._replace(prusaVersion=PrusaProfile.MK3)
+    for change in self.parser.feed(self.mmu, line):
+      # Same as the plugin, only changes that change something are events. The profile being
+      # detected says nothing about the MMU, it isn't written to the timeline.
+      previous = self.mmu
+      if change.mmu == previous:
+        continue
+      self.mmu = change.mmu
+      if change.mmu._replace(prusaVersion=previous.prusaVersion) != previous:
+        self._state_changed(change.mmu, line)
+
+  # Same as the plugin's gcode_sent_hook, the tool is known before the MMU starts on it
+  def sent(self, command):
+    tool = parse_tool(command)
+    if tool is None or tool == self.mmu.tool:
+      return
+    self.toolChanges += 1
+    self.emit(dict(time=self.logTime, event="tool", tool=tool, previousTool=self.mmu.tool,
+                   line=command))
+    self.mmu = self.mmu._replace(tool=tool, previousTool=self.mmu.tool)
+
+  def _state_changed(self, mmu, line):
+    event = "state"
+    if mmu.response != MMU3ResponseCodes.ERROR:
+      self._lastErrorCode = None
+      if mmu.response == MMU3ResponseCodes.PROCESSING:
+        event = "progress"
+    elif mmu.responseData != self._lastErrorCode:
+      self._lastErrorCode = mmu.responseData
+      event = "error"
+      self.errors[mmu.responseData] = self.errors.get(mmu.responseData, 0) + 1
+    self.emit(dict(time=self.logTime, event=event, state=mmu.state, tool=mmu.tool,
+                   previousTool=mmu.previousTool, response=mmu.response,
+                   responseData=mmu.responseData, line=line))
+
+
+# Feeds every MMU line of the log at path to replay. Returns (bytes, matched lines).
+def scan_log(path, replay, chunkSize=CHUNK_SIZE):
+  size = 0
+  matched = 0
+  carry = b""
+  with open(path, "rb") as f:
+    while True:
+      chunk = f.read(chunkSize)
+      buf = carry + chunk if carry else chunk
+      if chunk:
+        # Only search whole lines, the partial last line is carried over to the next chunk
+        end = buf.rfind(b"\n") + 1
+        if end == 0:
+          carry = buf
+          continue
+      else:
+        end = len(buf)
+
+      matched += _scan_lines(buf, end, replay)
+      size += end
+      carry = buf[end:]
+      if not chunk:
+        break
+  return size, matched
+
+
+def _scan_lines(buf, end, replay):
+  # Positions of every marker in file order, the line has to be received unless it's in sent
+  positions = []
+  for pattern in RECEIVED_MARKERS:
+    positions.extend([match.start() for match in pattern.finditer(buf, 0, end)])
+  sent = set(match.start() for match in SENT_TOOL.finditer(buf, 0, end))
+  positions.extend(sent)
+  positions.sort()
+
+  matched = 0
+  lastStart = -1
+  lastData = lastText = None
+  for position in positions:
+    kind = SEND if position in sent else RECV
+    start = buf.rfind(b"\n", 0, position) + 1
+    # More than one marker on a line
+    if start == lastStart:
+      continue
+    lastStart = start
+    dataStart = start + STAMP_LENGTH + len(kind)
+    if buf[start + STAMP_LENGTH:dataStart] != kind:
+      continue
+    lineEnd = buf.find(b"\n", position, end)
+    data = buf[dataStart:lineEnd if lineEnd != -1 else end].rstrip()
+
+    matched += 1
+    if kind is RECV:
+      # The MMU repeats its answer to every query, the parsers ignore the same line again so don't
+      # bother decoding it
+      if data == lastData and replay.lastLine == lastText:
+        continue
+      lastData = data
+      lastText = data.decode("utf-8", "replace")
+      replay.set_time(buf[start:start + STAMP_LENGTH])
+      replay.received(lastText)
+      continue
+    replay.set_time(buf[start:start + STAMP_LENGTH])
+    # Strip the line number and checksum, N123 T1*45
+    if data[:1] == b"N":
+      data = data[data.find(b" ") + 1:]
+    replay.sent(data.split(b"*", 1)[0].decode("ascii", "replace").strip())
+  return matched
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog="python -m octoprint_prusammu.analyze",
+    description="Timeline of MMU tool changes, progress and errors from an OctoPrint serial.log",
+  )
+  parser.add_argument("log", help="path to serial.log")
+  parser.add_argument("--format", choices=["json", "csv"], default="json",
+                      help="json writes one object per line")
+  parser.add_argument("--output", help="file to write the timeline to, default stdout")
+  parser.add_argument("--profile", choices=[
+                        PrusaProfile.MK3, PrusaProfile.MK3_5, PrusaProfile.MK3_9, PrusaProfile.MK4,
+                        PrusaProfile.COREONE,
+                      ],
+                      help="printer profile if the log doesn't have the firmware line")
+  args = parser.parse_args(argv)
+
+  out = open(args.output, "w", newline="") if args.output else sys.stdout
+  try:
+    if args.format == "csv":
+      writer = csv.DictWriter(out, fieldnames=COLUMNS, extrasaction="ignore")
+      writer.writeheader()
+      emit = writer.writerow
+    else:
+      emit = lambda record: out.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    replay = SerialLogReplay(emit, args.profile)
+    start = perf_counter()
+    size, matched = scan_log(args.log, replay)
+    seconds = perf_counter() - start
+  finally:
+    if args.output:
+      out.close()
+
+  print(json.dumps(dict(
+    bytes=size,
+    mmuLines=matched,
+    seconds=round(seconds, 2),
+    prusaVersion=replay.mmu.prusaVersion,
+    toolChanges=replay.toolChanges,
+    errors=replay.errors,
+    suppressedLines=replay.parser.recentLines.suppressed,
+    finalState=replay.mmu.state if replay.mmu.state != MmuStates.NOT_FOUND else None,
+  ), indent=2), file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
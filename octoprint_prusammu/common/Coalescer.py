@@ -0,0 +1,57 @@
+# coding=utf-8
+from __future__ import absolute_import
+from threading import Lock
+from time import monotonic
+
+
+# Sends the latest message straight away, then at most once per interval. Anything pushed inside
+# the interval replaces the pending message, which is flushed when the interval is up so the final
+# message is never lost. An interval of 0 sends everything immediately. The flush runs on scheduler
+# (see Scheduler).
+class Coalescer():
+  def __init__(self, send, scheduler, interval=0):
+    self.send = send
+    self.scheduler = scheduler
+    self.interval = interval
+    self.sent = 0
+    self.coalesced = 0
+    self._lock = Lock()
+    self._pending = None
+    self._nextSend = 0
+    self._timer = None
+
+  # immediate skips the window (and drops anything pending since message is newer)
+  def push(self, message, immediate=False):
+    with self._lock:
+      now = monotonic()
+      if immediate or self.interval <= 0 or now >= self._nextSend:
+        self._pending = None
+        self._send(message, now)
+        return
+
+      if self._pending is not None:
+        self.coalesced += 1
+      self._pending = message
+      if self._timer is None:
+        self._timer = self.scheduler.call_later(self._nextSend - now, self._flush)
+
+  def _flush(self):
+    with self._lock:
+      self._timer = None
+      if self._pending is None:
+        return
+      message = self._pending
+      self._pending = None
+      self._send(message, monotonic())
+
+  def _send(self, message, now):
+    self._nextSend = now + self.interval / 1000.0
+    self.sent += 1
+    self.send(message)
+
+  def cancel(self):
+    with self._lock:
+      self._pending = None
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
@@ -0,0 +1,61 @@
+# coding=utf-8
+from __future__ import absolute_import
+from json import dumps
+from threading import Lock
+from time import time
+
+DEFAULT_SIZE = 2000
+DEFAULT_LIMIT = 100
+
+
+# Fixed size ring of debug records. Records keep the message template, its args and an optional
+# object as-is and are only formatted when read (getdebug), so adding one is a tuple and a list
+# store. Anything passed in must not be changed afterwards, the plugin only passes immutable state
+# and strings.
+class DebugLog():
+  def __init__(self, size=DEFAULT_SIZE):
+    self.size = size
+    self._records = [None] * size
+    self._next = 0
+    self._lock = Lock()
+
+  def append(self, msg, args=(), obj=None):
+    with self._lock:
+      self._records[self._next % self.size] = (self._next, time(), msg, args, obj)
+      self._next += 1
+
+  # The oldest record still held
+  def first(self):
+    return max(0, self._next - self.size)
+
+  # Returns up to limit formatted records starting at seq since, and the seq to ask for next.
+  def read(self, since=0, limit=DEFAULT_LIMIT):
+    with self._lock:
+      end = self._next
+      start = min(max(since, end - self.size, 0), end)
+      stop = min(end, start + max(0, min(limit, self.size)))
+      records = [self._records[seq % self.size] for seq in range(start, stop)]
+    return [format_record(record) for record in records], stop
+
+  def clear(self):
+    with self._lock:
+      self._records = [None] * self.size
+      self._next = 0
+
+
+def format_record(record):
+  seq, at, msg, args, obj = record
+  return dict(seq=seq, time=at, msg=format_message(msg, args, obj))
+
+
+def format_message(msg, args=(), obj=None):
+  try:
+    if args:
+      msg = msg.format(*args)
+    if obj is not None:
+      if hasattr(obj, "_asdict"):
+        obj = obj._asdict()
+      msg = "{} {}".format(msg, dumps(obj, default=str))
+  except Exception as e:
+    msg = "{} (could not format: {})".format(msg, e)
+  return msg
@@ -0,0 +1,78 @@
+# coding=utf-8
+from __future__ import absolute_import
+import json
+import os
+from threading import Lock
+from time import time
+
+DEFAULT_SIZE = 500
+DEFAULT_LIMIT = 50
+
+
+# Recent MMU errors in a fixed size ring (like DebugLog) plus how many times each error code has been
+# seen, which isn't bounded by the ring. Saved to one json file after each error, errors are rare
+# enough that rewriting it is cheap.
+class ErrorHistory():
+  def __init__(self, path=None, size=DEFAULT_SIZE):
+    self.path = path
+    self.size = size
+    self.counts = {}
+    self._records = [None] * size
+    self._next = 0
+    self._lock = Lock()
+
+  # Returns the record added
+  def append(self, code, tool, state, printerState, at=None):
+    with self._lock:
+      record = dict(seq=self._next, time=time() if at is None else at, code=code, tool=tool,
+                    state=state, printerState=printerState)
+      self._records[self._next % self.size] = record
+      self._next += 1
+      self.counts[code] = self.counts.get(code, 0) + 1
+    return record
+
+  # The oldest record still held
+  def first(self):
+    return max(0, self._next - self.size)
+
+  # Returns up to limit records starting at seq since, and the seq to ask for next.
+  def read(self, since=0, limit=DEFAULT_LIMIT):
+    with self._lock:
+      end = self._next
+      start = min(max(since, end - self.size, 0), end)
+      stop = min(end, start + max(0, min(limit, self.size)))
+      records = [self._records[seq % self.size] for seq in range(start, stop)]
+    return [record for record in records if record is not None], stop
+
+  def to_dict(self):
+    with self._lock:
+      records = [self._records[seq % self.size] for seq in range(self.first(), self._next)]
+      return dict(next=self._next, counts=dict(self.counts),
+                  records=[record for record in records if record is not None])
+
+  def save(self):
+    if self.path is None:
+      return
+    data = json.dumps(self.to_dict(), separators=(",", ":"))
+    folder = os.path.dirname(self.path)
+    if folder and not os.path.isdir(folder):
+      os.makedirs(folder)
+    tmpFile = "{}.tmp".format(self.path)
+    with open(tmpFile, "w") as f:
+      f.write(data)
+    os.replace(tmpFile, self.path)
+
+  def load(self):
+    if self.path is None:
+      return
+    try:
+      with open(self.path) as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      return
+    with self._lock:
+      self.counts = dict(data.get("counts", {}))
+      self._next = int(data.get("next", 0))
+      self._records = [None] * self.size
+      for record in data.get("records", [])[-self.size:]:
+        self._records[record["seq"] % self.size] = record
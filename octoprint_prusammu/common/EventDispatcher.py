@@ -0,0 +1,143 @@
+# coding=utf-8
+from __future__ import absolute_import
+from collections import deque
+from threading import Condition, Thread, current_thread
+from time import monotonic
+
+DEFAULT_MAX_DEPTH = 1000
+
+
+# Runs work handed over by the serial hooks (event firing, logging, websocket messages) on a single
+# worker thread. The queue never holds more than maxDepth calls, what happens when it's full depends
+# on how the call was handed over:
+# - submit: always runs. The caller waits for room, so events and journal records are never lost.
+# - submit_latest: for calls where a newer one makes the older ones pointless (UI pushes, saving a
+#   file). The oldest queued call to the same function is dropped to make room, if there isn't one
+#   the caller waits like submit.
+# - try_submit: for calls that can be lost (debug output). Dropped, returns False.
+# Calls handed over from the worker itself run inline when the queue is full, it can't wait on
+# itself. Until start() is called everything runs inline on the calling thread.
+class EventDispatcher():
+  def __init__(self, logger=None, maxDepth=DEFAULT_MAX_DEPTH, name="prusammu-dispatcher"):
+    self.logger = logger
+    self.maxDepth = maxDepth
+    self.name = name
+    self.processed = 0
+    self.dropped = 0
+    self.waited = 0
+    self.highWater = 0
+    self._queue = deque()
+    self._full = False
+    self._waiting = 0
+    self._condition = Condition()
+    self._thread = None
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._thread = Thread(target=self._run, name=self.name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, fn, *args):
+    self._submit(fn, args, False)
+
+  def submit_latest(self, fn, *args):
+    self._submit(fn, args, True)
+
+  def try_submit(self, fn, *args):
+    if self._thread is None:
+      self._call(fn, args)
+      return True
+    with self._condition:
+      if len(self._queue) >= self.maxDepth:
+        self.dropped += 1
+        return False
+      self._append(fn, args)
+    return True
+
+  def _submit(self, fn, args, latest):
+    if self._thread is None:
+      self._call(fn, args)
+      return
+
+    inline = warn = False
+    with self._condition:
+      if len(self._queue) >= self.maxDepth:
+        if latest and self._drop_oldest(fn):
+          self.dropped += 1
+        elif current_thread() is self._thread:
+          inline = True
+        else:
+          self.waited += 1
+          # Only once each time it fills up, see _run
+          warn = not self._full
+          self._full = True
+          self._waiting += 1
+          while len(self._queue) >= self.maxDepth:
+            self._condition.wait()
+          self._waiting -= 1
+      if not inline:
+        self._append(fn, args)
+    if warn and self.logger is not None:
+      self.logger.warning("{} queue is full ({} items), waiting for it".format(
+        self.name, self.maxDepth))
+    if inline:
+      self._call(fn, args)
+
+  def _append(self, fn, args):
+    self._queue.append((monotonic(), fn, args))
+    if len(self._queue) > self.highWater:
+      self.highWater = len(self._queue)
+    self._condition.notify()
+
+  # Removes the oldest queued call to fn, True if there was one
+  def _drop_oldest(self, fn):
+    for index, item in enumerate(self._queue):
+      if item[1] == fn:
+        del self._queue[index]
+        return True
+    return False
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while not self._queue:
+          self._full = False
+          self._condition.wait()
+        _, fn, args = self._queue.popleft()
+        if self._waiting:
+          self._condition.notify_all()
+      self._call(fn, args)
+
+  def _call(self, fn, args):
+    try:
+      fn(*args)
+    except Exception:
+      if self.logger is not None:
+        self.logger.exception("Dispatching {} failed".format(getattr(fn, "__name__", fn)))
+    self.processed += 1
+
+  # ======== Backpressure ========
+
+  def depth(self):
+    return len(self._queue)
+
+  # Seconds the oldest queued item has been waiting, 0 when empty.
+  def oldest_age(self):
+    try:
+      return monotonic() - self._queue[0][0]
+    except IndexError:
+      return 0
+
+  def stats(self):
+    return dict(
+      running=self._thread is not None,
+      depth=self.depth(),
+      oldestAge=self.oldest_age(),
+      highWater=self.highWater,
+      maxDepth=self.maxDepth,
+      processed=self.processed,
+      dropped=self.dropped,
+      waited=self.waited,
+    )
@@ -0,0 +1,90 @@
+# coding=utf-8
+from __future__ import absolute_import
+from threading import Lock
+
+# Most slots a browser can report, a few more than any MMU has
+MAX_SLOTS = 32
+
+
+# One slot as the browsers show it, type is the material
+def filament_slot(index, name="", type="", color="", enabled=True):
+  return dict(id=index + 1, index=index, name=name or "", type=type or "", color=color or "",
+              enabled=bool(enabled))
+
+
+# The slots a browser sent ([{index, name, type, color}, ...]) in slot order, None if it isn't that
+def parse_slots(entries):
+  if not isinstance(entries, list):
+    return None
+  slots = {}
+  for entry in entries[:MAX_SLOTS]:
+    if not isinstance(entry, dict):
+      return None
+    try:
+      index = int(entry.get("index"))
+    except (TypeError, ValueError):
+      return None
+    if 0 <= index < MAX_SLOTS:
+      slots[index] = filament_slot(index, *(
+        str(entry.get(key) or "") for key in ("name", "type", "color")
+      ))
+  return [slots[index] for index in sorted(slots)]
+
+
+# The filament in each MMU slot, built once and handed to every browser (getfilament) instead of
+# each one working it out on every nav update. It comes from the plugin's own filament settings, or
+# from the spools a browser reported (setfilament) when the source is a spool plugin since only the
+# browser can see those. version goes up every time it's rebuilt so browsers can tell if they have it.
+class FilamentCatalogue():
+  def __init__(self, internalSource):
+    self.internalSource = internalSource
+    self.version = 0
+    self._spools = {}
+    self._payload = None
+    self._lock = Lock()
+
+  # Settings changed, it's rebuilt the next time it's asked for
+  def invalidate(self):
+    with self._lock:
+      self._payload = None
+
+  # Slots a browser read from a spool plugin, already made with filament_slot. True if they changed.
+  def set_spools(self, source, slots):
+    with self._lock:
+      if self._spools.get(source) == slots:
+        return False
+      self._spools[source] = slots
+      self._payload = None
+    return True
+
+  # source is the filamentSource setting, filament the plugin's own filament setting
+  def to_dict(self, source, filament, filamentCount):
+    with self._lock:
+      payload = self._payload
+      if payload is None or payload["source"] != source:
+        self.version += 1
+        payload = self._payload = dict(
+          version=self.version,
+          source=source,
+          filament=self._build(source, filament, filamentCount),
+        )
+      return payload
+
+  def _build(self, source, filament, filamentCount):
+    slots = None
+    if source != self.internalSource:
+      slots = self._spools.get(source)
+    # The spool plugin isn't there (or no browser has said what's in it), use our own
+    if slots is None:
+      slots = []
+      for entry in filament or []:
+        try:
+          index = int(entry.get("id")) - 1
+        except (TypeError, ValueError):
+          continue
+        if entry.get("enabled", True):
+          slots.append(filament_slot(index, entry.get("name"), "", entry.get("color")))
+    # Show something rather than nothing
+    if not slots:
+      slots = [filament_slot(index) for index in range(filamentCount)]
+    return slots
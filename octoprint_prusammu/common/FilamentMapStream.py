@@ -0,0 +1,35 @@
+# coding=utf-8
+from __future__ import absolute_import
+from octoprint.filemanager.util import LineProcessorStream
+
+from octoprint_prusammu.common.Gcode import filament_map_header, has_filament_map_header, \
+  remap_tool_line
+
+
+# Writes the filament map into gcode while it's uploaded (see the filemanager preprocessor hook).
+# The map used is put on the first line so the plugin knows at print start not to map it again. A
+# file that already has a map (downloaded and uploaded again) is left alone.
+class FilamentMapStream(LineProcessorStream):
+  def __init__(self, input_stream, toolMap):
+    LineProcessorStream.__init__(self, input_stream)
+    self.toolMap = toolMap
+    self.rewritten = 0
+    self._first = True
+    self._passthrough = False
+
+  def process_line(self, line):
+    if self._first:
+      self._first = False
+      if has_filament_map_header(line):
+        self._passthrough = True
+        return line
+      return filament_map_header(self.toolMap) + self._remap(line)
+    if self._passthrough:
+      return line
+    return self._remap(line)
+
+  def _remap(self, line):
+    newLine = remap_tool_line(line, self.toolMap)
+    if newLine is not line:
+      self.rewritten += 1
+    return newLine
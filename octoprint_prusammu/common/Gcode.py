@@ -0,0 +1,78 @@
+# coding=utf-8
+from __future__ import absolute_import
+from collections import namedtuple
+from types import MappingProxyType
+
+DIGITS = "0123456789"
+
+
+# How T# commands are handled in gcode_queuing_hook
+class ToolRemap():
+  PASSTHROUGH="PASSTHROUGH"
+  OVERRIDE="OVERRIDE" # MK4 single filament override
+  FILAMENT_MAP="FILAMENT_MAP"
+
+
+# Everything gcode_queuing_hook needs to rewrite T# commands, built whole and swapped in with one
+# assignment so the threads reading it never see part of an old one and part of a new one. mode is a
+# ToolRemap. commands is what a T# becomes: one command list (OVERRIDE) or {tool: command list}
+# (FILAMENT_MAP). toolMap is {tool: mapped tool} from the filament map setting, whatever the mode.
+class ToolRemapState(namedtuple("ToolRemapState", ["mode", "commands", "toolMap"])):
+  __slots__ = ()
+
+  @classmethod
+  def build(cls, mode, commands=None, toolMap=None):
+    if isinstance(commands, dict):
+      commands = MappingProxyType(commands)
+    return cls(mode, commands, MappingProxyType(dict(toolMap or {})))
+
+
+PASSTHROUGH_REMAP = ToolRemapState.build(ToolRemap.PASSTHROUGH)
+
+
+# Same as matching ^T(\d+) against the command but without the regex. Returns the tool digits as a
+# string or None when the command isn't a T# command.
+def parse_tool(cmd):
+  if cmd[:1] != "T":
+    return None
+  end = 1
+  length = len(cmd)
+  while end < length and cmd[end] in DIGITS:
+    end += 1
+  if end == 1:
+    return None
+  return cmd[1:end]
+
+
+# First line of gcode that had the filament map written into it at upload, followed by the map.
+FILAMENT_MAP_MARKER = b"; prusammu filament map:"
+
+
+def filament_map_header(toolMap):
+  pairs = " ".join("T{}>T{}".format(tool, toolMap[tool]) for tool in sorted(toolMap))
+  return FILAMENT_MAP_MARKER + " {}\n".format(pairs).encode("ascii")
+
+
+def has_filament_map_header(line):
+  return line.startswith(FILAMENT_MAP_MARKER)
+
+
+# Does to a line of a gcode file (bytes) what gcode_queuing_hook does to the command when the
+# filament map is on: T# commands with a mapping are replaced by T<mapped>, anything else is kept.
+def remap_tool_line(line, toolMap):
+  stripped = line.lstrip()
+  if stripped[:1] != b"T":
+    return line
+  tool = parse_tool(stripped.decode("ascii", "replace"))
+  if tool is None:
+    return line
+  mapped = toolMap.get(int(tool))
+  if mapped is None:
+    return line
+  if line.endswith(b"\r\n"):
+    ending = b"\r\n"
+  elif line.endswith(b"\n"):
+    ending = b"\n"
+  else:
+    ending = b""
+  return "T{}".format(mapped).encode("ascii") + ending
@@ -0,0 +1,130 @@
+# coding=utf-8
+from __future__ import absolute_import
+import json
+import os
+from hashlib import sha1
+from re import compile, MULTILINE
+
+from octoprint_prusammu.common.Gcode import DIGITS
+
+# Bump when the index format changes so old cache files are rebuilt
+INDEX_VERSION = 1
+CHUNK_SIZE = 1 << 20
+# T<n>, Tx, Tc, T?, M702 and M403 at the start of a line (after indentation). For M702 (C) and M403
+# (E<slot> F<type>) the rest of the line up to a comment is kept.
+TOOL_LINE = compile(rb"^[ \t]*(T(?:\d+|x|c|\?)|M702|M403)(?![0-9A-Za-z])([^;\r\n]*)", MULTILINE)
+
+
+# Scans a gcode file for the commands that involve the MMU. The file is read in CHUNK_SIZE pieces
+# and searched with one regex so memory stays constant no matter the size of the file, only the
+# matches are kept. Returns:
+#   entries     - [command, byte offset of the line, line number (from 1)] per match
+#   tools       - sorted tool numbers used by T<n>
+#   toolChanges - T<n> that switch to a different tool (the first load included)
+#   lines/bytes - size of the file scanned
+def scan_gcode(path, chunkSize=CHUNK_SIZE):
+  entries = []
+  tools = set()
+  toolChanges = 0
+  currentTool = None
+  offset = 0 # file offset of buf[0], always the start of a line
+  lineNumber = 1 # line number of buf[0]
+  carry = b""
+
+  with open(path, "rb") as f:
+    while True:
+      chunk = f.read(chunkSize)
+      buf = carry + chunk if carry else chunk
+      if chunk:
+        # Only search whole lines, the partial last line is carried over to the next chunk
+        end = buf.rfind(b"\n") + 1
+        if end == 0:
+          carry = buf
+          continue
+      else:
+        end = len(buf)
+
+      pos = 0
+      for match in TOOL_LINE.finditer(buf, 0, end):
+        start = match.start()
+        lineNumber += buf.count(b"\n", pos, start)
+        pos = start
+        command = match.group(1).decode("ascii")
+        if command[0] == "M":
+          command = "{}{}".format(command, match.group(2).decode("ascii", "replace").rstrip())
+        elif command[1] in DIGITS:
+          tool = int(command[1:])
+          tools.add(tool)
+          if tool != currentTool:
+            toolChanges += 1
+            currentTool = tool
+        entries.append([command, offset + start, lineNumber])
+      lineNumber += buf.count(b"\n", pos, end)
+      offset += end
+      carry = buf[end:]
+      if not chunk:
+        break
+
+  # lineNumber is the line after the last newline, it only exists if something followed the newline
+  lines = lineNumber if buf else lineNumber - 1
+  return dict(
+    version=INDEX_VERSION,
+    bytes=offset,
+    lines=lines,
+    tools=sorted(tools),
+    toolChanges=toolChanges,
+    entries=entries,
+  )
+
+
+# Keeps one json file per gcode file in folder. A cached index is only used while the gcode file's
+# path, size and mtime still match, anything else is scanned again.
+class GcodeIndexCache():
+  def __init__(self, folder):
+    self.folder = folder
+
+  def _cache_file(self, path):
+    return os.path.join(self.folder, "{}.json".format(sha1(path.encode("utf-8")).hexdigest()))
+
+  def get(self, path):
+    try:
+      stat = os.stat(path)
+      with open(self._cache_file(path)) as f:
+        index = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if (
+      index.get("version") != INDEX_VERSION or
+      index.get("path") != path or
+      index.get("size") != stat.st_size or
+      index.get("mtime") != stat.st_mtime
+    ):
+      return None
+    return index
+
+  def build(self, path):
+    # stat first, if the file changes while it's being scanned the next get() won't match
+    stat = os.stat(path)
+    index = scan_gcode(path)
+    index.update(path=path, size=stat.st_size, mtime=stat.st_mtime)
+
+    if not os.path.isdir(self.folder):
+      os.makedirs(self.folder)
+    cacheFile = self._cache_file(path)
+    tmpFile = "{}.tmp".format(cacheFile)
+    with open(tmpFile, "w") as f:
+      json.dump(index, f, separators=(",", ":"))
+    os.replace(tmpFile, cacheFile)
+    return index
+
+  def get_or_build(self, path):
+    index = self.get(path)
+    if index is None:
+      index = self.build(path)
+    return index
+
+  def remove(self, path):
+    try:
+      os.remove(self._cache_file(path))
+    except OSError:
+      pass
@@ -0,0 +1,104 @@
+# coding=utf-8
+from __future__ import absolute_import
+from functools import wraps
+from threading import Lock
+from time import perf_counter_ns, time
+
+# Bucket i holds calls that took less than 2^i ns (and at least 2^(i-1)), so finding the bucket is
+# a bit_length() instead of a search. 64 bits covers any duration.
+BUCKET_COUNT = 65
+
+
+class LatencyHistogram():
+  __slots__ = ("totalNs", "maxNs", "buckets")
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.totalNs = 0
+    self.maxNs = 0
+    self.buckets = [0] * BUCKET_COUNT
+
+  # Called on every hook call so it's kept to the bare minimum, the count is the sum of the buckets.
+  def record(self, ns):
+    self.totalNs += ns
+    if ns > self.maxNs:
+      self.maxNs = ns
+    self.buckets[ns.bit_length()] += 1
+
+  def count(self):
+    return sum(self.buckets)
+
+  # Upper bound (ns) of the bucket holding the given fraction of calls.
+  def percentile(self, fraction, count=None):
+    count = self.count() if count is None else count
+    if not count:
+      return 0
+    target = count * fraction
+    seen = 0
+    for i, bucket in enumerate(self.buckets):
+      seen += bucket
+      if seen >= target:
+        return 1 << i
+    return 1 << (BUCKET_COUNT - 1)
+
+  def to_dict(self):
+    count = self.count()
+    return dict(
+      count=count,
+      meanNs=self.totalNs // count if count else 0,
+      maxNs=self.maxNs,
+      p50Ns=self.percentile(0.50, count),
+      p99Ns=self.percentile(0.99, count),
+      # Only buckets with calls in them, lt is the bucket's upper bound
+      buckets=[dict(lt=1 << i, count=bucket) for i, bucket in enumerate(self.buckets) if bucket],
+    )
+
+
+# Call counts and latency histograms per name. Names like _fire_event are recorded from several
+# threads (comm, events, API) so recording is locked, it's one uncontended lock per call.
+class HookStats():
+  def __init__(self, names=()):
+    self.since = time()
+    self.histograms = {name: LatencyHistogram() for name in names}
+    self._lock = Lock()
+
+  def reset(self):
+    with self._lock:
+      self.since = time()
+      for histogram in self.histograms.values():
+        histogram.reset()
+
+  # Runs on every hook call, acquire() and release() cost less than a with block
+  def record(self, name, ns):
+    self._lock.acquire()
+    try:
+      histogram = self.histograms.get(name)
+      if histogram is None:
+        histogram = self.histograms[name] = LatencyHistogram()
+      histogram.record(ns)
+    finally:
+      self._lock.release()
+
+  def to_dict(self):
+    with self._lock:
+      return dict(
+        since=self.since,
+        hooks={name: histogram.to_dict() for name, histogram in self.histograms.items()},
+      )
+
+
+# Decorator for plugin methods, records how long each call took in self.hookStats under name. Only
+# positional arguments are passed on, forwarding **kwargs costs more than everything else here.
+def timed(name):
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(self, *args):
+      start = perf_counter_ns()
+      try:
+        return fn(self, *args)
+      finally:
+        self.hookStats.record(name, perf_counter_ns() - start)
+    return wrapper
+  return decorator
@@ -1,5 +1,7 @@
 # coding=utf-8
 from __future__ import absolute_import
+from collections import namedtuple
+from re import compile, escape
 
 
 class MmuStates():
@@ -28,9 +30,26 @@ class MmuKeys():
   RESPONSE_DATA="responseData"
   PRUSA_VERSION="prusaVersion"
 
-DEFAULT_MMU_STATE = dict(
+# Snapshot of the MMU. It's immutable so it can be compared in one go and handed to other threads,
+# use update() to get a changed copy. The dict form (with lastLine) is only built for payloads.
+class MmuState(namedtuple("MmuState", ["state", "tool", "previousTool", "response",
+                                       "responseData", "prusaVersion"])):
+  __slots__ = ()
+
+  # Returns a copy with the changes applied, or this snapshot when nothing would change.
+  def update(self, changes):
+    for key, value in changes.items():
+      if getattr(self, key) != value:
+        return self._replace(**changes)
+    return self
+
+  def to_dict(self, lastLine=""):
+    payload = self._asdict()
+    payload[MmuKeys.LAST_LINE] = lastLine
+    return payload
+
+DEFAULT_MMU_STATE = MmuState(
   state=MmuStates.NOT_FOUND,
-  lastLine="",
   tool="",
   previousTool="",
   response="",
@@ -57,6 +76,18 @@ class MMU3MK4Commands():
   ERROR_TMC="MMU2:ERR TMC failed"
   BUTTON="MMU2:Button"
 
+# Every MK4 command we care about starts with this, lines without it can be rejected straight away.
+MK4_PREFIX="MMU2:"
+# All of the MMU3MK4Commands folded into one compiled pattern so a line is classified in one pass.
+# The matched text is the command itself, so match.group(0) can be compared against the constants
+# above. Longest first so a command that prefixes another can never shadow it.
+MK4_COMMAND_MATCH=compile("{}(?:{})".format(MK4_PREFIX, "|".join(sorted(
+  (escape(value[len(MK4_PREFIX):]) for key, value in vars(MMU3MK4Commands).items()
+   if not key.startswith("_") and value.startswith(MK4_PREFIX)),
+  key=len, reverse=True,
+))))
+MK4_START_MATCH=compile(MMU3MK4Commands.START_MATCH)
+
 # https://github.com/prusa3d/Prusa-Firmware/blob/d84e3a9cf31963b9378b9cf39cd3dd4c948a05d6/Firmware/mmu2_protocol.h
 # The 3.0.0 software brings improved logging for the MMU. A response from the MMU would look like:
 # MMU2:<L0 P5
@@ -73,7 +104,9 @@ class MMU3Codes():
   # Group 2 is the request code data. It's usually 0 unless the code involves filament, then this contains the filament number (0-4)
   # Group 3 is the response code. It shows that current status of the command the MMU is performing. Possible responses: P,E,F,A,R,B
   # Group 4 is the response data. It contains extra info in hex depending on the response code. The amount of hex data can range, or even be empty! Check MMU3ResponseCodes below for more info
-  GROUP_MATCH="MMU2:<([TLUXKE])(.*) ([PEFARB])(.*)\*"
+  GROUP_MATCH="MMU2:<([TLUXKE])(.*) ([PEFARB])(.*)\\*"
+  # GROUP_MATCH with the request codes left as {}, MMU3_LINE_MATCH fills them in with the request codes in MMU3_REQUEST_TRANSITIONS
+  GROUP_MATCH_TEMPLATE="MMU2:<([{}])(.*) ([PEFARB])(.*)\\*"
   # These two lines can be used to tell that the MMU is stopped, waiting for user. Some errors trigger both lines, or spam one of them, so deduplication is used in gcode_received_hook
   # Saving and Parking - This appears the first time an error occurs, when the printer pauses itself to wait. It doesn't happen again if another error occurs before the printer resumes. MMU MCU ERROR seems to spam this every error, so twice a second!
   SAVING_PARKING="MMU2:Saving and parking"
@@ -132,4 +165,56 @@ class MMU3ResponseCodes():
   #                  The printer spams the next command until the MMU eventually takes it
   REJECTED="R"
   # B -     Button - Theoretically the MMU sends the pressed button to the printer for processing. I've never seen it in any log outputs
-  BUTTON="B"
\ No newline at end of file
+  BUTTON="B"
+
+# What a request/response pair from the MMU turns into. state is the next MmuStates value, carryTool
+# copies the request data into the tool and clearPreviousTool blanks out the previous tool.
+MmuTransition = namedtuple("MmuTransition", ["state", "carryTool", "clearPreviousTool"])
+
+# Request code -> (transition while the MMU is working on it, transition once it's finished)
+# New request codes only need an entry here.
+MMU3_REQUEST_TRANSITIONS = {
+  # Load filament to nozzle. Once finished the printer is loaded so clear the previous tool
+  MMU3RequestCodes.TOOL: (MmuTransition(MmuStates.LOADING, True, False),
+                          MmuTransition(MmuStates.LOADED, False, True)),
+  # Preload filament to mmu. Once finished the printer is idle
+  MMU3RequestCodes.LOAD: (MmuTransition(MmuStates.LOADING_MMU, True, False),
+                          MmuTransition(MmuStates.OK, False, False)),
+  # Unload Filament from Nozzle NOTE: Doesn't give us any tool info, so rely on T# commands to
+  # give us current and previous tool info
+  MMU3RequestCodes.UNLOAD: (MmuTransition(MmuStates.UNLOADING, False, False),
+                            MmuTransition(MmuStates.OK, False, False)),
+  # Printer Reset, Shows up after power on
+  MMU3RequestCodes.RESET: (MmuTransition(MmuStates.OK, False, False),
+                           MmuTransition(MmuStates.OK, False, False)),
+  # Cut Filament
+  MMU3RequestCodes.CUT: (MmuTransition(MmuStates.CUTTING, True, False),
+                         MmuTransition(MmuStates.OK, False, False)),
+  # Eject Filament
+  MMU3RequestCodes.EJECT: (MmuTransition(MmuStates.EJECTING, True, False),
+                           MmuTransition(MmuStates.OK, False, False)),
+}
+
+MMU3_LINE_MATCH = compile(MMU3Codes.GROUP_MATCH_TEMPLATE.format("".join(MMU3_REQUEST_TRANSITIONS)))
+
+def _public_values(cls):
+  return [value for key, value in vars(cls).items() if not key.startswith("_")]
+
+# Precomputed (request code, response code, current state) -> MmuTransition. If we're already at
+# attention and the MMU is still reporting an error we stay at attention and only take the error
+# code, otherwise the new response shows that the attention has cleared.
+def _build_mmu3_transitions():
+  transitions = {}
+  for request, (working, finished) in MMU3_REQUEST_TRANSITIONS.items():
+    for response in _public_values(MMU3ResponseCodes):
+      for state in _public_values(MmuStates):
+        if state == MmuStates.ATTENTION and response == MMU3ResponseCodes.ERROR:
+          transition = MmuTransition(MmuStates.ATTENTION, False, False)
+        elif response == MMU3ResponseCodes.FINISHED:
+          transition = finished
+        else:
+          transition = working
+        transitions[(request, response, state)] = transition
+  return transitions
+
+MMU3_TRANSITIONS = _build_mmu3_transitions()
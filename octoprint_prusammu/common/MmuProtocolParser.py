@@ -0,0 +1,221 @@
+# coding=utf-8
+from __future__ import absolute_import
+from collections import namedtuple
+
+from octoprint_prusammu.common.Mmu import MmuStates, MmuKeys, MMU3Codes, MMU3ResponseCodes, \
+  MMU3MK4Commands, MK4_PREFIX, MK4_COMMAND_MATCH, MK4_START_MATCH, MMU3_LINE_MATCH, \
+  MMU3_TRANSITIONS
+from octoprint_prusammu.common.PrusaProfile import PrusaProfile, detect_connection_profile
+from octoprint_prusammu.common.RecentLines import RecentLines
+
+# MK4 responseData we fake for each of the error and loading commands
+MK4_ERROR_DATA = {
+  MMU3MK4Commands.ERROR: "c",
+  MMU3MK4Commands.ERROR_FILAMENT: "f",
+  MMU3MK4Commands.ERROR_INTERNAL: "d",
+  MMU3MK4Commands.ERROR_TMC: "e",
+}
+MK4_LOADING_DATA = {
+  MMU3MK4Commands.LOADING_FINDA: "5",
+  MMU3MK4Commands.LOADING_EXTRUDER: "6",
+  MMU3MK4Commands.LOADING_FSENSOR: "7",
+}
+
+# One change a line asks for. changes is what to apply to the MmuState (like _fire_event takes), mmu
+# the state with them applied (the same object if nothing changed) and request the MMU3 request code
+# the line answered, None for anything else.
+LineChange = namedtuple("LineChange", ["changes", "mmu", "request"])
+
+
+# True for a line the parser could do something with once the printer profile is known
+def is_mmu_line(line):
+  return MK4_PREFIX in line or "MACHINE_TYPE:" in line or MMU3Codes.LCD_CHANGED in line
+
+
+# Turns the lines the printer sends into MMU state changes. It doesn't fire events or touch the
+# plugin, the only thing it keeps is what it needs to ignore repeated lines (lastLine, recentLines)
+# and the MK4's last action, so the same parser can sit behind the gcode hook or run over a saved
+# log (analyze.py).
+class MmuProtocolParser():
+  def __init__(self, recentLines=None):
+    self.lastLine = ""
+    self.lastMmuAction = ""
+    # Catches lines the firmware repeats that aren't back to back, see RecentLines
+    self.recentLines = RecentLines() if recentLines is None else recentLines
+
+  # Forget the lines seen so the next one is handled even if it's a repeat
+  def reset(self):
+    self.lastLine = ""
+    self.recentLines.clear()
+
+  # Returns the LineChanges for one received line given the current MmuState, usually none.
+  def feed(self, mmu, line):
+    changes = []
+    self._parse(mmu, line, changes)
+    return changes
+
+  # Same as feed for a batch of lines, each line sees the state the ones before it left. Returns
+  # (all the LineChanges, the final MmuState).
+  def feed_many(self, mmu, lines):
+    changes = []
+    parse = self._parse
+    for line in lines:
+      if parse(mmu, line, changes):
+        mmu = changes[-1].mmu
+    return changes, mmu
+
+  # Appends to changes, True if it did
+  def _parse(self, mmu, line, changes):
+    # Another Firmware check in case the actual one fails.
+    if mmu.prusaVersion is None:
+      if not line.startswith("FIRMWARE_NAME"):
+        # Until we have a version there's no point in trying to parse
+        return False
+      # MK4: The MMU doesn't tell us it's ok so if the printer has one assume it is.
+      version = detect_connection_profile(line)
+      if version != PrusaProfile.MK3:
+        return self._change(mmu, dict(state=MmuStates.OK, prusaVersion=version), changes)
+      return self._change(mmu, dict(prusaVersion=version), changes)
+
+    # MK3.5/3.9/4
+    if mmu.prusaVersion != PrusaProfile.MK3:
+      return self._parse_mk4(mmu, line, changes)
+
+    # MK3
+    return self._parse_mk3(mmu, line, changes)
+
+  def _change(self, mmu, payload, changes, request=None):
+    changes.append(LineChange(payload, mmu.update(payload), request))
+    return True
+
+  def _parse_mk4(self, mmu, line, changes):
+    # The MK4 is less verbose. To try and fill that gap we're faking the response and responseData
+    # to try and match the information we'd expect to get. Some day I hope prusa gives us back
+    # the data we had before.
+
+    # Everything but the start line is prefixed, so most serial chatter leaves here.
+    if MK4_PREFIX not in line:
+      # Starting
+      if "MACHINE_TYPE:" in line and MK4_START_MATCH.search(line):
+        # Back to back because we no longer get a ready message from the MMU
+        self._change(mmu, dict(state=MmuStates.STARTING, response=MMU3ResponseCodes.FINISHED,
+                               responseData="0"), changes)
+        return self._change(changes[-1].mmu,
+                            dict(state=MmuStates.OK, response=MMU3ResponseCodes.FINISHED,
+                                 responseData="0"), changes)
+      return False
+
+    # Dedupe
+    if self.lastLine == line:
+      return False
+    self.lastLine = line
+    if self.recentLines.repeated(line, mmu):
+      return False
+
+    match = MK4_COMMAND_MATCH.search(line)
+    if match is None:
+      return False
+    command = match.group(0)
+
+    # Paused
+    if command == MMU3MK4Commands.PAUSED_USER:
+      self.lastMmuAction = MmuStates.PAUSED_USER
+      # The printer will spam pause messages, so ignore them if we're already paused
+      if mmu.state == MmuStates.PAUSED_USER:
+        return False
+      # The printer will send pause messages directly after an attention, and attention is more
+      # important, so ignore them
+      elif mmu.state == MmuStates.ATTENTION:
+        return False
+      return self._change(mmu, dict(state=MmuStates.PAUSED_USER, response=MMU3ResponseCodes.ERROR,
+                                    responseData="c"), changes)
+
+    # Errors
+    # TODO: ERROR is a more generic error. we might be able to get something out of the bytes sent.
+    if command in MK4_ERROR_DATA:
+      return self._change(mmu, dict(state=MmuStates.ATTENTION, response=MMU3ResponseCodes.ERROR,
+                                    responseData=MK4_ERROR_DATA[command]), changes)
+
+    # Loading
+    if command in MK4_LOADING_DATA:
+      self.lastMmuAction = MmuStates.LOADING
+      return self._change(mmu, dict(state=MmuStates.LOADING, tool=mmu.tool,
+                                    response=MMU3ResponseCodes.PROCESSING,
+                                    responseData=MK4_LOADING_DATA[command]), changes)
+
+    if command == MMU3MK4Commands.ACTION_DONE:
+      # Loaded, clear previous tool
+      if self.lastMmuAction == MmuStates.LOADING:
+        self.lastMmuAction = MmuStates.LOADED
+        return self._change(mmu, dict(state=MmuStates.LOADED, previousTool="", tool=mmu.tool,
+                                      response=MMU3ResponseCodes.FINISHED, responseData="2"),
+                            changes)
+      # Unloaded Final
+      elif self.lastMmuAction == MmuStates.UNLOADING_FINAL:
+        self.lastMmuAction = MmuStates.OK
+        return self._change(mmu, dict(state=MmuStates.OK, response=MMU3ResponseCodes.FINISHED,
+                                      responseData="2"), changes)
+      return False
+
+    # Unloading (changing tool)
+    if command == MMU3MK4Commands.UNLOADING:
+      self.lastMmuAction = MmuStates.UNLOADING
+      return self._change(mmu, dict(state=MmuStates.UNLOADING,
+                                    response=MMU3ResponseCodes.PROCESSING, responseData="3"),
+                          changes)
+
+    # Unloading Final (print done)
+    if command == MMU3MK4Commands.UNLOADING_FINAL:
+      self.lastMmuAction = MmuStates.UNLOADING_FINAL
+      return self._change(mmu, dict(state=MmuStates.UNLOADING,
+                                    response=MMU3ResponseCodes.PROCESSING, responseData="3"),
+                          changes)
+
+    return False
+
+  def _parse_mk3(self, mmu, line, changes):
+    # MMU2 3.0.0
+    # https://github.com/prusa3d/Prusa-Firmware/blob/d84e3a9cf31963b9378b9cf39cd3dd4c948a05d6/Firmware/mmu2_progress_converter.cpp#L8
+    # https://github.com/prusa3d/Prusa-Firmware/blob/d84e3a9cf31963b9378b9cf39cd3dd4c948a05d6/Firmware/mmu2_protocol_logic.cpp
+    # One REGEX to catch all important MMU commands. This creates 4 matched groups.
+    # Group 1 is a single letter request code. Group 2 is the request data in hexidecimal
+    # Group 3 is a single letter response code. Group 4 is the response data in hexidecimal.
+    # Warning, it may not exist!
+    matchedCommand = MMU3_LINE_MATCH.search(line) if "MMU2:<" in line else None
+    if matchedCommand is not None:
+      # If this line is the same as the previously seen one, ignore it and return immediately,
+      # otherwise it's new, so continue
+      if self.lastLine == line:
+        return False
+      self.lastLine = line
+      if self.recentLines.repeated(line, mmu):
+        return False
+      request, requestData, response, responseData = matchedCommand.groups()
+
+      transition = MMU3_TRANSITIONS.get((request, response, mmu.state))
+      if transition is None:
+        return False
+
+      payload = dict(state=transition.state, response=response, responseData=responseData)
+      if transition.carryTool:
+        payload[MmuKeys.TOOL] = requestData
+      if transition.clearPreviousTool:
+        payload[MmuKeys.PREV_TOOL] = ""
+      return self._change(mmu, payload, changes, request)
+
+    # Catch other MMU3 lines not caught by regex
+    # ATTENTION. Some errors spam one of these lines, so deduplicate them here. It's possible some
+    # error may not print one of these lines, but I haven't found one
+    if (
+      (MMU3Codes.SAVING_PARKING in line or MMU3Codes.COOLDOWN_PENDING in line) and
+      mmu.state != MmuStates.ATTENTION
+    ):
+      return self._change(mmu, dict(state=MmuStates.ATTENTION), changes)
+    # PAUSED_USER is caught in the MMU2 section early on in this function, but we need to recover
+    # from it if the MMU's response is the same as LAST_LINE
+    elif mmu.state == MmuStates.PAUSED_USER and MMU3Codes.LCD_CHANGED in line:
+      # If detected, blank out LAST_LINE. The next mmu response in the log will trigger again and
+      # change the state away from PAUSED_USER
+      self.reset()
+
+    return False
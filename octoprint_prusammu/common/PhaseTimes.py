@@ -0,0 +1,93 @@
+# coding=utf-8
+from __future__ import absolute_import
+from collections import deque
+from time import monotonic
+
+from octoprint_prusammu.common.Mmu import MmuStates, MMU3ResponseCodes
+
+# How many recent durations are kept per slot and phase, the mean/p95/max are over these
+WINDOW = 50
+# Progress codes where the filament moving is the one being unloaded (previousTool)
+UNLOAD_PHASES = frozenset(["3", "4"])
+# Anything in these states isn't the MMU doing its job, the phase it was in isn't timed
+INTERRUPTED_STATES = frozenset([MmuStates.ATTENTION, MmuStates.PAUSED_USER, MmuStates.NOT_FOUND])
+
+
+class PhaseTime():
+  __slots__ = ("count", "samples")
+
+  def __init__(self):
+    self.count = 0
+    # ms, oldest first, fixed size
+    self.samples = deque(maxlen=WINDOW)
+
+  def record(self, ms):
+    self.count += 1
+    self.samples.append(ms)
+
+  def to_dict(self):
+    samples = sorted(self.samples)
+    return dict(
+      count=self.count,
+      meanMs=sum(samples) // len(samples),
+      p95Ms=samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+      maxMs=samples[-1],
+    )
+
+
+# Times how long the MMU spends in each progress phase (feeding to FINDA, unloading...) per slot. A
+# phase starts when the MMU reports its progress code and ends with the next state. Phases cut short
+# by an error or a pause aren't kept since they'd only say how long the user took.
+class PhaseTimes():
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.phases = {}
+    # (slot, progress code, start) of the phase the MMU is in
+    self._current = None
+
+  # Called with every new MMU state
+  def observe(self, mmu, now=None):
+    now = monotonic() if now is None else now
+    current = self._current
+    phase = None
+    if mmu.response == MMU3ResponseCodes.PROCESSING and mmu.responseData:
+      slot = mmu.tool
+      if mmu.responseData in UNLOAD_PHASES and mmu.previousTool != "":
+        slot = mmu.previousTool
+      phase = (str(slot), mmu.responseData)
+
+    if current is not None:
+      if phase == current[:2]:
+        return
+      if mmu.state not in INTERRUPTED_STATES:
+        self.record(current[0], current[1], int((now - current[2]) * 1000))
+
+    self._current = None if phase is None or phase[0] == "" else phase + (now,)
+
+  def record(self, slot, phase, ms):
+    phases = self.phases.get(slot)
+    if phases is None:
+      phases = self.phases[slot] = {}
+    phaseTime = phases.get(phase)
+    if phaseTime is None:
+      phaseTime = phases[phase] = PhaseTime()
+    phaseTime.record(ms)
+
+  # Mean ms a slot takes to load (or unload, unload=True) from its recent phase times, None if it
+  # hasn't been timed yet.
+  def mean_ms(self, slot, unload=False):
+    means = [
+      sum(phaseTime.samples) // len(phaseTime.samples)
+      for phase, phaseTime in list(self.phases.get(str(slot), {}).items())
+      if (phase in UNLOAD_PHASES) == unload
+    ]
+    return sum(means) if means else None
+
+  # {slot: {progress code: {count, meanMs, p95Ms, maxMs}}}
+  def to_dict(self):
+    return {
+      slot: {phase: phaseTime.to_dict() for phase, phaseTime in list(phases.items())}
+      for slot, phases in list(self.phases.items())
+    }
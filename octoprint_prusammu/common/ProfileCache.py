@@ -0,0 +1,58 @@
+# coding=utf-8
+from __future__ import absolute_import
+import json
+import os
+from threading import Lock
+
+
+# The printer profile (PrusaProfile) last detected for each connection, keyed by port and OctoPrint
+# printer profile. A connection to the same printer can start out with it instead of waiting on the
+# firmware to say what it is. Saved to one json file, only when a profile changes.
+class ProfileCache():
+  def __init__(self, path=None):
+    self.path = path
+    self.profiles = {}
+    self._lock = Lock()
+
+  @staticmethod
+  def key(port, printerProfile):
+    return "{}|{}".format(port, printerProfile)
+
+  def get(self, key):
+    if key is None:
+      return None
+    return self.profiles.get(key)
+
+  # True if the profile changed and should be saved
+  def set(self, key, profile):
+    if key is None or self.profiles.get(key) == profile:
+      return False
+    with self._lock:
+      self.profiles[key] = profile
+    return True
+
+  def save(self):
+    if self.path is None:
+      return
+    with self._lock:
+      data = json.dumps(self.profiles, separators=(",", ":"))
+    folder = os.path.dirname(self.path)
+    if folder and not os.path.isdir(folder):
+      os.makedirs(folder)
+    tmpFile = "{}.tmp".format(self.path)
+    with open(tmpFile, "w") as f:
+      f.write(data)
+    os.replace(tmpFile, self.path)
+
+  def load(self):
+    if self.path is None:
+      return
+    try:
+      with open(self.path) as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      return
+    if isinstance(data, dict):
+      # Profiles detected before the file was read are newer
+      with self._lock:
+        self.profiles = dict(data, **self.profiles)
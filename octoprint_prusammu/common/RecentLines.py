@@ -0,0 +1,46 @@
+# coding=utf-8
+from __future__ import absolute_import
+from time import monotonic
+
+DEFAULT_WINDOW = 5 # s
+DEFAULT_SIZE = 64
+
+
+# Remembers which lines were handled recently so firmware repeating a few lines over and over (even
+# interleaved, which the last line check can't catch) is only handled once per window. Lines are
+# keyed together with the MMU state (MmuState) they arrived in, the same line in a different state
+# can mean a change and always goes through. A line isn't pushed back by its repeats, so a spamming
+# line is still handled once per window and the state can't be stuck for longer than that.
+class RecentLines():
+  # clock is seconds, monotonic() unless something needs to control time (test/mmu_simulator.py)
+  def __init__(self, window=DEFAULT_WINDOW, size=DEFAULT_SIZE, clock=monotonic):
+    self.window = window
+    self.size = size
+    self.clock = clock
+    self.suppressed = 0
+    self._seen = {}
+
+  # True if the line should be skipped. Only called from the comm thread.
+  def repeated(self, line, mmu):
+    if self.window <= 0:
+      return False
+    now = self.clock()
+    key = (line, mmu)
+    seen = self._seen.get(key)
+    if seen is not None and now - seen < self.window:
+      self.suppressed += 1
+      return True
+
+    if seen is None and len(self._seen) >= self.size:
+      self._expire(now)
+    self._seen[key] = now
+    return False
+
+  def _expire(self, now):
+    self._seen = {key: seen for key, seen in self._seen.items() if now - seen < self.window}
+    # All recent, start over rather than grow
+    if len(self._seen) >= self.size:
+      self._seen = {}
+
+  def clear(self):
+    self._seen = {}
@@ -0,0 +1,86 @@
+# coding=utf-8
+from __future__ import absolute_import
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+
+
+class ScheduledCall():
+  __slots__ = ("deadline", "fn", "args", "interval", "cancelled")
+
+  def __init__(self, deadline, fn, args, interval=None):
+    self.deadline = deadline
+    self.fn = fn
+    self.args = args
+    self.interval = interval
+    self.cancelled = False
+
+  # Safe to call from any thread and more than once. A call that's already running finishes.
+  def cancel(self):
+    self.cancelled = True
+
+
+# One long lived thread that runs calls at their deadline (prompt timeouts, nav flushes, periodic
+# work) instead of a Timer thread per call. Calls run one at a time on the scheduler thread so they
+# must be quick. Cancelled calls stay in the heap until their deadline and are skipped. Calls made
+# before start() wait until it's called.
+class Scheduler():
+  def __init__(self, logger=None):
+    self.logger = logger
+    self._heap = []
+    self._order = count()
+    self._condition = Condition()
+    self._thread = None
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._thread = Thread(target=self._run, name="prusammu-scheduler")
+    self._thread.daemon = True
+    self._thread.start()
+
+  # Runs fn(*args) in delay seconds
+  def call_later(self, delay, fn, *args):
+    return self._schedule(ScheduledCall(monotonic() + delay, fn, args))
+
+  # Runs fn(*args) every interval seconds, the first time in interval seconds
+  def call_every(self, interval, fn, *args):
+    return self._schedule(ScheduledCall(monotonic() + interval, fn, args, interval))
+
+  def _schedule(self, call):
+    with self._condition:
+      heappush(self._heap, (call.deadline, next(self._order), call))
+      # Only wake the thread if this is now the first deadline
+      if self._heap[0][2] is call:
+        self._condition.notify()
+    return call
+
+  def pending(self):
+    return sum(1 for _, _, call in list(self._heap) if not call.cancelled)
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while True:
+          if not self._heap:
+            self._condition.wait()
+            continue
+          wait = self._heap[0][0] - monotonic()
+          if wait <= 0:
+            break
+          self._condition.wait(wait)
+        _, _, call = heappop(self._heap)
+
+      if call.cancelled:
+        continue
+      try:
+        call.fn(*call.args)
+      except Exception:
+        if self.logger is not None:
+          self.logger.exception("Scheduled {} failed".format(getattr(call.fn, "__name__", call.fn)))
+
+      if call.interval is not None and not call.cancelled:
+        # Keep to the original cadence unless it fell behind
+        call.deadline = max(call.deadline + call.interval, monotonic())
+        self._schedule(call)
@@ -16,5 +16,7 @@ class SettingsKeys():
   FILAMENT_MAP="filamentMap"
   FILAMENT_COUNT="filamentCount"
   USE_FILAMENT_MAP="useFilamentMap"
+  REWRITE_FILAMENT_MAP="rewriteFilamentMap"
   ENABLE_PROMPT="enablePrompt"
-  PRUSA_VERSION="prusaVersion"
\ No newline at end of file
+  PRUSA_VERSION="prusaVersion"
+  NAV_UPDATE_INTERVAL="navUpdateInterval"
\ No newline at end of file
@@ -0,0 +1,109 @@
+# coding=utf-8
+from __future__ import absolute_import
+import json
+import os
+from threading import Lock
+
+JOURNAL_FILE = "state.jsonl"
+CHECKPOINT_FILE = "state.json"
+# Once the journal is bigger than MAX_BYTES it's rewritten with only the last KEEP_BYTES of it
+MAX_BYTES = 1 << 20
+KEEP_BYTES = 1 << 18
+
+
+# Remembers the MMU state across restarts. Every state is appended to a json lines journal (history)
+# and the latest one is also written to a small checkpoint file, so restoring is one small read no
+# matter how long the journal is. append() only queues the record, flush() does the writing and
+# fsync so it can run on a background thread once in a while.
+class StateJournal():
+  def __init__(self, folder):
+    self.folder = folder
+    self.journalFile = os.path.join(folder, JOURNAL_FILE)
+    self.checkpointFile = os.path.join(folder, CHECKPOINT_FILE)
+    self.written = 0
+    self.compactions = 0
+    self._pending = []
+    self._lock = Lock()
+    self._flushLock = Lock()
+
+  def append(self, record):
+    with self._lock:
+      self._pending.append(record)
+
+  # Latest record written (or queued), None if there's none.
+  def last(self):
+    with self._lock:
+      if self._pending:
+        return self._pending[-1]
+    return self.load()
+
+  def load(self):
+    try:
+      with open(self.checkpointFile) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      pass
+    # No (or a broken) checkpoint, the journal's last whole line is just as good
+    return self._last_journal_record()
+
+  def _last_journal_record(self):
+    try:
+      with open(self.journalFile, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        lines = f.read().splitlines()
+    except OSError:
+      return None
+    for line in reversed(lines):
+      try:
+        return json.loads(line.decode("utf-8"))
+      except ValueError:
+        continue
+    return None
+
+  # Writes everything queued since the last flush. Returns how many records were written.
+  def flush(self):
+    with self._flushLock:
+      with self._lock:
+        records = self._pending
+        self._pending = []
+      if not records:
+        return 0
+
+      if not os.path.isdir(self.folder):
+        os.makedirs(self.folder)
+
+      data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+      with open(self.journalFile, "a") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+      self._write_atomic(self.checkpointFile, json.dumps(records[-1], separators=(",", ":")))
+      self.written += len(records)
+
+      if os.path.getsize(self.journalFile) > MAX_BYTES:
+        self._compact()
+      return len(records)
+
+  def _compact(self):
+    with open(self.journalFile, "rb") as f:
+      f.seek(-KEEP_BYTES, os.SEEK_END)
+      tail = f.read()
+    # Drop the line the cut landed in
+    tail = tail[tail.find(b"\n") + 1:]
+    self._write_atomic(self.journalFile, tail.decode("utf-8"))
+    self.compactions += 1
+
+  def _write_atomic(self, path, data):
+    tmpFile = "{}.tmp".format(path)
+    with open(tmpFile, "w") as f:
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmpFile, path)
+
+  def stats(self):
+    with self._lock:
+      pending = len(self._pending)
+    return dict(pending=pending, written=self.written, compactions=self.compactions)
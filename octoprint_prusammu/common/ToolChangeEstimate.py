@@ -0,0 +1,86 @@
+# coding=utf-8
+from __future__ import absolute_import
+from collections import Counter
+
+from octoprint_prusammu.common.Gcode import DIGITS
+
+
+# Estimates how long the tool changes left in the print will take. The changes left are kept as a
+# count per (from slot, to slot) so each T<n> sent only takes one off, and the time is the counts
+# times how long the slots take to unload and load (see PhaseTimes.mean_ms).
+class ToolChangeEstimate():
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.tools = None
+    self.cursor = 0
+    self.current = None
+    self.changes = Counter()
+    self.changesLeft = 0
+
+  # tools is every T<n> of the file in order (see index_tools), cursor how many were already sent
+  # and current the slot loaded now.
+  def set_tools(self, tools, cursor=0, current=None):
+    changes = Counter()
+    last = current
+    for tool in tools[cursor:]:
+      if tool != last:
+        changes[(last, tool)] += 1
+        last = tool
+    self.tools = tools
+    self.cursor = cursor
+    self.current = current
+    self.changes = changes
+    self.changesLeft = sum(changes.values())
+
+  def tool_sent(self):
+    if self.tools is None or self.cursor >= len(self.tools):
+      self.cursor += 1
+      return
+    tool = self.tools[self.cursor]
+    self.cursor += 1
+    if tool == self.current:
+      return
+    key = (self.current, tool)
+    self.current = tool
+    if self.changes[key] > 0:
+      self.changes[key] -= 1
+      self.changesLeft -= 1
+
+  # Seconds the changes left will take, None without an index or any load timed. Slots that haven't
+  # been timed yet are counted as the average of the ones that have.
+  def seconds_left(self, phaseTimes):
+    if self.tools is None:
+      return None
+    if not self.changesLeft:
+      return 0
+
+    slots = set(tool for change in self.changes for tool in change if tool is not None)
+    loadMs = {slot: phaseTimes.mean_ms(slot) for slot in slots}
+    unloadMs = {slot: phaseTimes.mean_ms(slot, unload=True) for slot in slots}
+    if all(ms is None for ms in loadMs.values()):
+      return None
+    for times in (loadMs, unloadMs):
+      known = [ms for ms in times.values() if ms is not None]
+      average = sum(known) // len(known) if known else 0
+      for slot, ms in times.items():
+        if ms is None:
+          times[slot] = average
+    unloadMs[None] = 0
+
+    totalMs = sum(
+      count * (unloadMs[source] + loadMs[target])
+      for (source, target), count in self.changes.items() if count
+    )
+    return totalMs // 1000
+
+
+# The T<n> tools of a gcode index (see GcodeIndex.scan_gcode) in order, mapped through toolMap.
+def index_tools(index, toolMap=None):
+  tools = []
+  for command, _, _ in index.get("entries", []):
+    if command[:1] == "T" and command[1:2] in DIGITS:
+      tool = int(command[1:])
+      tools.append(toolMap.get(tool, tool) if toolMap else tool)
+  return tools
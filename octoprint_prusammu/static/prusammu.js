@@ -27,14 +27,26 @@ $(() => {
     FILAMENT_MANAGER: "filamentManager",
     SPOOL_MAN: "spoolMan",
   };
-  const MAX_FILAMENT_RETRY = 5;
+  // Per browser opt-in to print the server's debug records to the console
+  const DEBUG_CONSOLE_KEY = `${LOG_PLUGIN_NAME}_debugConsole`;
+  const DEBUG_POLL_MS = 2000;
+  const DEBUG_PAGE = 100;
 
   function PrusaMMU2ViewModel(parameters) {
     const self = this;
-    // Used to refresh the UI when the user tabs away.
-    let isActiveTab = true;
-    // Track if we've loaded the filament or not. Useful for spool managers that are slow to load.
-    self.filamentRetryCount = 0;
+    // Sequence number of the last nav message seen, sent with getmmu so the server can skip the
+    // response when nothing changed.
+    let lastNavSeq = null;
+    // Next debug record to fetch and the pending poll
+    let debugSeq = 0;
+    let debugPoll = undefined;
+    // Version of the filament catalogue we have (see refreshFilament) and the spools we last sent
+    let filamentVersion = null;
+    let lastReportedSpools = null;
+    // The last nav message, kept to draw the nav again when the filament changes
+    let lastNav = null;
+    // The filament in each slot from the server, see getFilamentList()
+    self.filamentCatalogue = [];
     self._prusaVersion;
     self._overrideFilament = "";
     // Keep track so we can refresh if needed
@@ -47,7 +59,7 @@ $(() => {
 
     self.globalSettings = parameters[0]; // settingsViewModel
     self.loginState = parameters[1]; // loginStateViewModel
-    // self.printerState = parameters[2]; // printerStateViewModel
+    self.printerState = parameters[2]; // printerStateViewModel
     self.filamentSources = {
       filamentManager: parameters[3], // filamentManagerViewModel
       spoolManager: parameters[4], // spoolManagerViewModel
@@ -71,6 +83,27 @@ $(() => {
 
     self.navMessageText = ko.observable("");
 
+    // Seconds (and number) of tool changes left in the print, null when unknown
+    self.toolChangeTimeLeft = ko.observable(null);
+    self.toolChangesLeft = ko.observable(null);
+    /**
+     * OctoPrint's time left doesn't know about tool changes, this adds the time they'll take.
+     */
+    self.navTimeLeftText = ko.pureComputed(() => {
+      const toolChangeTimeLeft = self.toolChangeTimeLeft();
+      if (!self.toolChangesLeft() || toolChangeTimeLeft === null) {
+        return "";
+      }
+      const text = `${self.toolChangesLeft()} ${gettext("tool changes left")}: ` +
+                   formatFuzzyPrintTime(toolChangeTimeLeft);
+      const printTimeLeft = self.printerState.printTimeLeft();
+      if (!printTimeLeft) {
+        return text;
+      }
+      return `${gettext("Time left with tool changes")}: ` +
+             `${formatFuzzyPrintTime(printTimeLeft + toolChangeTimeLeft)} (${text})`;
+    });
+
     /* =============================
      * =====   Nav Functions   =====
      * ============================= */
@@ -255,16 +288,11 @@ $(() => {
       self._toolState = state;
       self._response = response;
       self._responseData = responseData;
-      // Fetch filament data from the correct source
+      // Filament data from the server, the nav is drawn again when it changes
       const filamentList = self.getFilamentList();
       const currentFilament = filamentList.find(f => f.index === toolId);
       const previousFilament = filamentList.find(f => f.index === previousToolId);
 
-      // If we didn't load the current filament then simply try again.
-      if (!currentFilament) {
-        self.delayedRefreshNav(filamentList);
-      }
-
       // global state icon & text
       self.navActionText(getNavActionText(state, toolId, currentFilament, previousFilament));
       self.navActionIcon(getNavActionIcon(state));
@@ -272,10 +300,10 @@ $(() => {
       // If response was present in the log we're dealing with an MMU running 3.0.0 so let's show more info.
       if (response) {
         // If there was an error then let's show a popup to the user. But only once.
-        if (response === RESPONSES.ERROR && !self._lastError) {
+        if (response === RESPONSES.ERROR && self._lastError !== responseData) {
           self._lastError = responseData;
           showErrorPopupNotification(self.processMmuError(responseData));
-        } else {
+        } else if (response !== RESPONSES.ERROR) {
           self._lastError = "";
         }
         self.navMessageText(getNavMessageText(response, responseData));
@@ -343,37 +371,6 @@ $(() => {
       self.globalSettings.selectTab("#settings_plugin_prusammu");
     };
 
-    /**
-     * Delay a nav refresh and then try again. We're probably waiting for a spool manager. It will
-     * wait MAX_FILAMENT_RETRY times and do a slow backoff.
-     * 
-     * @param {[{id, name, type, color, enabled}, ...]} filamentList - The filament object
-     *                                                                 representing the tool
-     *                                                                 (see getFilamentList())
-     */
-    self.delayedRefreshNav = (filamentList) => {
-      const filamentCount = parseInt(self.settings.filamentCount(), 10);
-      if (
-        self.filamentRetryCount++ >= MAX_FILAMENT_RETRY ||
-        (filamentList.length >= filamentCount && !filamentList.includes(null))
-      ) {
-        return;
-      }
-      setTimeout(() => {
-        log(
-          "delayedRefreshNav", self.filamentRetryCount,
-          { 
-            "state": self._toolState,
-            "tool": self._toolId,
-            "prevTool": self._previousToolId,
-            "response": self._response,
-            "responseData": self._responseData
-          }
-        );
-        updateNav(self._toolState, self._toolId, self._previousToolId, self._response, self._responseData);
-      }, 1000 * self.filamentRetryCount);
-    };
-
     // A hacky way to avoid spamming the user with errors.
     let _notifyEle = undefined;
 
@@ -500,12 +497,14 @@ $(() => {
           closeModal();
           break;
         case "nav":
-          updateNav(data.state, data.tool, data.previousTool, data.response, data.responseData);
-          if (data.prusaVersion) {
-            self._prusaVersion = data.prusaVersion;
+          applyNav(data);
+          break;
+        case "filament":
+          if (data.version !== filamentVersion) {
+            refreshFilament();
           }
           break;
-        // case "debug": these just exist to get logged and we do that above.
+        // Debug records aren't pushed, see pollDebug.
       }
     };
 
@@ -518,6 +517,7 @@ $(() => {
       self.shouldShowNav(self.settings.displayActiveFilament());
       self.isSimpleDisplayMode(self.settings.simpleDisplayMode());
       self.isAdvancedDisplayMode(self.settings.advancedDisplayMode() && !self.settings.simpleDisplayMode());
+      setDebugConsole($("#prusammu_debug_console").is(":checked"));
     };
 
     /**
@@ -533,7 +533,9 @@ $(() => {
      */
     self.onSettingsShown = () => {
       bindPickers();
+      $("#prusammu_debug_console").prop("checked", isDebugConsole());
       showError();
+      showPhases();
       if (self._prusaVersion === "MK3") {
         $("#settings_plugin_prusammu .mk4").addClass("hide");
         $("#settings_plugin_prusammu .mk3").removeClass("hide");
@@ -552,8 +554,26 @@ $(() => {
       log("onStartupComplete");
       self.shouldShowNav(self.settings.displayActiveFilament());
       self.isSimpleDisplayMode(self.settings.simpleDisplayMode());
-      OctoPrint.simpleApiCommand(PLUGIN_NAME, "getmmu");
+      refreshNav();
+      refreshFilament();
+      watchSourceSpools();
       setupRefocusCheck();
+      setDebugConsole(isDebugConsole());
+    };
+
+    /**
+     * Called when the server comes back after a disconnect. The server may have restarted and
+     * started numbering nav messages from scratch (and forgotten the spools) so forget what we've
+     * seen.
+     */
+    self.onServerReconnect = () => {
+      log("onServerReconnect");
+      lastNavSeq = null;
+      filamentVersion = null;
+      lastReportedSpools = null;
+      refreshNav();
+      refreshFilament();
+      reportSourceSpools(readSourceSpools());
     };
 
     /* =============================
@@ -561,70 +581,80 @@ $(() => {
      * ============================= */
 
     /**
-     * Get the filament array for the dropdown display. This checks all the sources we have.
+     * Get the filament array for the dropdown display. The server works it out from the filament
+     * source (see refreshFilament).
      *
-     * @returns [{id, name, type, color, enabled}, ...]
+     * @returns [{id, index, name, type, color, enabled}, ...]
      */
     self.getFilamentList = () => {
-      let filament = [];
+      return self.filamentCatalogue;
+    };
+
+    /**
+     * Asks the server for the filament in each slot and draws the nav again with it. If we already
+     * have the latest version the server just says so.
+     */
+    const refreshFilament = () => {
+      const data = filamentVersion === null ? {} : { version: filamentVersion };
+      OctoPrint.simpleApiCommand(PLUGIN_NAME, "getfilament", data).done((response) => {
+        if (!response || response.unchanged) {
+          return;
+        }
+        log("refreshFilament", response);
+        filamentVersion = response.version;
+        self.filamentCatalogue = response.filament;
+        if (lastNav) {
+          updateNav(lastNav.state, lastNav.tool, lastNav.previousTool, lastNav.response,
+                    lastNav.responseData);
+        }
+      });
+    };
+
+    /**
+     * Reads the spools from the spool plugin the filament source is set to. Only the browser can
+     * see those, the server is told about them with reportSourceSpools.
+     *
+     * @returns [{index, name, type, color}, ...] or null if the source isn't a spool plugin we have
+     */
+    const readSourceSpools = () => {
+      const source = self.settings.filamentSource();
       const filamentCount = parseInt(self.settings.filamentCount(), 10);
-      filament = self.settings.filament().map(f => {
-        return {
-          enabled: f.enabled(),
-          id: parseInt(f.id(), 10),
-          index: parseInt(f.id(), 10) - 1,
-          name: f.name(),
-          type: "",
-          color: f.color(),
-        };
-      }).filter(f => f.enabled);
-      log("getFilament internal", filament, "Source Target:", self.settings.filamentSource());
-
-      if (self.filamentSources.filamentManager !== null && self.settings.filamentSource() === FILAMENT_SOURCE_NAMES.FILAMENT_MANAGER) {
-        filament = [];
+      const spools = [];
 
+      if (self.filamentSources.filamentManager && source === FILAMENT_SOURCE_NAMES.FILAMENT_MANAGER) {
         try {
-          const spools = self.filamentSources.filamentManager.selectedSpools();
-          spools?.forEach((spool, i) => {
+          self.filamentSources.filamentManager.selectedSpools()?.forEach((spool, i) => {
             if (!spool || i >= filamentCount) {
               return;
             }
-            filament.push({
-              enabled: true,
-              id: i + 1,
-              index: i,
-              name: spool.name,
-              type: spool.profile.material,
-              color: spool.color
-            });
+            spools.push({ index: i, name: spool.name, type: spool.profile.material, color: spool.color });
           });
-          log("getFilament filamentManager", filament, spools);
         } catch(e) {
           console.error("Create a github issue with the following:", "prusammu Error: getFilament filamentManager failed.", e);
         }
-      } else if (self.filamentSources.spoolManager !== null && self.settings.filamentSource() === FILAMENT_SOURCE_NAMES.SPOOL_MANAGER) {
-        filament = [];
+        return spools;
+      }
 
+      if (self.filamentSources.spoolManager && source === FILAMENT_SOURCE_NAMES.SPOOL_MANAGER) {
         try {
-          const spools = self.filamentSources.spoolManager.api_getSelectedSpoolInformations();
-          spools?.forEach(spool => {
+          self.filamentSources.spoolManager.api_getSelectedSpoolInformations()?.forEach(spool => {
             if (!spool) {
               return;
             }
-            filament.push({
-              enabled: true,
-              id: parseInt(spool.toolIndex, 10) + 1,
+            spools.push({
               index: parseInt(spool.toolIndex, 10),
               name: spool.spoolName,
               type: spool.material,
-              color: spool.color
+              color: spool.color,
             });
           });
-          log("getFilament SpoolManager", filament, spools);
         } catch(e) {
           console.error("Create a github issue with the following:", "prusammu Error: getFilament SpoolManager failed.", e);
         }
-      } else if (self.filamentSources.spoolMan !== null && self.settings.filamentSource() === FILAMENT_SOURCE_NAMES.SPOOL_MAN) {
+        return spools;
+      }
+
+      if (self.filamentSources.spoolMan && source === FILAMENT_SOURCE_NAMES.SPOOL_MAN) {
         const getSpoolManColor = (f) => {
           if (f.color_hex) {
             return `#${f.color_hex.replace("#","")}`;
@@ -635,40 +665,50 @@ $(() => {
           return "#C0C0C0";
         }
 
-        filament = [];
-
         try {
-          const spools = self.filamentSources.spoolMan.templateData.selectedSpoolsByToolIdx();
-          spools?.forEach((spool, i) => {
+          self.filamentSources.spoolMan.templateData.selectedSpoolsByToolIdx()?.forEach((spool, i) => {
             if (!spool?.spoolData?.filament) {
               return;
             }
             const data = spool.spoolData.filament;
-            filament.push({
-              enabled: true,
-              id: i + 1,
-              index: i,
-              name: data.name,
-              type: data.material || "",
-              color: getSpoolManColor(data),
-            });
+            spools.push({ index: i, name: data.name, type: data.material || "", color: getSpoolManColor(data) });
           });
         } catch(e) {
           console.error("Create a github issue with the following:", "prusammu Error: getFilament SpoolMan failed.", e);
         }
+        return spools;
       }
 
-      // Catchall if we got zero back, default to showing something.
-      if (filament.length === 0) {
-        filament = [];
-        for (const i = 0; i < parseInt(self.settings.filamentCount(), 10); i++) {
-          filament.push({id: i + 1, index: i, name: "", type: "", color: "", enabled: true});
-        }
-        log("getFilament fallback", filament);
+      return null;
+    };
+
+    /**
+     * Tells the server what's in the spool plugin if it changed since we last did. The server
+     * lets every browser know (see refreshFilament).
+     *
+     * @param {[{index, name, type, color}, ...]} spools - see readSourceSpools()
+     */
+    const reportSourceSpools = (spools) => {
+      if (spools === null || !self.loginState.isUser()) {
+        return;
       }
+      const source = self.settings.filamentSource();
+      const report = JSON.stringify([source, spools]);
+      if (report === lastReportedSpools) {
+        return;
+      }
+      lastReportedSpools = report;
+      log("reportSourceSpools", source, spools);
+      OctoPrint.simpleApiCommand(PLUGIN_NAME, "setfilament", { source, filament: spools });
+    };
 
-      return filament;
-    }
+    /**
+     * Spool plugins keep their spools in observables, reading them in a computed means we hear
+     * about it when they load (they can be slow to) or a spool is changed.
+     */
+    const watchSourceSpools = () => {
+      ko.computed(() => reportSourceSpools(readSourceSpools()));
+    };
 
     /**
      * Get the nav display name of the filament.
@@ -715,18 +755,97 @@ $(() => {
      */
     const setupRefocusCheck = () => {
       log("setupRefocusCheck");
-      setInterval(() => {
+      document.addEventListener("visibilitychange", () => {
         if (document.hidden) {
-          isActiveTab = false;
           return;
         }
-        if (!document.hidden && isActiveTab) {
+        log("setupRefocusCheck:", "Refreshing nav");
+        refreshNav();
+        refreshFilament();
+        reportSourceSpools(readSourceSpools());
+      });
+    };
+
+    /**
+     * Asks the server for the mmu state. Only this browser gets the answer and if we've already
+     * seen the latest nav message the server just says so.
+     */
+    const refreshNav = () => {
+      const data = lastNavSeq === null ? {} : { seq: lastNavSeq };
+      OctoPrint.simpleApiCommand(PLUGIN_NAME, "getmmu", data).done((response) => {
+        if (!response || response.unchanged) {
           return;
         }
-        log("setupRefocusCheck:", "Refreshing nav");
-        isActiveTab = true;
-        OctoPrint.simpleApiCommand(PLUGIN_NAME, "getmmu");
-      }, 10000);
+        // A nav message may have beaten the response here
+        if (lastNavSeq !== null && response.seq < lastNavSeq) {
+          return;
+        }
+        applyNav(response);
+      });
+    };
+
+    /**
+     * Shows a nav message (or getmmu response) in the nav.
+     *
+     * @param {{seq, state, tool, previousTool, response, responseData, prusaVersion,
+     *          toolChangeTimeLeft, toolChangesLeft}} data
+     */
+    const applyNav = (data) => {
+      lastNavSeq = data.seq;
+      lastNav = data;
+      self.toolChangeTimeLeft(data.toolChangeTimeLeft === undefined ? null : data.toolChangeTimeLeft);
+      self.toolChangesLeft(data.toolChangesLeft === undefined ? null : data.toolChangesLeft);
+      updateNav(data.state, data.tool, data.previousTool, data.response, data.responseData);
+      if (data.prusaVersion) {
+        self._prusaVersion = data.prusaVersion;
+      }
+    };
+
+    /**
+     * Whether this browser wants the server's debug records in its console.
+     */
+    const isDebugConsole = () => {
+      return localStorage.getItem(DEBUG_CONSOLE_KEY) === "true";
+    };
+
+    /**
+     * Turns the debug console on or off for this browser only.
+     *
+     * @param {boolean} enabled
+     */
+    const setDebugConsole = (enabled) => {
+      localStorage.setItem(DEBUG_CONSOLE_KEY, enabled ? "true" : "false");
+      clearTimeout(debugPoll);
+      debugPoll = undefined;
+      if (enabled && self.settings.debug()) {
+        pollDebug();
+      }
+    };
+
+    /**
+     * Fetches the debug records we haven't seen yet and prints them. Keeps paging while there are
+     * more, then waits DEBUG_POLL_MS.
+     */
+    const pollDebug = () => {
+      OctoPrint.simpleApiCommand(PLUGIN_NAME, "getdebug", { since: debugSeq, limit: DEBUG_PAGE })
+        .done((response) => {
+          if (response.first > debugSeq) {
+            log("pollDebug:", `${response.first - debugSeq} records dropped`);
+          }
+          response.records.forEach((record) => {
+            log(`[${record.seq}]`, new Date(record.time * 1000).toLocaleTimeString(), record.msg);
+          });
+          debugSeq = response.next;
+          if (!isDebugConsole() || !response.enabled) {
+            debugPoll = undefined;
+            return;
+          }
+          const wait = response.records.length === DEBUG_PAGE ? 0 : DEBUG_POLL_MS;
+          debugPoll = setTimeout(pollDebug, wait);
+        })
+        .fail(() => {
+          debugPoll = setTimeout(pollDebug, DEBUG_POLL_MS);
+        });
     };
 
     /**
@@ -779,6 +898,34 @@ $(() => {
       $(`${idPrefix}zone`).removeClass("hide");
     };
 
+    /**
+     * Used when settings are shown, fills the tool change times table from getphases.
+     */
+    const showPhases = () => {
+      OctoPrint.simpleApiCommand(PLUGIN_NAME, "getphases").done((response) => {
+        const rows = [];
+        const seconds = (ms) => `${(ms / 1000).toFixed(1)}s`;
+        Object.keys(response).sort((a, b) => a - b).forEach((slot) => {
+          const tool = parseInt(slot);
+          const index = self.settings.indexAtZero() ? tool : tool + 1;
+          Object.keys(response[slot]).sort().forEach((phase) => {
+            const time = response[slot][phase];
+            rows.push($("<tr>").append(
+              $("<td>").text(index),
+              $("<td>").text(getMmuProgress(phase)),
+              $("<td class='text-right'>").text(time.count),
+              $("<td class='text-right'>").text(seconds(time.meanMs)),
+              $("<td class='text-right'>").text(seconds(time.p95Ms)),
+              $("<td class='text-right'>").text(seconds(time.maxMs)),
+            ));
+          });
+        });
+        if (rows.length) {
+          $("#settings_plugin_prusammu #prusammu_phases tbody").empty().append(rows);
+        }
+      });
+    };
+
     /**
      * Given the error code it generates an error object with more information.
      * 
@@ -0,0 +1,814 @@
+# coding=utf-8
+# Behaviour checks for the plugin's building blocks, each one on its own without a plugin around it.
+# Every check listed in CHECKS is run and reported, a failed assert fails the script.
+#
+# Usage (needs OctoPrint installed, run from the repo root):
+#   python test/behaviour_checks.py
+#   python test/behaviour_checks.py --only parser
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+
+from benchmark_hooks import ROOT, TEST_DIR, GCODE_FILES  # noqa: F401 puts the repo on sys.path
+
+from octoprint_prusammu.analyze import CHUNK_SIZE, SerialLogReplay, scan_log
+from octoprint_prusammu.common.Coalescer import Coalescer
+from octoprint_prusammu.common.DebugLog import DebugLog, format_message
+from octoprint_prusammu.common.ErrorHistory import ErrorHistory
+from octoprint_prusammu.common.EventDispatcher import EventDispatcher
+from octoprint_prusammu.common.FilamentCatalogue import FilamentCatalogue, MAX_SLOTS, \
+  filament_slot, parse_slots
+from octoprint_prusammu.common.GcodeIndex import GcodeIndexCache, scan_gcode
+from octoprint_prusammu.common.HookStats import HookStats, LatencyHistogram, timed
+from octoprint_prusammu.common.Mmu import MmuStates, MMU3MK4Commands, MMU3ResponseCodes, \
+  DEFAULT_MMU_STATE
+from octoprint_prusammu.common.MmuProtocolParser import MmuProtocolParser, is_mmu_line
+from octoprint_prusammu.common.PhaseTimes import PhaseTimes, WINDOW
+from octoprint_prusammu.common.ProfileCache import ProfileCache
+from octoprint_prusammu.common.PrusaProfile import PrusaProfile
+from octoprint_prusammu.common.RecentLines import RecentLines
+from octoprint_prusammu.common.Scheduler import Scheduler
+from octoprint_prusammu.common.StateJournal import StateJournal
+from octoprint_prusammu.common.ToolChangeEstimate import ToolChangeEstimate, index_tools
+
+MK3_FIRMWARE = "FIRMWARE_NAME:Prusa-Firmware 3.13.3 based on Marlin MACHINE_TYPE:Prusa i3 MK3S"
+MK4_FIRMWARE = "FIRMWARE_NAME:Prusa-Firmware-Buddy 6.1 MACHINE_TYPE:Prusa-MK4 EXTRUDER_COUNT:1"
+# A short MK3 serial.log with two tool changes and an error, for the analyzer
+SERIAL_LOG = "mmuSerialLog.log"
+# Long enough for a worker thread to get to something queued
+SETTLE = 0.2
+
+
+class ManualClock():
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+def mmu_state(profile, **changes):
+  values = dict(state=MmuStates.OK, prusaVersion=profile)
+  values.update(changes)
+  return DEFAULT_MMU_STATE._replace(**values)
+
+
+def wait_for(condition, timeout=2.0):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.01)
+  return True
+
+
+# ======== MmuProtocolParser ========
+
+def check_parser_profile():
+  parser = MmuProtocolParser()
+  assert parser.feed(DEFAULT_MMU_STATE, "MMU2:<T0 P5*aa") == [], "parsed without a profile"
+
+  changes = parser.feed(DEFAULT_MMU_STATE, MK3_FIRMWARE)
+  assert len(changes) == 1 and changes[0].mmu.prusaVersion == PrusaProfile.MK3, changes
+  # The MMU says nothing about itself on an MK4, it's assumed ok
+  changes = parser.feed(DEFAULT_MMU_STATE, MK4_FIRMWARE)
+  assert changes[-1].mmu.state == MmuStates.OK, changes
+  assert changes[-1].mmu.prusaVersion == PrusaProfile.MK4, changes
+
+
+def check_parser_mk3():
+  parser = MmuProtocolParser(RecentLines(window=0))
+  mmu = mmu_state(PrusaProfile.MK3)
+
+  changes = parser.feed(mmu, "MMU2:<T2 P5*aa")
+  assert len(changes) == 1, changes
+  change = changes[0]
+  assert change.request == "T" and change.mmu.state == MmuStates.LOADING, change
+  assert change.mmu.tool == "2" and change.mmu.responseData == "5", change
+  # The same line back to back is the MMU being polled, not news
+  assert parser.feed(change.mmu, "MMU2:<T2 P5*aa") == []
+
+  finished = parser.feed(change.mmu, "MMU2:<T2 F0*aa")[0].mmu
+  assert finished.state == MmuStates.LOADED and finished.previousTool == "", finished
+
+  # Unknown request codes and chatter change nothing
+  assert parser.feed(finished, "MMU2:<Q0 P5*aa") == []
+  assert parser.feed(finished, "ok") == []
+
+  # Errors park the printer, the lines repeat until it's dealt with
+  attention = parser.feed(finished, "MMU2:Saving and parking")[0].mmu
+  assert attention.state == MmuStates.ATTENTION, attention
+  assert parser.feed(attention, "MMU2:Heater cooldown pending") == []
+
+
+def check_parser_mk3_paused():
+  parser = MmuProtocolParser(RecentLines(window=0))
+  paused = mmu_state(PrusaProfile.MK3, state=MmuStates.PAUSED_USER)
+  parser.feed(paused, "MMU2:<T1 P5*aa")
+  assert parser.feed(paused, "MMU2:<T1 P5*aa") == []
+  # LCD status changed clears the last line so the same response is handled again
+  assert parser.feed(paused, "LCD status changed") == []
+  assert parser.feed(paused, "MMU2:<T1 P5*aa") != []
+
+
+def check_parser_mk4():
+  parser = MmuProtocolParser(RecentLines(window=0))
+  mmu = mmu_state(PrusaProfile.MK4, tool="1")
+
+  loading = parser.feed(mmu, MMU3MK4Commands.LOADING_FINDA)[0].mmu
+  assert loading.state == MmuStates.LOADING and loading.responseData == "5", loading
+  loading = parser.feed(loading, MMU3MK4Commands.LOADING_FSENSOR)[0].mmu
+  assert loading.responseData == "7", loading
+  loaded = parser.feed(loading, MMU3MK4Commands.ACTION_DONE)[0].mmu
+  assert loaded.state == MmuStates.LOADED and loaded.tool == "1", loaded
+
+  # Done without anything going on is the idler letting go, nothing to report
+  assert parser.feed(loaded, "echo:" + MMU3MK4Commands.ACTION_DONE) == []
+
+  error = parser.feed(loaded, MMU3MK4Commands.ERROR_TMC)[0].mmu
+  assert error.state == MmuStates.ATTENTION and error.responseData == "e", error
+  # Wait for User follows an error, the error is what matters
+  assert parser.feed(error, MMU3MK4Commands.PAUSED_USER) == []
+
+  # The MK4 start line says the MMU is starting and ready straight after
+  changes = parser.feed(DEFAULT_MMU_STATE._replace(prusaVersion=PrusaProfile.MK4), MK4_FIRMWARE)
+  assert [change.mmu.state for change in changes] == [MmuStates.STARTING, MmuStates.OK], changes
+
+
+def check_parser_feed_many():
+  lines = ["MMU2:<T0 P5*aa", "ok", "MMU2:<T0 F0*aa", "MMU2:<U0 P3*aa", "MMU2:<U0 F0*aa",
+           "MMU2:<T3 P5*aa", "MMU2:<T3 F0*aa"]
+  mmu = mmu_state(PrusaProfile.MK3)
+
+  one = MmuProtocolParser(RecentLines(window=0))
+  expected = []
+  state = mmu
+  for line in lines:
+    for change in one.feed(state, line):
+      expected.append(change)
+      state = change.mmu
+
+  changes, final = MmuProtocolParser(RecentLines(window=0)).feed_many(mmu, lines)
+  assert changes == expected, changes
+  assert final == state and final.state == MmuStates.LOADED and final.tool == "3", final
+
+
+def check_parser_is_mmu_line():
+  assert is_mmu_line("MMU2:<T0 P5*aa")
+  assert is_mmu_line("echo:MMU2:Feeding to FINDA")
+  assert is_mmu_line(MK4_FIRMWARE)
+  assert is_mmu_line("LCD status changed")
+  assert not is_mmu_line("ok")
+  assert not is_mmu_line("T:215.0 /215.0 B:60.0 /60.0 @:64 B@:0")
+
+
+# ======== EventDispatcher ========
+
+def check_dispatcher_inline():
+  dispatcher = EventDispatcher()
+  calls = []
+  dispatcher.submit(calls.append, 1)
+  dispatcher.submit_latest(calls.append, 2)
+  assert dispatcher.try_submit(calls.append, 3)
+  assert calls == [1, 2, 3], calls
+
+
+def check_dispatcher_full_queue():
+  dispatcher = EventDispatcher(maxDepth=3)
+  gate = threading.Event()
+  calls = []
+  dispatcher.start()
+  dispatcher.submit(gate.wait)
+  assert wait_for(lambda: dispatcher.depth() == 0)
+
+  states = lambda n: calls.append(("state", n))  # noqa: E731
+  for n in range(3):
+    dispatcher.submit_latest(states, n)
+  # Full: a newer state replaces the oldest one, debug output is dropped
+  dispatcher.submit_latest(states, 9)
+  assert not dispatcher.try_submit(calls.append, ("debug", 0))
+  assert dispatcher.depth() == 3
+
+  # Work that can't be lost waits for room, the queue doesn't grow past maxDepth
+  producer = threading.Thread(target=lambda: [dispatcher.submit(calls.append, ("work", n))
+                                              for n in range(3)])
+  producer.start()
+  time.sleep(SETTLE)
+  assert producer.is_alive() and dispatcher.depth() == 3, calls
+  gate.set()
+  producer.join(2)
+  assert wait_for(lambda: dispatcher.depth() == 0)
+  time.sleep(SETTLE)
+
+  expected = [("state", 1), ("state", 2), ("state", 9)] + [("work", n) for n in range(3)]
+  assert calls == expected, calls
+  stats = dispatcher.stats()
+  assert stats["highWater"] == 3 and stats["dropped"] == 2 and stats["waited"] >= 1, stats
+
+
+def check_dispatcher_worker_submits():
+  dispatcher = EventDispatcher(maxDepth=1)
+  dispatcher.start()
+  calls = []
+  gate = threading.Event()
+
+  # Handed over from the worker with the queue full, it runs there and then instead of waiting
+  def fill():
+    dispatcher.submit(calls.append, "queued")
+    dispatcher.submit(calls.append, "inline")
+    gate.set()
+  dispatcher.submit(fill)
+  assert gate.wait(2), "the worker waited on itself"
+  assert wait_for(lambda: calls == ["inline", "queued"]), calls
+
+
+def check_dispatcher_errors():
+  dispatcher = EventDispatcher()
+  dispatcher.start()
+  calls = []
+  dispatcher.submit(lambda: 1 / 0)
+  dispatcher.submit(calls.append, 1)
+  assert wait_for(lambda: calls == [1]), "worker stopped after an exception"
+
+
+# ======== Scheduler ========
+
+def check_scheduler_order():
+  scheduler = Scheduler()
+  calls = []
+  scheduler.call_later(0.2, calls.append, "late")
+  scheduler.call_later(0.05, calls.append, "early")
+  # Nothing runs before start()
+  time.sleep(0.1)
+  assert calls == []
+  scheduler.start()
+  assert wait_for(lambda: len(calls) == 2), calls
+  assert calls == ["early", "late"], calls
+
+
+def check_scheduler_cancel():
+  scheduler = Scheduler()
+  scheduler.start()
+  calls = []
+  call = scheduler.call_later(0.05, calls.append, "cancelled")
+  scheduler.call_later(0.1, calls.append, "kept")
+  call.cancel()
+  call.cancel()
+  assert scheduler.pending() == 1, scheduler.pending()
+  assert wait_for(lambda: calls == ["kept"]), calls
+  time.sleep(SETTLE)
+  assert calls == ["kept"], calls
+
+
+def check_scheduler_every():
+  scheduler = Scheduler()
+  scheduler.start()
+  ticks = []
+  call = scheduler.call_every(0.02, lambda: ticks.append(1) if len(ticks) < 3 else 1 / 0)
+  # A call that raises keeps its schedule
+  assert wait_for(lambda: len(ticks) == 3), ticks
+  call.cancel()
+  time.sleep(SETTLE)
+  assert scheduler.pending() == 0, scheduler.pending()
+
+
+# ======== StateJournal ========
+
+def check_state_journal(folder):
+  journal = StateJournal(folder)
+  assert journal.last() is None
+  journal.append(dict(state=MmuStates.LOADING, tool="1"))
+  journal.append(dict(state=MmuStates.LOADED, tool="1"))
+  # Queued records count before they're written
+  assert journal.last() == dict(state=MmuStates.LOADED, tool="1")
+  assert journal.flush() == 2 and journal.flush() == 0
+
+  restarted = StateJournal(folder)
+  assert restarted.last() == dict(state=MmuStates.LOADED, tool="1"), restarted.last()
+
+  # A broken checkpoint falls back on the journal
+  with open(restarted.checkpointFile, "w") as f:
+    f.write("{not json")
+  assert restarted.load() == dict(state=MmuStates.LOADED, tool="1"), restarted.load()
+  os.remove(restarted.checkpointFile)
+  with open(restarted.journalFile, "a") as f:
+    f.write('{"state":"cut off')
+  assert restarted.load() == dict(state=MmuStates.LOADED, tool="1"), restarted.load()
+
+
+def check_state_journal_compaction(folder):
+  journal = StateJournal(folder)
+  padding = "x" * 200
+  for i in range(6000):
+    journal.append(dict(seq=i, padding=padding))
+  journal.flush()
+  assert journal.compactions == 1, journal.stats()
+  with open(journal.journalFile) as f:
+    lines = f.read().splitlines()
+  # Only whole records are kept, the last one included
+  assert all(json.loads(line) for line in lines)
+  assert json.loads(lines[-1])["seq"] == 5999
+  assert journal.load()["seq"] == 5999
+
+
+# ======== ErrorHistory ========
+
+def check_error_history(folder):
+  history = ErrorHistory(os.path.join(folder, "errors.json"), size=3)
+  for i, code in enumerate(["8001", "8002", "8001", "800d"]):
+    history.append(code, str(i), MmuStates.ATTENTION, "PRINTING", at=i)
+
+  # The ring keeps the last 3, the counts keep everything
+  records, nextSeq = history.read()
+  assert [record["seq"] for record in records] == [1, 2, 3] and nextSeq == 4, records
+  assert history.counts == {"8001": 2, "8002": 1, "800d": 1}, history.counts
+  records, nextSeq = history.read(since=2, limit=1)
+  assert [record["seq"] for record in records] == [2] and nextSeq == 3, records
+  records, nextSeq = history.read(since=10)
+  assert records == [] and nextSeq == 4, records
+
+  history.save()
+  loaded = ErrorHistory(history.path, size=3)
+  loaded.load()
+  assert loaded.to_dict() == history.to_dict(), loaded.to_dict()
+  assert loaded.append("8003", "0", MmuStates.ATTENTION, None)["seq"] == 4
+
+
+# ======== RecentLines ========
+
+def check_recent_lines():
+  clock = ManualClock()
+  recent = RecentLines(window=5, size=4, clock=clock)
+  loading = mmu_state(PrusaProfile.MK3, state=MmuStates.LOADING)
+  loaded = mmu_state(PrusaProfile.MK3, state=MmuStates.LOADED)
+
+  assert not recent.repeated("a", loading)
+  assert recent.repeated("a", loading)
+  # The same line in another state can mean something
+  assert not recent.repeated("a", loaded)
+  # Repeats don't push the window back, so a spamming line still goes through once per window
+  clock.now = 4
+  assert recent.repeated("a", loading)
+  clock.now = 5
+  assert not recent.repeated("a", loading)
+  assert recent.suppressed == 2, recent.suppressed
+
+  # Full of recent lines it starts over rather than growing
+  for line in "bcdef":
+    recent.repeated(line, loading)
+  assert len(recent._seen) <= recent.size, recent._seen
+
+  recent.clear()
+  assert not recent.repeated("a", loading)
+  off = RecentLines(window=0)
+  assert not off.repeated("a", loading) and not off.repeated("a", loading)
+
+
+# ======== ProfileCache ========
+
+def check_profile_cache(folder):
+  path = os.path.join(folder, "profiles", "profiles.json")
+  cache = ProfileCache(path)
+  key = ProfileCache.key("/dev/ttyACM0", "_default")
+  assert key == "/dev/ttyACM0|_default"
+  assert cache.get(None) is None and not cache.set(None, PrusaProfile.MK3)
+  assert cache.set(key, PrusaProfile.MK3) and not cache.set(key, PrusaProfile.MK3)
+  cache.save()
+
+  loaded = ProfileCache(path)
+  loaded.load()
+  assert loaded.get(key) == PrusaProfile.MK3, loaded.profiles
+
+  with open(path, "w") as f:
+    f.write("[broken")
+  broken = ProfileCache(path)
+  broken.load()
+  assert broken.profiles == {}, broken.profiles
+
+
+def check_profile_cache_load_merges(folder):
+  path = os.path.join(folder, "profiles.json")
+  key = ProfileCache.key("/dev/ttyACM0", "_default")
+  saved = ProfileCache(path)
+  saved.set(key, PrusaProfile.MK3)
+  saved.set("other|_default", PrusaProfile.MK3)
+  saved.save()
+
+  # What was detected before the file was read wins over the file
+  early = ProfileCache(path)
+  early.set(key, PrusaProfile.MK4)
+  early.load()
+  expected = {key: PrusaProfile.MK4, "other|_default": PrusaProfile.MK3}
+  assert early.profiles == expected, early.profiles
+
+
+# ======== FilamentCatalogue ========
+
+def check_filament_catalogue():
+  catalogue = FilamentCatalogue("prusammu")
+  filament = [dict(id=1, name="PLA", color="#ff0000"), dict(id=2, name="PETG", enabled=False),
+              dict(id="x"), dict(id=3, name="ASA", color="#00ff00")]
+
+  payload = catalogue.to_dict("prusammu", filament, 5)
+  assert [slot["index"] for slot in payload["filament"]] == [0, 2], payload
+  assert payload["filament"][0] == filament_slot(0, "PLA", "", "#ff0000"), payload
+  # Built once, the same payload until something changes
+  assert catalogue.to_dict("prusammu", filament, 5) is payload
+  catalogue.invalidate()
+  rebuilt = catalogue.to_dict("prusammu", filament, 5)
+  assert rebuilt["version"] == payload["version"] + 1, rebuilt
+
+  # A spool plugin nobody has reported yet falls back on our own filament, then on empty slots
+  assert catalogue.to_dict("spoolman", filament, 5)["filament"] == rebuilt["filament"]
+  # Settings changes invalidate it, otherwise the filament passed in isn't looked at again
+  catalogue.invalidate()
+  assert len(catalogue.to_dict("spoolman", [], 3)["filament"]) == 3
+
+  spools = parse_slots([dict(index=1, name="Red", type="PLA", color="#f00")])
+  assert catalogue.set_spools("spoolman", spools)
+  assert not catalogue.set_spools("spoolman", spools)
+  reported = catalogue.to_dict("spoolman", filament, 5)
+  assert reported["filament"] == spools and reported["source"] == "spoolman", reported
+
+
+def check_parse_slots():
+  assert parse_slots(None) is None
+  assert parse_slots([dict(index="x")]) is None
+  assert parse_slots(["PLA"]) is None
+  slots = parse_slots([dict(index=2, name="B"), dict(index=0, name="A", color=None),
+                       dict(index=MAX_SLOTS, name="out of range")])
+  assert [slot["index"] for slot in slots] == [0, 2], slots
+  assert slots[0] == filament_slot(0, "A"), slots
+  assert len(parse_slots([dict(index=i) for i in range(MAX_SLOTS * 2)])) == MAX_SLOTS
+
+
+# ======== analyze ========
+
+def replay_log(name, chunkSize=CHUNK_SIZE):
+  rows = []
+  replay = SerialLogReplay(rows.append)
+  scan_log(os.path.join(TEST_DIR, name), replay, chunkSize)
+  return replay, rows
+
+
+def check_analyze_replay():
+  replay, rows = replay_log(SERIAL_LOG)
+  assert replay.mmu.prusaVersion == PrusaProfile.MK3 and replay.toolChanges == 2, replay.mmu
+  # Detecting the printer isn't a row, the MMU2:> request isn't a line the parsers look at
+  assert all(row.get("state") != MmuStates.NOT_FOUND for row in rows), rows
+  assert [row["tool"] for row in rows if row["event"] == "tool"] == ["1", "2"], rows
+
+  # The error is counted and labelled once, parking is a state change caused by its own line
+  errors = [row for row in rows if row["event"] == "error"]
+  assert len(errors) == 1 and errors[0]["line"] == "MMU2:<T2 E8001*aa", errors
+  assert replay.errors == {"8001": 1}, replay.errors
+  attention = [row for row in rows if row.get("state") == MmuStates.ATTENTION]
+  assert len(attention) == 1 and attention[0]["event"] == "state", attention
+  assert attention[0]["line"] == "MMU2:Saving and parking", attention
+  assert rows[-1]["state"] == MmuStates.LOADED and rows[-1]["tool"] == "2", rows[-1]
+
+
+def check_analyze_chunks():
+  _, expected = replay_log(SERIAL_LOG)
+  # Lines cut in two by a chunk end are put back together
+  for chunkSize in (1, 7, 64, 100):
+    _, rows = replay_log(SERIAL_LOG, chunkSize)
+    assert rows == expected, chunkSize
+
+
+# ======== GcodeIndex ========
+
+GCODE_LINES = [
+  b"; generated\r\n", b"G1 X1 Y1\r\n", b"T0\r\n", b"  T1 ; indented, with a comment\r\n",
+  b"T1\r\n", b"T10\r\n", b"T1x ; not a tool\r\n", b"Tx\r\n", b"Tc\r\n", b"M702 C ; unload\r\n",
+  b"M403 E2 F1\r\n", b"M7020\r\n", b"G1 T1\r\n", b"T2",
+]
+
+
+# Every entry has to point at the line it came from, whatever the chunk size
+def check_gcode_entries(data, index):
+  lines = data.splitlines(True)
+  starts = [0]
+  for line in lines:
+    starts.append(starts[-1] + len(line))
+  for command, offset, lineNumber in index["entries"]:
+    assert starts[lineNumber - 1] == offset, (command, offset, lineNumber)
+    assert lines[lineNumber - 1].lstrip().startswith(command[:2].encode("ascii")), command
+  assert index["lines"] == len(lines) and index["bytes"] == len(data), index
+
+
+def check_scan_gcode(folder):
+  path = os.path.join(folder, "tools.gcode")
+  data = b"".join(GCODE_LINES)
+  with open(path, "wb") as f:
+    f.write(data)
+
+  index = scan_gcode(path)
+  check_gcode_entries(data, index)
+  commands = [entry[0] for entry in index["entries"]]
+  assert commands == ["T0", "T1", "T1", "T10", "Tx", "Tc", "M702 C", "M403 E2 F1", "T2"], commands
+  assert index["tools"] == [0, 1, 2, 10] and index["toolChanges"] == 4, index
+
+  # Lines cut in two by a chunk end are put back together
+  for chunkSize in (1, 2, 7, 64):
+    assert scan_gcode(path, chunkSize) == index, chunkSize
+
+
+def check_scan_gcode_files():
+  for name in GCODE_FILES:
+    path = os.path.join(TEST_DIR, name)
+    with open(path, "rb") as f:
+      data = f.read()
+    index = scan_gcode(path)
+    check_gcode_entries(data, index)
+    for chunkSize in (100, 4096):
+      assert scan_gcode(path, chunkSize) == index, (name, chunkSize)
+
+
+def check_gcode_index_cache(folder):
+  path = os.path.join(folder, "job.gcode")
+  with open(path, "wb") as f:
+    f.write(b"T0\nG1 X1\nT1\n")
+  cache = GcodeIndexCache(os.path.join(folder, "index"))
+  assert cache.get(path) is None
+
+  index = cache.build(path)
+  assert index["toolChanges"] == 2 and index["path"] == path, index
+  assert cache.get(path) == index and cache.get_or_build(path) == index
+
+  # A changed file isn't read from the cache
+  with open(path, "ab") as f:
+    f.write(b"T2\n")
+  assert cache.get(path) is None
+  assert cache.get_or_build(path)["toolChanges"] == 3
+  cache.remove(path)
+  cache.remove(path)
+  assert cache.get(path) is None
+
+
+# ======== PhaseTimes ========
+
+def check_phase_times_stats():
+  phaseTimes = PhaseTimes()
+  for ms in range(1, 101):
+    phaseTimes.record("1", "5", ms)
+  # Only the last WINDOW durations are kept for the stats, the count is everything
+  stats = phaseTimes.to_dict()["1"]["5"]
+  assert WINDOW == 50, WINDOW
+  assert stats == dict(count=100, meanMs=75, p95Ms=98, maxMs=100), stats
+
+  phaseTimes.record("1", "7", 4)
+  phaseTimes.record("1", "3", 30)
+  assert phaseTimes.mean_ms("1") == 75 + 4 and phaseTimes.mean_ms("1", unload=True) == 30
+  assert phaseTimes.mean_ms("2") is None
+
+
+def check_phase_times_observe():
+  phaseTimes = PhaseTimes()
+  mmu = mmu_state(PrusaProfile.MK3, state=MmuStates.LOADING, tool="2", previousTool="1",
+                  response=MMU3ResponseCodes.PROCESSING)
+  # Unloading is the previous tool's filament, loading the new one's
+  phaseTimes.observe(mmu._replace(responseData="3"), now=10.0)
+  phaseTimes.observe(mmu._replace(responseData="3"), now=10.5)
+  phaseTimes.observe(mmu._replace(responseData="5"), now=11.0)
+  phaseTimes.observe(mmu._replace(state=MmuStates.LOADED, response="F", responseData="0"), now=13.5)
+  phases = phaseTimes.to_dict()
+  assert phases["1"]["3"]["meanMs"] == 1000 and phases["2"]["5"]["meanMs"] == 2500, phases
+
+  # A phase cut short by an error only says how long the user took, it isn't kept
+  phaseTimes.observe(mmu._replace(responseData="6"), now=20.0)
+  phaseTimes.observe(mmu._replace(state=MmuStates.ATTENTION, response="E", responseData="8001"),
+                     now=80.0)
+  assert "6" not in phaseTimes.to_dict()["2"], phaseTimes.to_dict()
+
+
+# ======== ToolChangeEstimate ========
+
+def check_tool_change_estimate():
+  tools = [0, 1, 1, 2, 0]
+  estimate = ToolChangeEstimate()
+  estimate.set_tools(tools)
+  # The first load counts as a change
+  assert estimate.changesLeft == 4, estimate.changes
+
+  # Resuming from an index: two T# already sent and slot 1 loaded
+  estimate.set_tools(tools, cursor=2, current=1)
+  assert estimate.changesLeft == 2, estimate.changes
+  phaseTimes = PhaseTimes()
+  assert estimate.seconds_left(phaseTimes) is None
+  phaseTimes.record("0", "5", 10000)
+  phaseTimes.record("2", "5", 20000)
+  phaseTimes.record("2", "3", 4000)
+  # 1 -> 2 (slot 1 unload untimed, counted as the average) and 2 -> 0
+  assert estimate.seconds_left(phaseTimes) == (4000 + 20000 + 4000 + 10000) // 1000
+
+  estimate.tool_sent()
+  assert estimate.changesLeft == 2 and estimate.cursor == 3
+  estimate.tool_sent()
+  assert estimate.changesLeft == 1 and estimate.current == 2
+  assert estimate.seconds_left(phaseTimes) == (4000 + 10000) // 1000
+  estimate.tool_sent()
+  assert estimate.changesLeft == 0 and estimate.seconds_left(phaseTimes) == 0
+  # More T# than the file has changes nothing
+  estimate.tool_sent()
+  assert estimate.changesLeft == 0 and estimate.cursor == 6
+
+  estimate.reset()
+  assert estimate.tools is None and estimate.seconds_left(phaseTimes) is None
+
+
+def check_index_tools():
+  index = dict(entries=[["T0", 0, 1], ["Tx", 3, 2], ["M702 C", 6, 3], ["T3", 13, 4], ["T1", 16, 5]])
+  assert index_tools(index) == [0, 3, 1]
+  assert index_tools(index, {0: 4, 3: 0}) == [4, 0, 1]
+  assert index_tools(dict()) == []
+
+
+# ======== DebugLog ========
+
+def check_debug_log_ring():
+  log = DebugLog(size=3)
+  assert log.read() == ([], 0) and log.first() == 0
+  for i in range(5):
+    log.append("line {}", (i,))
+
+  # Wrapped around, the two oldest are gone
+  assert log.first() == 2
+  records, nextSeq = log.read()
+  assert [record["seq"] for record in records] == [2, 3, 4] and nextSeq == 5, records
+  assert [record["msg"] for record in records] == ["line 2", "line 3", "line 4"], records
+  records, nextSeq = log.read(since=3, limit=1)
+  assert [record["seq"] for record in records] == [3] and nextSeq == 4, records
+  assert log.read(since=5) == ([], 5)
+
+  log.clear()
+  assert log.read() == ([], 0)
+
+
+def check_debug_log_format():
+  mmu = mmu_state(PrusaProfile.MK3, tool="1")
+  assert format_message("T{} -> T{}", ("0", 2)) == "T0 -> T2"
+  assert format_message("state", obj=mmu) == "state " + json.dumps(mmu._asdict())
+  # Formatting happens when the record is read, a bad template doesn't lose it
+  log = DebugLog()
+  log.append("missing {} {}", ("one",))
+  records, _ = log.read()
+  assert records[0]["msg"].startswith("missing {} {} (could not format:"), records
+
+
+# ======== HookStats ========
+
+def check_histogram_buckets():
+  histogram = LatencyHistogram()
+  # Bucket i holds [2^(i-1), 2^i), 0 has one of its own
+  for ns in (0, 1, 2, 3, 4, 7, 8, 1023, 1024):
+    histogram.record(ns)
+  buckets = {bucket["lt"]: bucket["count"] for bucket in histogram.to_dict()["buckets"]}
+  assert buckets == {1: 1, 2: 1, 4: 2, 8: 2, 16: 1, 1024: 1, 2048: 1}, buckets
+
+  stats = histogram.to_dict()
+  assert stats["count"] == 9 and stats["maxNs"] == 1024, stats
+  assert stats["meanNs"] == (0 + 1 + 2 + 3 + 4 + 7 + 8 + 1023 + 1024) // 9, stats
+  # Percentiles are the upper bound of the bucket they fall in
+  assert stats["p50Ns"] == 8 and stats["p99Ns"] == 2048, stats
+  assert LatencyHistogram().to_dict()["p50Ns"] == 0
+
+
+class Timed():
+  def __init__(self):
+    self.hookStats = HookStats(["hook"])
+
+  @timed("hook")
+  def hook(self, fail):
+    if fail:
+      raise ValueError("failed")
+    return "done"
+
+
+def check_timed():
+  timedObject = Timed()
+  assert timedObject.hook(False) == "done"
+  try:
+    timedObject.hook(True)
+  except ValueError:
+    pass
+  # Calls that raise are counted too
+  assert timedObject.hookStats.to_dict()["hooks"]["hook"]["count"] == 2
+  timedObject.hookStats.record("other", 5)
+  assert timedObject.hookStats.to_dict()["hooks"]["other"]["count"] == 1
+  timedObject.hookStats.reset()
+  assert all(hook["count"] == 0 for hook in timedObject.hookStats.to_dict()["hooks"].values())
+
+
+def check_hook_stats_threads():
+  stats = HookStats(["hook"])
+
+  def record():
+    for _ in range(20000):
+      stats.record("hook", 100)
+  threads = [threading.Thread(target=record) for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  hook = stats.to_dict()["hooks"]["hook"]
+  assert hook["count"] == 80000 and hook["meanNs"] == 100, hook
+
+
+# ======== Coalescer ========
+
+def check_coalescer():
+  scheduler = Scheduler()
+  scheduler.start()
+  sent = []
+  coalescer = Coalescer(sent.append, scheduler, interval=300)
+
+  coalescer.push("a")
+  coalescer.push("b")
+  coalescer.push("c")
+  # The first goes out straight away, the last one pushed is flushed when the interval is up
+  assert sent == ["a"], sent
+  assert wait_for(lambda: sent == ["a", "c"]), sent
+  assert coalescer.coalesced == 1 and coalescer.sent == 2
+
+  # Errors skip the interval, what was pending is older so it's dropped
+  coalescer.push("d")
+  coalescer.push("e", immediate=True)
+  assert sent == ["a", "c", "e"], sent
+  time.sleep(0.4)
+  assert sent == ["a", "c", "e"], sent
+
+  coalescer.push("f")
+  coalescer.push("g")
+  coalescer.cancel()
+  time.sleep(0.4)
+  assert sent == ["a", "c", "e", "f"], sent
+
+  off = []
+  Coalescer(off.append, scheduler, interval=0).push("x")
+  assert off == ["x"]
+
+
+# ======== Runner ========
+
+CHECKS = [
+  ("parser", [check_parser_profile, check_parser_mk3, check_parser_mk3_paused, check_parser_mk4,
+              check_parser_feed_many, check_parser_is_mmu_line]),
+  ("dispatcher", [check_dispatcher_inline, check_dispatcher_full_queue,
+                  check_dispatcher_worker_submits, check_dispatcher_errors]),
+  ("scheduler", [check_scheduler_order, check_scheduler_cancel, check_scheduler_every]),
+  ("journal", [check_state_journal, check_state_journal_compaction]),
+  ("errors", [check_error_history]),
+  ("recentlines", [check_recent_lines]),
+  ("profiles", [check_profile_cache, check_profile_cache_load_merges]),
+  ("filament", [check_filament_catalogue, check_parse_slots]),
+  ("analyze", [check_analyze_replay, check_analyze_chunks]),
+  ("gcodeindex", [check_scan_gcode, check_scan_gcode_files, check_gcode_index_cache]),
+  ("phases", [check_phase_times_stats, check_phase_times_observe]),
+  ("estimate", [check_tool_change_estimate, check_index_tools]),
+  ("debuglog", [check_debug_log_ring, check_debug_log_format]),
+  ("hookstats", [check_histogram_buckets, check_timed, check_hook_stats_threads]),
+  ("coalescer", [check_coalescer]),
+]
+
+
+def run_check(check):
+  # Checks that take an argument get a folder of their own
+  folder = tempfile.mkdtemp(prefix="prusammu-checks-") if check.__code__.co_argcount else None
+  try:
+    check(*([folder] if folder else []))
+    return True
+  except Exception:
+    traceback.print_exc()
+    return False
+  finally:
+    if folder:
+      shutil.rmtree(folder, ignore_errors=True)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Behaviour checks for the plugin's components.")
+  parser.add_argument("--only", choices=[name for name, _ in CHECKS], action="append",
+                      help="default: all")
+  args = parser.parse_args()
+
+  results = []
+  for name, checks in CHECKS:
+    if args.only and name not in args.only:
+      continue
+    for check in checks:
+      ok = run_check(check)
+      print("{:5} {:12} {}".format("ok" if ok else "FAIL", name, check.__name__))
+      results.append(ok)
+  if not all(results):
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,297 @@
+# coding=utf-8
+# Hook throughput benchmark.
+#
+# Streams the bundled gcode files and the MMU lines from mmuTestStrings.txt, scaled up to as many
+# lines as asked for, through gcode_queuing_hook, gcode_sent_hook and gcode_received_hook of a
+# PrusaMMUPlugin wired to fake collaborators. Each hook is measured for the MK3 and MK4 profiles.
+#
+# Usage (needs OctoPrint installed, run from the repo root):
+#   python test/benchmark_hooks.py --lines 2000000 --output bench.json
+#   python test/benchmark_hooks.py --lines 2000000 --output new.json --compare bench.json
+#
+# Reported per hook and profile:
+#   linesPerSec            - throughput of an untimed pass over every line
+#   p50Ns/p99Ns/maxNs      - per-call latency from a second pass that times every call
+#   allocBytesPerLine      - mean peak of transient allocations per call (tracemalloc, sampled)
+#   retainedBlocksPerLine  - memory blocks still allocated afterwards, should stay at ~0
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from itertools import cycle, islice
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from octoprint_prusammu import PrusaMMUPlugin, PLUGIN_NAME  # noqa: E402
+
+TEST_DIR = os.path.join(ROOT, "test")
+GCODE_FILES = [
+  "MK3_MMU_Multi_3_0.2mm_PLA,PLA,PLA_MK3SMMU2S_6m.gcode",
+  "MK3_MMU_Single_0.2mm_PLA_MK3SMMU2S_36s.gcode",
+]
+MMU_STRINGS = "mmuTestStrings.txt"
+PROFILES = ["MK3", "MK4"]
+HOOKS = ["gcode_queuing_hook", "gcode_sent_hook", "gcode_received_hook"]
+# What a printer says between MMU lines. One MMU line is mixed in every MMU_EVERY lines.
+CHATTER = [
+  "ok",
+  "T:215.0 /215.0 B:60.0 /60.0 @:64 B@:0",
+  "echo:busy: processing",
+  "ok",
+  "NORMAL MODE: Percent done: 20; print time remaining in mins: 33",
+  "X:10.00 Y:2.00 Z:0.20 E:0.00 Count X: 10.00 Y:2.00 Z:0.20 E:0.00",
+]
+MMU_EVERY = 8
+ALLOC_SAMPLE = 20000
+
+
+# ======== Fakes ========
+
+class FakePrinter():
+  def __init__(self):
+    self.sent = 0
+
+  def commands(self, commands, tags=None, *args, **kwargs):
+    self.sent += 1
+
+  def set_job_on_hold(self, value, *args, **kwargs):
+    return True
+
+  def get_current_connection(self):
+    return "Operational", "/dev/null", 115200, dict(id="_default")
+
+
+class FakeEventBus():
+  def __init__(self):
+    self.fired = 0
+
+  def fire(self, event, payload=None):
+    self.fired += 1
+
+
+class FakePluginManager():
+  def __init__(self):
+    self.messages = 0
+
+  def send_plugin_message(self, plugin, data):
+    self.messages += 1
+
+  def get_plugin_info(self, key, *args, **kwargs):
+    return None
+
+
+class FakeSettings():
+  def __init__(self, defaults, overrides):
+    self.data = dict(defaults)
+    self.data.update(overrides)
+
+  def get(self, path, *args, **kwargs):
+    return self.data.get(path[0])
+
+  def get_int(self, path, *args, **kwargs):
+    value = self.data.get(path[0])
+    return None if value is None else int(value)
+
+  def get_boolean(self, path, *args, **kwargs):
+    return bool(self.data.get(path[0]))
+
+  def set(self, path, value, *args, **kwargs):
+    self.data[path[0]] = value
+
+  def save(self, *args, **kwargs):
+    pass
+
+
+def build_plugin(profile, **settings):
+  plugin = PrusaMMUPlugin()
+  plugin._identifier = PLUGIN_NAME
+  plugin._plugin_version = "benchmark"
+  plugin._logger = logging.getLogger("octoprint.plugins.prusammu.benchmark")
+  plugin._printer = FakePrinter()
+  plugin._event_bus = FakeEventBus()
+  plugin._plugin_manager = FakePluginManager()
+  plugin._settings = FakeSettings(plugin.get_settings_defaults(), dict(settings, prusaVersion=profile))
+  plugin._refresh_config()
+  return plugin
+
+
+# ======== Inputs ========
+
+def read_gcode(name):
+  # Same as what OctoPrint queues: comments stripped, blank lines dropped.
+  commands = []
+  with open(os.path.join(TEST_DIR, name)) as f:
+    for line in f:
+      command = line.split(";", 1)[0].strip()
+      if command:
+        commands.append(command)
+  return commands
+
+
+def read_mmu_strings():
+  # Returns the MMU lines of mmuTestStrings.txt, split into the MK3 and MK4 sections.
+  lines = dict(MK3=[], MK4=[])
+  section = "MK3"
+  with open(os.path.join(TEST_DIR, MMU_STRINGS)) as f:
+    for line in f:
+      line = line.strip()
+      if "MK3.5" in line and line.startswith("="):
+        section = "MK4"
+      if not line.startswith("!!DEBUG:send "):
+        continue
+      line = line[len("!!DEBUG:send "):]
+      if line.startswith("Recv: "):
+        line = line[len("Recv: "):]
+      lines[section].append(line)
+  return lines
+
+
+def build_streams(count):
+  commands = []
+  for name in GCODE_FILES:
+    commands.extend(read_gcode(name))
+  mmu = read_mmu_strings()
+
+  received = {}
+  for profile in PROFILES:
+    mmuLines = cycle(mmu[profile])
+    chatter = cycle(CHATTER)
+    received[profile] = [
+      next(mmuLines) if i % MMU_EVERY == 0 else next(chatter) for i in range(count)
+    ]
+  return list(islice(cycle(commands), count)), received
+
+
+# ======== Measurements ========
+
+def percentile(ordered, fraction):
+  return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def make_call(plugin, hook):
+  tags = set()
+  if hook == "gcode_received_hook":
+    fn = plugin.gcode_received_hook
+    return lambda line: fn(None, line)
+  fn = getattr(plugin, hook)
+  phase = "queuing" if hook == "gcode_queuing_hook" else "sent"
+  return lambda line: fn(None, phase, line, None, None, tags=tags)
+
+
+def measure(profile, hook, lines):
+  perf_counter_ns = time.perf_counter_ns
+
+  # Throughput
+  call = make_call(build_plugin(profile), hook)
+  start = perf_counter_ns()
+  for line in lines:
+    call(line)
+  elapsed = perf_counter_ns() - start
+
+  # Latency
+  call = make_call(build_plugin(profile), hook)
+  timings = []
+  append = timings.append
+  for line in lines:
+    callStart = perf_counter_ns()
+    call(line)
+    append(perf_counter_ns() - callStart)
+  timings.sort()
+
+  # Allocations, sampled since tracemalloc is slow
+  sample = lines[:ALLOC_SAMPLE]
+  call = make_call(build_plugin(profile), hook)
+  tracemalloc.start()
+  peaks = 0
+  blocks = sys.getallocatedblocks()
+  for line in sample:
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    call(line)
+    peaks += tracemalloc.get_traced_memory()[1] - current
+  retained = sys.getallocatedblocks() - blocks
+  tracemalloc.stop()
+
+  return dict(
+    lines=len(lines),
+    seconds=elapsed / 1e9,
+    linesPerSec=len(lines) / (elapsed / 1e9),
+    p50Ns=percentile(timings, 0.50),
+    p99Ns=percentile(timings, 0.99),
+    maxNs=timings[-1],
+    allocBytesPerLine=peaks / len(sample),
+    retainedBlocksPerLine=retained / len(sample),
+  )
+
+
+def plugin_version():
+  try:
+    return subprocess.check_output(
+      ["git", "describe", "--always", "--dirty"], cwd=ROOT, stderr=subprocess.DEVNULL
+    ).decode().strip()
+  except Exception:
+    return "unknown"
+
+
+def compare(results, baseline):
+  print("")
+  print("Compared to {} ({})".format(baseline.get("version"), baseline.get("date")))
+  for profile, hooks in results["results"].items():
+    for hook, result in hooks.items():
+      try:
+        old = baseline["results"][profile][hook]
+      except KeyError:
+        continue
+      print("  {:4} {:20} lines/sec x{:.2f}  p99 x{:.2f}  alloc x{:.2f}".format(
+        profile, hook,
+        result["linesPerSec"] / old["linesPerSec"],
+        result["p99Ns"] / max(old["p99Ns"], 1),
+        result["allocBytesPerLine"] / max(old["allocBytesPerLine"], 1e-9),
+      ))
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the PrusaMMU gcode hooks.")
+  parser.add_argument("--lines", type=int, default=1000000, help="lines streamed per hook")
+  parser.add_argument("--profile", choices=PROFILES, action="append", help="default: all")
+  parser.add_argument("--hook", choices=HOOKS, action="append", help="default: all")
+  parser.add_argument("--output", help="write the results to this JSON file")
+  parser.add_argument("--compare", help="JSON results from an earlier run to compare against")
+  args = parser.parse_args()
+
+  commands, received = build_streams(args.lines)
+  results = dict(
+    version=plugin_version(),
+    date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    python=platform.python_version(),
+    machine=platform.machine(),
+    results={},
+  )
+  for profile in args.profile or PROFILES:
+    results["results"][profile] = {}
+    for hook in args.hook or HOOKS:
+      lines = received[profile] if hook == "gcode_received_hook" else commands
+      result = measure(profile, hook, lines)
+      results["results"][profile][hook] = result
+      print("{:4} {:20} {:>12,.0f} lines/sec  p50 {:>6}ns  p99 {:>6}ns  {:>7.1f} B/line".format(
+        profile, hook, result["linesPerSec"], result["p50Ns"], result["p99Ns"],
+        result["allocBytesPerLine"]))
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
+
+  if args.compare:
+    with open(args.compare) as f:
+      compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,100 @@
+# coding=utf-8
+# Checks that writing the filament map into gcode at upload (FilamentMapStream) sends the printer
+# exactly the same commands as mapping tool commands in gcode_queuing_hook while printing.
+#
+# Each bundled gcode file is run through both paths for a few filament maps:
+#   live    - the original file, useFilamentMap on, every command goes through the queuing hook
+#   rewrite - the file as the preprocessor hook would store it, then printed the same way. The
+#             plugin sees the map header like it would at print start and passes everything through
+# Commands are taken from the file the way OctoPrint does (comments and whitespace stripped).
+#
+# Usage (needs OctoPrint installed, run from the repo root):
+#   python test/filament_map_equivalence.py
+from __future__ import absolute_import, print_function
+import io
+import os
+
+from benchmark_hooks import build_plugin, GCODE_FILES, TEST_DIR
+
+from octoprint.util.comm import process_gcode_line
+
+from octoprint_prusammu.common.FilamentMapStream import FilamentMapStream
+from octoprint_prusammu.common.Gcode import ToolRemap, has_filament_map_header
+
+FILAMENT_MAPS = [
+  [0, 1, 2, 3, 4],
+  [2, 0, 1, 4, 3],
+  [4, 4, 4, 4, 4],
+  [1, 2], # tools without a mapping pass through
+]
+
+
+def build(filamentMap):
+  return build_plugin(
+    "MK3",
+    useFilamentMap=True,
+    filamentMap=[dict(id=mapped) for mapped in filamentMap],
+  )
+
+
+def emitted(plugin, lines):
+  tags = set()
+  commands = []
+  for line in lines:
+    cmd = process_gcode_line(line.decode("utf-8"))
+    if not cmd:
+      continue
+    result = plugin.gcode_queuing_hook(None, "queuing", cmd, None, None, tags=tags)
+    if result is None:
+      commands.append(cmd)
+    else:
+      commands.extend(entry[0] for entry in result if entry is not None)
+  return commands
+
+
+def rewrite(data, toolMap):
+  stream = FilamentMapStream(io.BytesIO(data), toolMap)
+  return stream.read(), stream.rewritten
+
+
+def check(name, filamentMap):
+  with open(os.path.join(TEST_DIR, name), "rb") as f:
+    data = f.read()
+
+  live = emitted(build(filamentMap), data.splitlines(True))
+
+  plugin = build(filamentMap)
+  rewritten, count = rewrite(data, plugin.toolRemap.toolMap)
+  lines = rewritten.splitlines(True)
+  # What PRINT_STARTED does
+  plugin.fileToolMapped = has_filament_map_header(lines[0])
+  plugin._rebuild_tool_remap()
+  assert plugin.toolRemap.mode == ToolRemap.PASSTHROUGH, "rewritten file would be mapped again"
+  printed = emitted(plugin, lines)
+
+  # Uploading the rewritten file again must not map it twice
+  again, _ = rewrite(rewritten, plugin.toolRemap.toolMap)
+
+  ok = live == printed and again == rewritten
+  print("{:5} {:55} map {:16} {:4} T# rewritten, {:5} commands".format(
+    "ok" if ok else "FAIL", name, str(filamentMap), count, len(live)))
+  if live != printed:
+    for i, (a, b) in enumerate(zip(live, printed)):
+      if a != b:
+        print("  first difference at command {}: live {!r} rewrite {!r}".format(i, a, b))
+        break
+    else:
+      print("  live sent {} commands, rewrite {}".format(len(live), len(printed)))
+  if again != rewritten:
+    print("  uploading the rewritten file again changed it")
+  return ok
+
+
+def main():
+  results = [check(name, filamentMap) for name in GCODE_FILES for filamentMap in FILAMENT_MAPS]
+  if not all(results):
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,284 @@
+# coding=utf-8
+# Virtual MMU for load and soak testing.
+#
+# VirtualMmu emits the serial traffic a printer with an MMU produces during tool changes: MMU2
+# 3.0.0 request/response lines (MMU2:<T2 P5*..) for the MK3, the MMU2:Feeding to FINDA style lines
+# of the MK3.5/3.9/4/Core One, the error spam of a stuck MMU (Saving and parking twice a second,
+# LCD status changed once resolved) and printer chatter at a configurable rate. Tool changes come
+# from the commands the plugin's queuing hook lets through.
+#
+# run_soak() drives a synthetic multi-material job through a real PrusaMMUPlugin (with the fakes
+# from benchmark_hooks.py) and checks the plugin's MMU state after every tool change. The clock is
+# virtual, --speed 0 runs as fast as possible so an hour-long job finishes in seconds, --speed 1 is
+# real time.
+#
+# Usage (needs OctoPrint installed, run from the repo root):
+#   python test/mmu_simulator.py --profile MK3 --tool-changes 400 --error-rate 0.05
+#   python test/mmu_simulator.py --profile MK4 --tool-changes 10 --speed 1
+from __future__ import absolute_import, print_function
+import argparse
+import heapq
+import json
+import random
+import time
+
+from benchmark_hooks import build_plugin, PROFILES
+
+from octoprint_prusammu.common.Gcode import parse_tool
+from octoprint_prusammu.common.Mmu import MmuStates
+from octoprint_prusammu.common.PluginEventKeys import PluginEventKeys
+
+# Seconds each MMU phase takes
+DEFAULT_PHASE_SECONDS = dict(
+  accept=0.2,
+  unload=6.0,
+  feed_finda=4.0,
+  feed_extruder=8.0,
+  feed_nozzle=3.0,
+  disengage=0.5,
+)
+CHATTER = [
+  "T:215.0 /215.0 B:60.0 /60.0 @:64 B@:0",
+  "echo:busy: processing",
+  "NORMAL MODE: Percent done: 20; print time remaining in mins: 33",
+]
+
+
+class VirtualClock():
+  # speed 0 jumps straight to the next deadline, otherwise it sleeps (deadline - now) / speed.
+  def __init__(self, speed=0):
+    self.speed = speed
+    self.now = 0.0
+
+  def advance(self, to):
+    if to <= self.now:
+      return
+    if self.speed > 0:
+      time.sleep((to - self.now) / self.speed)
+    self.now = to
+
+
+class VirtualMmu():
+  def __init__(self, profile, clock, rng, phaseSeconds=None, queryInterval=0.3, chatterRate=4.0,
+               errorRate=0.0, errorSeconds=5.0):
+    self.profile = profile
+    self.clock = clock
+    self.rng = rng
+    self.phaseSeconds = dict(DEFAULT_PHASE_SECONDS, **(phaseSeconds or {}))
+    self.queryInterval = queryInterval
+    self.chatterRate = chatterRate
+    self.errorRate = errorRate
+    self.errorSeconds = errorSeconds
+    self.tool = None
+    self.busyUntil = 0.0
+    self.errors = 0
+    self._lines = []
+    self._seq = 0
+    self._nextChatter = 0.0
+
+  # ======== Output ========
+
+  def _emit(self, at, line):
+    self._seq += 1
+    heapq.heappush(self._lines, (at, self._seq, line))
+
+  def _mk3_line(self, request, response):
+    line = "MMU2:<{} {}".format(request, response)
+    # The firmware appends a crc, the plugin only needs the *
+    return "{}*{:02x}".format(line, sum(line.encode()) & 0xff)
+
+  def _phase(self, start, seconds, line):
+    # The printer queries the MMU the whole time so the same line repeats until the phase is done.
+    at = start
+    while at < start + seconds:
+      self._emit(at, line)
+      at += self.queryInterval
+    return start + seconds
+
+  def _error(self, start, request):
+    # A stuck MMU: the error, the printer parking and spamming it twice a second, then the user
+    # fixes it and the LCD changes.
+    self.errors += 1
+    if self.profile == "MK3":
+      at = self._phase(start, 1.0, self._mk3_line(request, "E8001"))
+    else:
+      at = self._phase(start, 1.0, "MMU2:ERR Help filament")
+    end = at + self.errorSeconds
+    while at < end:
+      self._emit(at, "MMU2:Saving and parking")
+      if self.profile != "MK3":
+        self._emit(at + 0.25, "MMU2:ERR Wait for User")
+      at += 0.5
+    self._emit(at, "LCD status changed")
+    return at
+
+  def lines_until(self, until):
+    # Yields every line (MMU and chatter) emitted up to until, advancing the clock as it goes.
+    while True:
+      nextLine = self._lines[0][0] if self._lines else None
+      if self.chatterRate > 0 and self._nextChatter <= until and (
+        nextLine is None or self._nextChatter < nextLine
+      ):
+        self.clock.advance(self._nextChatter)
+        self._nextChatter += 1.0 / self.chatterRate
+        yield self.rng.choice(CHATTER)
+        continue
+      if nextLine is None or nextLine > until:
+        break
+      at, _, line = heapq.heappop(self._lines)
+      self.clock.advance(at)
+      yield line
+    self.clock.advance(until)
+
+  # ======== Input ========
+
+  def command(self, cmd):
+    # Feed a command the printer sent. Returns when the printer can continue.
+    tool = parse_tool(cmd)
+    if tool is None:
+      return self.clock.now
+    start = max(self.clock.now, self.busyUntil)
+    phases = self.phaseSeconds
+    error = self.rng.random() < self.errorRate
+
+    if self.profile == "MK3":
+      at = start
+      if self.tool is not None:
+        at = self._phase(at, phases["accept"], self._mk3_line("U0", "A"))
+        at = self._phase(at, phases["unload"], self._mk3_line("U0", "P3"))
+        at = self._phase(at, phases["disengage"], self._mk3_line("U0", "F0"))
+      request = "T{}".format(tool)
+      at = self._phase(at, phases["accept"], self._mk3_line(request, "A"))
+      at = self._phase(at, phases["feed_finda"], self._mk3_line(request, "P5"))
+      if error:
+        at = self._error(at, request)
+        at = self._phase(at, phases["feed_finda"], self._mk3_line(request, "P5"))
+      at = self._phase(at, phases["feed_extruder"], self._mk3_line(request, "P6"))
+      at = self._phase(at, phases["feed_nozzle"], self._mk3_line(request, "P7"))
+      at = self._phase(at, phases["disengage"], self._mk3_line(request, "P2"))
+      self._emit(at, self._mk3_line(request, "F0"))
+    else:
+      at = start
+      if self.tool is not None:
+        at = self._phase(at, phases["unload"], "MMU2:Unloading to FINDA")
+        at = self._phase(at, phases["disengage"], "MMU2:Disengaging idler")
+      at = self._phase(at, phases["feed_finda"], "MMU2:Feeding to FINDA")
+      if error:
+        at = self._error(at, None)
+        at = self._phase(at, phases["feed_finda"], "MMU2:Feeding to FINDA")
+      at = self._phase(at, phases["feed_extruder"], "MMU2:Feeding to extruder")
+      at = self._phase(at, phases["feed_nozzle"], "MMU2:Feeding to FSensor")
+      self._emit(at, "MMU2:Disengaging idler")
+
+    self.tool = tool
+    self.busyUntil = at + self.queryInterval
+    return self.busyUntil
+
+
+# ======== Soak ========
+
+class RecordingEventBus():
+  # Keeps the last MMU state the plugin published so it can be checked.
+  def __init__(self):
+    self.fired = 0
+    self.last = None
+
+  def fire(self, event, payload=None):
+    self.fired += 1
+    if event == PluginEventKeys.MMU_CHANGE:
+      self.last = payload
+
+
+def synthetic_job(rng, toolChanges, tools, movesBetween):
+  current = None
+  for _ in range(toolChanges):
+    tool = rng.choice([t for t in range(tools) if t != current])
+    current = tool
+    yield "T{}".format(tool)
+    for i in range(movesBetween):
+      yield "G1 X{:.2f} Y{:.2f} E0.0{}".format(rng.random() * 200, rng.random() * 200, i % 10)
+
+
+def run_soak(profile="MK3", toolChanges=200, tools=5, movesBetween=400, moveSeconds=0.05,
+             speed=0, errorRate=0.0, chatterRate=4.0, queryInterval=0.3, seed=1):
+  rng = random.Random(seed)
+  clock = VirtualClock(speed)
+  mmu = VirtualMmu(profile, clock, rng, queryInterval=queryInterval, chatterRate=chatterRate,
+                   errorRate=errorRate)
+  plugin = build_plugin(profile)
+  # Repeated line suppression is time based, keep it on the virtual clock
+  plugin.parser.recentLines.clock = lambda: clock.now
+  bus = plugin._event_bus = RecordingEventBus()
+  tags = set()
+
+  received = 0
+  changes = 0
+  mismatches = []
+  wallStart = time.perf_counter()
+
+  for cmd in synthetic_job(rng, toolChanges, tools, movesBetween):
+    result = plugin.gcode_queuing_hook(None, "queuing", cmd, None, None, tags=tags)
+    if result is None:
+      commands = [cmd]
+    else:
+      commands = [entry[0] for entry in result if entry is not None]
+
+    for command in commands:
+      plugin.gcode_sent_hook(None, "sent", command, None, None, tags=tags)
+      until = mmu.command(command)
+      if until <= clock.now:
+        until = clock.now + moveSeconds
+      for line in mmu.lines_until(until):
+        plugin.gcode_received_hook(None, line)
+        received += 1
+
+      tool = parse_tool(command)
+      if tool is None:
+        continue
+      changes += 1
+      state = bus.last or {}
+      if state.get("state") != MmuStates.LOADED or state.get("tool") != tool:
+        mismatches.append(dict(at=round(clock.now, 2), command=command, state=state.get("state"),
+                               tool=state.get("tool")))
+
+  wall = time.perf_counter() - wallStart
+  return dict(
+    profile=profile,
+    toolChanges=changes,
+    mmuErrors=mmu.errors,
+    receivedLines=received,
+    events=bus.fired,
+    simulatedSeconds=round(clock.now, 1),
+    wallSeconds=round(wall, 3),
+    linesPerSec=round(received / wall) if wall else None,
+    mismatches=mismatches,
+  )
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Soak test the plugin against a virtual MMU.")
+  parser.add_argument("--profile", choices=PROFILES, default="MK3")
+  parser.add_argument("--tool-changes", type=int, default=200)
+  parser.add_argument("--tools", type=int, default=5)
+  parser.add_argument("--moves-between", type=int, default=400, help="G1 moves between changes")
+  parser.add_argument("--move-seconds", type=float, default=0.05, help="simulated time per move")
+  parser.add_argument("--speed", type=float, default=0, help="0 = as fast as possible, 1 = real time")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="chance a tool change errors")
+  parser.add_argument("--chatter-rate", type=float, default=4.0, help="printer lines per second")
+  parser.add_argument("--query-interval", type=float, default=0.3, help="seconds between MMU polls")
+  parser.add_argument("--seed", type=int, default=1)
+  args = parser.parse_args()
+
+  result = run_soak(
+    profile=args.profile, toolChanges=args.tool_changes, tools=args.tools,
+    movesBetween=args.moves_between, moveSeconds=args.move_seconds, speed=args.speed,
+    errorRate=args.error_rate, chatterRate=args.chatter_rate, queryInterval=args.query_interval,
+    seed=args.seed,
+  )
+  print(json.dumps(result, indent=2))
+  if result["mismatches"]:
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,175 @@
+# coding=utf-8
+# Checks that a change to the serial parsing leaves the MMU events the plugin fires as they were.
+#
+# The plugin as it is in a git revision (--against) and the plugin in the working tree are both fed the same random stream of received lines, with T# commands going through the
+# sent hook now and then. The lines are the MMU lines of mmuTestStrings.txt, a few the firmware
+# sends that it doesn't have (errors, queries, repeats) and printer chatter. Every MMU event each
+# plugin fires is compared, as is the MMU state after every line.
+#
+# Repeated line suppression (RecentLines) is time based so it's turned off on both sides.
+#
+# The parser from before this series can't be compared with: it raises on MMU2:< lines without a
+# *checksum (mmuTestStrings.txt has one, "MMU2:<X0 F0"), which was fixed with the MK3 transition
+# table (fa2cad0). Equivalence is only claimed against revisions from that fix on, for the parser
+# split compare with 5670a4d, the last revision before MmuProtocolParser.
+#
+# Usage (needs OctoPrint and git, run from the repo root):
+#   python test/parser_equivalence.py --against <commit before the change>
+#   python test/parser_equivalence.py --against 5670a4d --profile MK4 --lines 50000 --seed 3
+from __future__ import absolute_import, print_function
+import argparse
+import importlib
+import io
+import logging
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+from benchmark_hooks import FakePrinter, FakePluginManager, PROFILES, ROOT, CHATTER, \
+  read_mmu_strings
+
+PACKAGE = "octoprint_prusammu"
+MMU_KEYS = ("state", "tool", "previousTool", "response", "responseData", "prusaVersion")
+# Lines the firmware sends that mmuTestStrings.txt doesn't have
+EXTRA_LINES = dict(
+  MK3=[
+    "MMU2:<T0 P5*aa", "MMU2:<T0 F0*aa", "MMU2:<T1 E800d*aa", "MMU2:<L2 P5*1", "MMU2:<L2 F0*1",
+    "MMU2:<U0 P3*1", "MMU2:<U0 F0*1", "MMU2:<X0 F0*1", "MMU2:<K1 P5*1", "MMU2:<K1 F0*1",
+    "MMU2:<E3 P5*1", "MMU2:<E3 F0*1", "MMU2:<T2 A*1", "MMU2:<T2 R*1", "MMU2:<L1 E8005*1",
+    "MMU2:<Q0 P5*1", "MMU2:<T0 P6*aa", "MMU2:<T0 P7*aa", "MMU2:<T0 F0*bb",
+    "MMU2:Saving and parking", "MMU2:Heater cooldown pending", "LCD status changed",
+  ],
+  MK4=[
+    "MMU2:Feeding to FINDA", "MMU2:Feeding to extruder", "MMU2:Feeding to FSensor",
+    "MMU2:Disengaging idler", "MMU2:Unloading to FINDA", "MMU2:Retract from FINDA",
+    "MMU2:Command Error", "MMU2:ERR Help filament", "MMU2:ERR Internal", "MMU2:ERR TMC failed",
+    "MMU2:ERR Wait for User", "MMU2:Button", "echo:MMU2:Feeding to FINDA",
+    "FIRMWARE_NAME:Prusa-Firmware-Buddy 6.1 MACHINE_TYPE:Prusa-MK4 EXTRUDER_COUNT:1",
+  ],
+)
+SENT = ["T0", "T1", "T2", "Tx", "Tc", "G1 X1", "M109 S200", "M1600", "T3 ; c"]
+SENT_CHANCE = 0.05
+
+
+class RecordingEventBus():
+  def __init__(self):
+    self.events = []
+
+  def fire(self, event, payload=None):
+    self.events.append((event, mmu_values(payload)))
+
+
+# The MMU state as a tuple whichever form the revision keeps it in (dict, MmuState)
+def mmu_values(mmu):
+  if hasattr(mmu, "_asdict"):
+    mmu = mmu._asdict()
+  if not isinstance(mmu, dict):
+    return mmu
+  return tuple(mmu.get(key) for key in MMU_KEYS)
+
+
+# Imports the plugin package found in folder, whatever was imported before is forgotten
+def load_plugin(folder):
+  for name in list(sys.modules):
+    if name == PACKAGE or name.startswith(PACKAGE + "."):
+      del sys.modules[name]
+  sys.path.insert(0, folder)
+  try:
+    return importlib.import_module(PACKAGE)
+  finally:
+    sys.path.remove(folder)
+
+
+def export_revision(revision, folder):
+  data = subprocess.check_output(["git", "archive", revision, PACKAGE], cwd=ROOT)
+  with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+    archive.extractall(folder)
+
+
+def build_stream(profile, count, rng):
+  lines = read_mmu_strings()[profile] + EXTRA_LINES[profile] + CHATTER
+  stream = []
+  for _ in range(count):
+    if rng.random() < SENT_CHANCE:
+      stream.append(("sent", rng.choice(SENT)))
+    stream.append(("received", rng.choice(lines)))
+  return stream
+
+
+def run(module, profile, stream):
+  plugin = module.PrusaMMUPlugin()
+  plugin._identifier = module.PLUGIN_NAME if hasattr(module, "PLUGIN_NAME") else "prusammu"
+  plugin._logger = logging.getLogger("octoprint.plugins.prusammu.equivalence")
+  plugin._printer = FakePrinter()
+  plugin._plugin_manager = FakePluginManager()
+  bus = plugin._event_bus = RecordingEventBus()
+  recentLines = getattr(getattr(plugin, "parser", plugin), "recentLines", None)
+  if recentLines is not None:
+    recentLines.window = 0
+  plugin._fire_event(module.PluginEventKeys.MMU_CHANGE, dict(prusaVersion=profile))
+
+  states = []
+  for kind, line in stream:
+    if kind == "received":
+      plugin.gcode_received_hook(None, line)
+    else:
+      plugin.gcode_sent_hook(None, "sent", line, None, None, tags=set())
+    states.append(mmu_values(plugin.mmu))
+  return bus.events, states
+
+
+def first_difference(before, after):
+  for i, (a, b) in enumerate(zip(before, after)):
+    if a != b:
+      return i, a, b
+  if len(before) != len(after):
+    i = min(len(before), len(after))
+    return i, before[i] if i < len(before) else None, after[i] if i < len(after) else None
+  return None
+
+
+def check(profile, count, seed, againstModule, workingModule):
+  stream = build_stream(profile, count, random.Random(seed))
+  beforeEvents, beforeStates = run(againstModule, profile, stream)
+  afterEvents, afterStates = run(workingModule, profile, stream)
+
+  ok = beforeEvents == afterEvents and beforeStates == afterStates
+  print("{:5} {:4} seed {:3} {:7} lines {:6} events before, {:6} after".format(
+    "ok" if ok else "FAIL", profile, seed, len(stream), len(beforeEvents), len(afterEvents)))
+  for name, before, after in (("event", beforeEvents, afterEvents),
+                              ("state after step", beforeStates, afterStates)):
+    difference = first_difference(before, after)
+    if difference is not None:
+      i, a, b = difference
+      print("  first {} difference at {}: before {!r} after {!r}".format(name, i, a, b))
+  return ok
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Compare the MMU events of two plugin revisions.")
+  parser.add_argument("--against", required=True,
+                      help="git revision to compare with, the working tree against itself proves "
+                           "nothing so there's no default")
+  parser.add_argument("--profile", choices=PROFILES, action="append", help="default: all")
+  parser.add_argument("--lines", type=int, default=20000, help="received lines per run")
+  parser.add_argument("--seed", type=int, action="append", help="default: 1 and 2")
+  args = parser.parse_args()
+
+  folder = tempfile.mkdtemp(prefix="prusammu-equivalence-")
+  export_revision(args.against, folder)
+  # Kept loaded side by side, each plugin only uses the modules it was built with
+  againstModule = load_plugin(folder)
+  workingModule = load_plugin(ROOT)
+
+  results = [
+    check(profile, args.lines, seed, againstModule, workingModule)
+    for profile in args.profile or PROFILES for seed in args.seed or [1, 2]
+  ]
+  if not all(results):
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  main()